@@ -1,15 +1,18 @@
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import colorsys
 import pomio
 import cv2
+import profiling
 
 """
 Miscellaneous Tools
 """
 
 def readImage( fn ):
-  img = cv2.imread(fn,-1)
+  with profiling.timer( 'load' ):
+    img = cv2.imread(fn,-1)
   if img == None:
     raise IOError( "Image " + fn + " not found" )
   if img.ndim == 3:
@@ -23,6 +26,19 @@ def writeImage( fn, img ):
     img = img.copy()[:,:,::-1]
   cv2.imwrite(fn,img)
 
+# Yields the filenames given on the command line, then those in fileList (one
+# per line, or - for stdin) if it is given.  The list is read lazily, so it
+# can be long.
+def inputFilenames( filenames, fileList=None ):
+  for fn in filenames:
+    yield fn
+  if fileList:
+    f = sys.stdin if fileList == '-' else open( fileList )
+    for line in f:
+      line = line.strip()
+      if len(line) > 0:
+        yield line
+
 def _get_colors(num_colors):
     colors=[]
     for i in np.arange(0., 360., 360. / num_colors):
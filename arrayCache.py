@@ -0,0 +1,142 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+"""
+Content-addressed on-disk cache of numpy arrays, shared between processes and
+tools.  Used for super-pixel graphs and features, which are expensive to
+recompute and depend only on the image and the parameters.
+"""
+
+# Entries are .npz files in cacheDir, named by a hash of everything the result
+# depends on.  When the cache grows past maxCacheBytes the least recently used
+# entries are deleted.  Set cacheDir to None (or the environment variable
+# AMN_ARRAY_CACHE_DIR to '') to turn the cache off.
+cacheDir = os.environ.get( 'AMN_ARRAY_CACHE_DIR', \
+                             os.path.expanduser( '~/.cache/alienMarkovNetworks/arrays' ) )
+maxCacheBytes = int( float( os.environ.get( 'AMN_ARRAY_CACHE_MB', 1024 ) ) * 1024 * 1024 )
+
+def enabled():
+  return bool( cacheDir )
+
+# Hash of the parts, which can be numpy arrays (by content, shape and type),
+# strings or anything with a stable repr.  version is the version of the code
+# computing the entry, e.g. superPixels.spGraphCacheVersion, which must be
+# bumped whenever that code changes what it computes, so that entries from the
+# old code aren't used.
+def makeKey( version, *parts ):
+  h = hashlib.sha1()
+  for p in ( ( 'version', version ), ) + parts:
+    if isinstance( p, np.ndarray ):
+      p = np.ascontiguousarray( p )
+      h.update( repr( ( 'ndarray', p.dtype.str, p.shape ) ) )
+      h.update( p.data )
+    else:
+      h.update( repr( p ) )
+    h.update( '\0' )
+  return h.hexdigest()
+
+def _filename( name, key ):
+  return os.path.join( cacheDir, '%s_%s.npz' % ( name, key ) )
+
+# Returns a dict of the arrays stored under name and key, or None.
+def load( name, key ):
+  if not enabled():
+    return None
+  fn = _filename( name, key )
+  try:
+    npz = np.load( fn )
+    try:
+      res = dict( ( k, npz[k] ) for k in npz.files )
+    finally:
+      npz.close()
+    # Mark as recently used.
+    os.utime( fn, None )
+    return res
+  except ( IOError, OSError, ValueError, KeyError ):
+    # Not there, or damaged or evicted by another process meanwhile.
+    return None
+
+# Writes the file fn by calling write(f) on a temporary file in the same
+# directory, then renaming it, so that other processes and threads never see
+# part of a file.  Makes the directory if need be.  Best effort: returns False
+# if it failed.
+def writeAtomically( fn, write ):
+  tmpFn = None
+  try:
+    d = os.path.dirname( fn ) or '.'
+    if not os.path.isdir( d ):
+      os.makedirs( d )
+    fd, tmpFn = tempfile.mkstemp( suffix='.tmp', prefix=os.path.basename( fn ) + '.', dir=d )
+    with os.fdopen( fd, 'wb' ) as f:
+      write( f )
+    os.rename( tmpFn, fn )
+    return True
+  except ( IOError, OSError ):
+    if tmpFn != None and os.path.exists( tmpFn ):
+      os.remove( tmpFn )
+    return False
+
+# The size of the cache at the last scan of cacheDir plus what this process has
+# saved since, and the number of saves since.  The cache is only scanned, to
+# evict entries, when this estimate goes over maxCacheBytes or every
+# savesPerScan saves (to notice what other processes have saved).
+_estimatedBytes = None
+_savesSinceScan = 0
+savesPerScan = 100
+
+# Stores the arrays under name and key, then evicts old entries if need be.
+# Best effort: failures to write are ignored.
+def save( name, key, **arrays ):
+  global _estimatedBytes, _savesSinceScan
+  if not enabled():
+    return
+  fn = _filename( name, key )
+  if not writeAtomically( fn, lambda f: np.savez( f, **arrays ) ):
+    return
+  _savesSinceScan += 1
+  if _estimatedBytes != None:
+    try:
+      _estimatedBytes += os.path.getsize( fn )
+    except OSError:
+      pass
+  if _estimatedBytes == None or _estimatedBytes > maxCacheBytes or \
+        _savesSinceScan >= savesPerScan:
+    evict( maxCacheBytes )
+
+# Deletes the least recently used entries until the cache is under maxBytes.
+# When it is over, it is taken down to 80% of maxBytes, to leave some slack.
+def evict( maxBytes ):
+  global _estimatedBytes, _savesSinceScan
+  if not enabled() or not os.path.isdir( cacheDir ):
+    return
+  _savesSinceScan = 0
+  entries = []
+  total = 0
+  for f in os.listdir( cacheDir ):
+    if not f.endswith( '.npz' ):
+      continue
+    fn = os.path.join( cacheDir, f )
+    try:
+      st = os.stat( fn )
+    except OSError:
+      continue
+    entries.append( ( st.st_mtime, st.st_size, fn ) )
+    total += st.st_size
+  _estimatedBytes = total
+  if total <= maxBytes:
+    return
+  entries.sort()
+  for mtime, size, fn in entries:
+    if total <= 0.8 * maxBytes:
+      break
+    try:
+      os.remove( fn )
+      total -= size
+    except OSError:
+      pass
+  _estimatedBytes = total
+
+def clear():
+  evict( 0 )
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the filterbank response engines in FeatureGenerator.py: the
+separable/FFT createFilterbankResponse against the original convolve2d
+implementation.  Also checks they agree to FeatureGenerator.filterbankTolerance.
+"""
+
+# Example:
+#
+#     ./benchFilterbank.py ship-at-sea.jpg --scale 1 2 4 --repeats 3
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmark filterbank response engines.')
+parser.add_argument('infile', type=str, action='store', nargs='?', default='ship-at-sea.jpg', \
+                        help='filename of input image')
+parser.add_argument('--window', type=int, default=15, \
+                        help='filter window size, as used by generatePixelFeaturesForImage')
+parser.add_argument('--scale', type=int, nargs='+', default=[1], \
+                        help='tile the image this many times in each direction, to make bigger test images')
+parser.add_argument('--repeats', type=int, default=3, \
+                        help='number of timing runs per engine.  The best is reported.')
+
+args = parser.parse_args()
+
+import time
+import numpy as np
+import amntools
+import FeatureGenerator
+
+def bestTime( fn, img, repeats ):
+  best = None
+  for i in range(repeats):
+    t0 = time.time()
+    res = fn( img, args.window )
+    dt = time.time() - t0
+    if best == None or dt < best:
+      best = dt
+  return best, res
+
+image = amntools.readImage( args.infile )
+
+print '%12s %10s %12s %12s %8s %10s' % \
+    ('size', 'pixels', 'convolve2d', 'separable', 'speedup', 'maxAbsDiff')
+for s in args.scale:
+  img = np.tile( image, (s,s,1) )
+  tOld, respOld = bestTime( FeatureGenerator.createFilterbankResponseConvolve2d, img, args.repeats )
+  tNew, respNew = bestTime( FeatureGenerator.createFilterbankResponse, img, args.repeats )
+  assert respOld.shape == respNew.shape
+  diff = np.abs( respOld - respNew ).max()
+  print '%12s %10d %11.3fs %11.3fs %7.1fx %10.2e' % \
+      ( '%dx%d' % img.shape[:2], img.shape[0]*img.shape[1], tOld, tNew, tOld/tNew, diff )
+  assert diff <= FeatureGenerator.filterbankTolerance, \
+      'Filterbank engines differ by %g, tolerance is %g' % (diff, FeatureGenerator.filterbankTolerance)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the N-label MRF inference methods in cython_uflow, abswap against
+aexpansion, on synthetic pixel and super-pixel problems.  Reports the number of
+max-flow computations (cuts), sweeps, wall time and final energy.
+"""
+
+# Example:
+#
+#     ./benchInference.py --size 120 --nbLabels 21 --K 0.5
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmark abswap against aexpansion inference.')
+parser.add_argument('--size', type=int, default=80, \
+                        help='rows and cols of the synthetic image')
+parser.add_argument('--blockSize', type=int, default=10, \
+                        help='size of the constant label blocks in the synthetic ground truth, and of the grid super-pixels')
+parser.add_argument('--nbLabels', type=int, default=21, \
+                        help='number of labels (21 for MSRC)')
+parser.add_argument('--noise', type=float, default=0.5, \
+                        help='amount of noise in the synthetic class probabilities')
+parser.add_argument('--K0', type=float, default=0.0, \
+                        help='Offset for pixel pairwise potential.')
+parser.add_argument('--K', type=float, default=0.5, \
+                        help='Weighting for pairwise potential.')
+parser.add_argument('--seed', type=int, default=0, \
+                        help='random seed')
+
+args = parser.parse_args()
+
+import time
+import numpy as np
+import cython_uflow as uflow
+import superPixels
+
+methods = [ 'abswap', 'aexpansion' ]
+
+def noisyProbs( gt, nbLabels, noise ):
+  # class probabilities that favour the true label, plus noise
+  P = np.random.rand( *(gt.shape + (nbLabels,)) ) * noise
+  P.reshape( (-1,nbLabels) )[ np.arange(gt.size), gt.ravel() ] += 1.0
+  P /= P.sum( axis=-1 )[...,np.newaxis]
+  return np.ascontiguousarray( -np.log( np.maximum(1E-10, P) ) )
+
+def run( fn ):
+  t0 = time.time()
+  labels, stats = fn()
+  return time.time() - t0, stats
+
+def report( problem, method, dt, stats ):
+  print '%-28s %-11s %6d %6d %9.3fs %14.6f' % \
+      ( problem, method, stats['nbIterations'], stats['nbCuts'], dt, stats['energy'] )
+
+
+np.random.seed( args.seed )
+n = args.size
+L = args.nbLabels
+bs = args.blockSize
+
+# Blocky ground truth, with an image whose colour follows the labels.
+blocks = np.arange( n ) / bs
+gtBlocks = np.random.randint( 0, L, size=(blocks[-1]+1, blocks[-1]+1) )
+gt = gtBlocks[ blocks[:,np.newaxis], blocks[np.newaxis,:] ].astype(np.int32)
+palette = np.random.rand( L, 3 )
+img = np.ascontiguousarray( palette[gt] + 0.05*np.random.randn( n, n, 3 ) )
+
+print '%-28s %-11s %6s %6s %10s %14s' % \
+    ( 'problem', 'method', 'iters', 'cuts', 'time', 'energy' )
+
+# Pixel problems
+pixWts = noisyProbs( gt, L, args.noise )
+nbrParams = np.ascontiguousarray( [ args.K0, args.K, 0.1 ] )
+for nhood in [ 4, 8 ]:
+  for method in methods:
+    dt, stats = run( lambda: uflow.inferenceN( \
+        img, pixWts, method, nhood, 'contrastSensitive', nbrParams, returnStats=True, verbose=False ) )
+    report( 'pixel %dx%d, %d-nhood' % (n,n,nhood), method, dt, stats )
+
+# Super-pixel problems: a grid of square super-pixels
+spLabels = ( blocks[:,np.newaxis]*(blocks[-1]+1) + blocks[np.newaxis,:] ).astype(np.int32)
+nodes, edges = superPixels.make_graph( spLabels )
+spgraph = superPixels.SuperPixelGraph( spLabels, nodes, edges )
+spWts = noisyProbs( gtBlocks.ravel(), L, 2*args.noise )
+adjProbs = np.random.rand( L, L )
+adjProbs = np.ascontiguousarray( 0.5*(adjProbs + adjProbs.T) )
+for nbrPotentialMethod in [ 'degreeSensitive', 'adjacencyAndDegreeSensitive' ]:
+  for method in methods:
+    dt, stats = run( lambda: uflow.inferenceSuperPixel( \
+        spgraph, spWts, adjProbs, method, nbrPotentialMethod, args.K, returnStats=True, verbose=False ) )
+    report( 'superpixel %d, %s' % (spgraph.getNumSuperPixels(), nbrPotentialMethod[:9]), \
+              method, dt, stats )
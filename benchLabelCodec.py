@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the label colour codec in pomio.py over the MSRC ground truth: the
+lookup table msrc_convertRGBToLabels/msrc_convertLabelsToRGB against the
+original per-class mask versions.  Also checks they agree.
+"""
+
+# Example:
+#
+#     ./benchLabelCodec.py ~/data/sceneLabelling/MSRC_ObjCategImageDatabase_v2 --repeats 3
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmark the label colour codec over the MSRC GroundTruth directory.')
+parser.add_argument('dataSetPath', type=str, action='store', \
+                        help='base directory of the MSRC data set')
+parser.add_argument('--repeats', type=int, default=3, \
+                        help='number of timing runs per codec.  The best is reported.')
+
+args = parser.parse_args()
+
+import glob
+import time
+import numpy as np
+import amntools
+import pomio
+
+def bestTime( fn, images, repeats ):
+  best = None
+  for i in range(repeats):
+    t0 = time.time()
+    res = [ fn( img ) for img in images ]
+    dt = time.time() - t0
+    if best == None or dt < best:
+      best = dt
+  return best, res
+
+gtFns = sorted( glob.glob( args.dataSetPath + '/GroundTruth/*_GT.bmp' ) )
+assert len(gtFns) > 0, 'No ground truth images in ' + args.dataSetPath + '/GroundTruth'
+print 'Reading %d ground truth images...' % len(gtFns)
+gtImages = [ np.ascontiguousarray( amntools.readImage( fn ) ) for fn in gtFns ]
+nbPixels = sum( [ img.shape[0]*img.shape[1] for img in gtImages ] )
+
+# Build the lookup table before timing.
+pomio.msrc_convertRGBToLabels( gtImages[0] )
+
+print '%12s %12s %12s %8s %12s' % \
+    ('direction', 'masks', 'lut', 'speedup', 'Mpixels/s')
+
+tOld, labsOld = bestTime( pomio.msrc_convertRGBToLabelsMasks, gtImages, args.repeats )
+tNew, labsNew = bestTime( pomio.msrc_convertRGBToLabels, gtImages, args.repeats )
+for a, b, fn in zip( labsOld, labsNew, gtFns ):
+  assert np.array_equal( a, b ), 'RGB to labels differs for ' + fn
+print '%12s %11.3fs %11.3fs %7.1fx %12.1f' % \
+    ( 'rgb->labels', tOld, tNew, tOld/tNew, nbPixels/tNew/1E6 )
+
+tOld, rgbOld = bestTime( pomio.msrc_convertLabelsToRGBMasks, labsNew, args.repeats )
+tNew, rgbNew = bestTime( pomio.msrc_convertLabelsToRGB, labsNew, args.repeats )
+for a, b, fn in zip( rgbOld, rgbNew, gtFns ):
+  assert np.array_equal( a, b ), 'Labels to RGB differs for ' + fn
+print '%12s %11.3fs %11.3fs %7.1fx %12.1f' % \
+    ( 'labels->rgb', tOld, tNew, tOld/tNew, nbPixels/tNew/1E6 )
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite over the stages of the MSRC pipeline, on synthetic images of
+fixed sizes and numbers of classes, and optionally on sample images.  Records
+the best wall time, the peak memory (RSS) added by the stage and the
+throughput of each stage, and compares them with a stored baseline to flag
+regressions.  Each stage is run in its own forked process, so that its peak
+memory can be measured.
+"""
+
+# Example:
+#
+#     ./benchPipeline.py --saveBaseline bench_baseline.json
+#     (make changes)
+#     ./benchPipeline.py --baseline bench_baseline.json
+#
+# The exit status is 1 if any stage regressed, including a stage in the
+# baseline that now fails, or if a baseline couldn't be saved because stages
+# failed.
+
+import argparse
+
+stageNames = [ 'pixelFeatures', 'aggregation', 'makeGraph', 'superPixelLabels', \
+                 'classProbs', 'inferenceN4', 'inferenceN8', 'inferenceSuperPixel', \
+                 'evaluation' ]
+
+parser = argparse.ArgumentParser(description='Benchmark the pipeline stages, and compare with a baseline.')
+parser.add_argument('--sizes', type=str, nargs='+', default=['60x80', '120x160', '240x320'], \
+                        help='rows x cols of the synthetic images')
+parser.add_argument('--nbLabels', type=int, nargs='+', default=[6, 21], \
+                        help='numbers of classes in the synthetic images (21 for MSRC, 6 for ISPRS)')
+parser.add_argument('--images', type=str, nargs='*', default=[], \
+                        help='sample images to run as well, with the largest number of classes')
+parser.add_argument('--stages', type=str, nargs='+', default=stageNames, choices=stageNames, \
+                        help='stages to run')
+parser.add_argument('--repeats', type=int, default=3, \
+                        help='number of timing runs per stage.  The best is reported.')
+parser.add_argument('--nbSuperPixels', type=int, default=400, \
+                        help='approximate number of (square) super pixels per image')
+parser.add_argument('--baseline', type=str, \
+                        help='json file of results to compare with')
+parser.add_argument('--saveBaseline', type=str, \
+                        help='json file to save the results to')
+parser.add_argument('--tolerance', type=float, default=0.25, \
+                        help='fraction by which a time or memory must exceed the baseline to be a regression')
+parser.add_argument('--seed', type=int, default=0, \
+                        help='random seed')
+
+args = parser.parse_args()
+
+import os
+import sys
+import json
+import time
+import resource
+import multiprocessing as mp
+import numpy as np
+import sklearn.ensemble
+import cython_uflow as uflow
+import amntools
+import pomio
+import FeatureGenerator
+import features
+import superPixels
+import classification
+import evalPredictions
+
+def currentRSSMB():
+  with open( '/proc/self/statm' ) as f:
+    return int( f.read().split()[1] ) * resource.getpagesize() / 1024.0**2
+
+# High-water mark of the RSS since the process started or resetPeakRSS().
+def peakRSSMB():
+  with open( '/proc/self/status' ) as f:
+    for line in f:
+      if line.startswith( 'VmHWM:' ):
+        # in kB
+        return int( line.split()[1] ) / 1024.0
+  assert False, 'No VmHWM in /proc/self/status'
+
+# Resets the high-water mark to the current RSS (linux 4.0 on), so that the
+# memory used by the setup of a stage isn't counted against it.
+def resetPeakRSS():
+  with open( '/proc/self/clear_refs', 'w' ) as f:
+    f.write( '5' )
+
+# Blocky ground truth, an image whose colour follows it, and square super
+# pixels that each lie in one block of the ground truth.
+def syntheticCase( rows, cols, nbLabels, rng ):
+  spSize = max( 2, int( np.sqrt( rows*cols / float(args.nbSuperPixels) ) ) )
+  r = np.arange( rows )[:,np.newaxis]
+  c = np.arange( cols )[np.newaxis,:]
+  gtBlocks = rng.randint( 0, nbLabels, size=( rows/(2*spSize)+1, cols/(2*spSize)+1 ) )
+  gt = gtBlocks[ r/(2*spSize), c/(2*spSize) ].astype(np.int32)
+  palette = rng.randint( 0, 256, size=(nbLabels,3) )
+  img = np.clip( palette[gt] + rng.randn( rows, cols, 3 )*10, 0, 255 ).astype(np.uint8)
+  spLabels = ( (r/spSize)*( (cols-1)/spSize + 1 ) + c/spSize ).astype(np.int32)
+  return img, gt, spLabels
+
+# The ground truth of a sample image is not needed, it is made up from the
+# colours like the synthetic one.
+def imageCase( fn, nbLabels, rng ):
+  img = np.ascontiguousarray( amntools.readImage( fn )[:,:,:3] )
+  rows, cols = img.shape[:2]
+  dummy, gt, spLabels = syntheticCase( rows, cols, nbLabels, rng )
+  return img, gt, spLabels
+
+def noisyUnaries( gt, nbLabels, rng ):
+  P = rng.rand( *(gt.shape + (nbLabels,)) ) * 0.5
+  P.reshape( (-1,nbLabels) )[ np.arange(gt.size), gt.ravel() ] += 1.0
+  P /= P.sum( axis=-1 )[...,np.newaxis]
+  return np.ascontiguousarray( -np.log( np.maximum(1E-10, P) ) )
+
+# Returns (fn, amount, unit): the function to time, and the amount of work it
+# does for the throughput.
+def setupStage( stage, img, gt, spLabels, nbLabels, rng ):
+  npix = img.shape[0]*img.shape[1]
+  nodes, edges = superPixels.make_graph( spLabels )
+  spg = superPixels.SuperPixelGraph( spLabels, nodes, edges )
+  nsp = spg.getNumSuperPixels()
+  if stage == 'pixelFeatures':
+    return ( lambda: FeatureGenerator.generatePixelFeaturesForImage( img ) ), npix, 'pixel'
+  if stage == 'aggregation':
+    pf = features.computePixelFeatures( img, 'classic' )
+    return ( lambda: features.aggregateFeaturesBySuperPixel( pf, spg, 'classic' ) ), npix, 'pixel'
+  if stage == 'makeGraph':
+    return ( lambda: superPixels.make_graph( spLabels, 4, img ) ), npix, 'pixel'
+  if stage == 'superPixelLabels':
+    return ( lambda: classification.computeSuperPixelLabels( gt, spg ) ), npix, 'pixel'
+  if stage == 'classProbs':
+    # A small forest that knows all the MSRC classes.
+    ftrs = features.computeSuperPixelFeatures( img, spg, 'classic', 'classic' )
+    nbClasses = pomio.getNumClasses()
+    X = rng.rand( 20*nbClasses, ftrs.shape[1] )
+    y = np.arange( X.shape[0] ) % nbClasses
+    clfr = sklearn.ensemble.RandomForestClassifier( n_estimators=50, random_state=args.seed )
+    clfr.fit( X, y )
+    return ( lambda: classification.classProbsOfFeatures( ftrs, clfr ) ), nsp, 'superpixel'
+  if stage in [ 'inferenceN4', 'inferenceN8' ]:
+    nhood = int( stage[-1] )
+    fimg = np.ascontiguousarray( img, dtype=float )
+    wts = noisyUnaries( gt, nbLabels, rng )
+    nbrParams = np.ascontiguousarray( [ 0.0, 0.5, 100.0 ] )
+    return ( lambda: uflow.inferenceN( fimg, wts, 'abswap', nhood, 'contrastSensitive', \
+                                         nbrParams, verbose=False ) ), npix, 'pixel'
+  if stage == 'inferenceSuperPixel':
+    # Each super pixel lies in one block of the ground truth.
+    spGt = np.zeros( nsp, dtype=int )
+    spGt[ spLabels.ravel() ] = gt.ravel()
+    wts = noisyUnaries( spGt, nbLabels, rng )
+    adjProbs = rng.rand( nbLabels, nbLabels )
+    adjProbs = np.ascontiguousarray( -np.log( 0.5*(adjProbs + adjProbs.T) ) )
+    return ( lambda: uflow.inferenceSuperPixel( spg, wts, adjProbs, 'abswap', \
+                                                  'adjacencyAndDegreeSensitive', 0.5, verbose=False ) ), \
+                                                  nsp, 'superpixel'
+  if stage == 'evaluation':
+    nbClasses = pomio.getNumClasses()
+    pred = np.where( rng.rand( *gt.shape ) < 0.8, gt, rng.randint( 0, nbLabels, gt.shape ) ) % nbClasses
+    gtv = np.where( rng.rand( *gt.shape ) < 0.05, pomio.getVoidIdx(), gt % nbClasses )
+    def evaluate():
+      evalPredictions.evaluatePrediction( pred, gtv, 'bench' )
+      evalPredictions.evaluateConfusionMatrix( pred, gtv )
+    return evaluate, npix, 'pixel'
+  assert False, 'unknown stage ' + stage
+
+# Run in a forked process: the setup, then the timings.
+def runStage( conn, stage, case ):
+  try:
+    rng = np.random.RandomState( args.seed )
+    if case[0] == 'image':
+      img, gt, spLabels = imageCase( case[1], case[2], rng )
+    else:
+      img, gt, spLabels = syntheticCase( case[1], case[2], case[3], rng )
+    nbLabels = case[-1]
+    fn, amount, unit = setupStage( stage, img, gt, spLabels, nbLabels, rng )
+    resetPeakRSS()
+    rss0 = currentRSSMB()
+    best = None
+    for i in range( args.repeats ):
+      t0 = time.time()
+      fn()
+      dt = time.time() - t0
+      if best == None or dt < best:
+        best = dt
+    conn.send( { 'seconds': best, 'peakRSSMB': max( 0.0, peakRSSMB() - rss0 ), \
+                   'throughput': amount/max(best,1E-9), 'unit': unit } )
+  except Exception, e:
+    conn.send( { 'error': '%s: %s' % ( type(e).__name__, e ) } )
+  conn.close()
+
+def caseName( case ):
+  if case[0] == 'image':
+    return '%s/%d' % ( os.path.basename( case[1] ), case[2] )
+  return '%dx%d/%d' % case[1:]
+
+cases = []
+for sz in args.sizes:
+  rows, cols = [ int(x) for x in sz.split('x') ]
+  for L in args.nbLabels:
+    cases.append( ( 'synthetic', rows, cols, L ) )
+for fn in args.images:
+  cases.append( ( 'image', fn, max( args.nbLabels ) ) )
+
+baseline = {}
+if args.baseline:
+  with open( args.baseline ) as f:
+    baseline = json.load( f )['results']
+
+print '%-20s %-20s %10s %10s %14s   %s' % \
+    ( 'stage', 'case', 'time', 'peak MB', 'throughput', 'vs baseline' )
+results = {}
+regressions = []
+failures = []
+for stage in args.stages:
+  for case in cases:
+    key = '%s %s' % ( stage, caseName( case ) )
+    parentConn, childConn = mp.Pipe()
+    p = mp.Process( target=runStage, args=( childConn, stage, case ) )
+    p.start()
+    # So that recv raises EOFError if the stage dies without sending.
+    childConn.close()
+    try:
+      res = parentConn.recv()
+    except EOFError:
+      res = None
+    p.join()
+    parentConn.close()
+    if res == None:
+      res = { 'error': 'stage process died (exit code %s)' % p.exitcode }
+    elif p.exitcode != 0 and 'error' not in res:
+      res = { 'error': 'stage process exited with code %s' % p.exitcode }
+    if 'error' in res:
+      print '%-20s %-20s failed: %s' % ( stage, caseName( case ), res['error'] )
+      failures.append( key )
+      if key in baseline:
+        regressions.append( key )
+      continue
+    results[ key ] = res
+
+    cmp = ''
+    if key in baseline:
+      base = baseline[key]
+      ratio = res['seconds'] / max( base['seconds'], 1E-9 )
+      cmp = '%5.2fx time' % ratio
+      if ratio > 1.0 + args.tolerance:
+        cmp += ' REGRESSION'
+        regressions.append( key )
+      elif res['peakRSSMB'] > ( 1.0 + args.tolerance ) * base['peakRSSMB'] + 1.0:
+        cmp += ', memory %.1f MB was %.1f MB REGRESSION' % ( res['peakRSSMB'], base['peakRSSMB'] )
+        regressions.append( key )
+    print '%-20s %-20s %9.4fs %10.1f %14s   %s' % \
+        ( stage, caseName( case ), res['seconds'], res['peakRSSMB'], \
+            '%.3f M%s/s' % ( res['throughput']/1E6, res['unit'] ), cmp )
+    sys.stdout.flush()
+
+if args.saveBaseline and len( failures ) > 0:
+  print 'Not saving a baseline to %s, as %d stages failed: %s' % \
+      ( args.saveBaseline, len(failures), ', '.join( failures ) )
+elif args.saveBaseline:
+  with open( args.saveBaseline, 'w' ) as f:
+    json.dump( { 'repeats': args.repeats, 'results': results }, f, indent=1, sort_keys=True )
+  print 'Results saved to %s' % args.saveBaseline
+
+if len( regressions ) > 0:
+  print '%d regressions: %s' % ( len(regressions), ', '.join( regressions ) )
+if len( regressions ) > 0 or ( args.saveBaseline and len( failures ) > 0 ):
+  sys.exit( 1 )
@@ -2,11 +2,14 @@
 Functionality to do with classifiers, pixel-based and super-pixel-based.
 """
 import features
+import amntools
 import numpy as np
 import pomio
 import scipy
 import matplotlib.pyplot as plt
 import superPixels
+import workerPool
+import profiling
 import pdb
 
 showDodgySPs = False
@@ -14,7 +17,8 @@ if showDodgySPs:
   plt.interactive(1)
 
 def classLabelsOfFeatures( features, classifier ):
-  return classifier.predict( features )
+  with profiling.timer( 'predict' ):
+    return classifier.predict( features )
 
 # IMPORTANT: there is a column for each CLASS, not each LABEL.  Void is not in there.
 # You'll need to offset the indices by 1 to compensate.
@@ -22,7 +26,8 @@ def classProbsOfFeatures( features, classifier ):
     assert np.all( classifier.classes_ == np.arange( pomio.getNumClasses() ) ), \
         'Error: given classifier  has %d classes, expecting %d - %s' % \
         ( len(classifier.classes_), pomio.getNumClasses(), str(classifier.classes_) )
-    probs = classifier.predict_proba( features )
+    with profiling.timer( 'predictProba' ):
+      probs = classifier.predict_proba( features )
     # Can't happen now due to above assertion
     # if len(classifier.classes_) != pomio.getNumClasses():
     #     # Transform class probs to the correct sized matrix.
@@ -73,37 +78,39 @@ def classifyImageSuperPixels( rgbImage, classifier, superPixelObj, ftype, aggtyp
   return (spLabels, outProbs)
 
 
-# Mod of the function in SuperPixelClassifier.py
-def assignClassLabelToSuperPixel(superPixelMask, imageClassLabels):
-    """This function provides basic logic for setting the overall class label for a superpixel"""
-    # just adopt the most frequently occurring class label as the superpixel label
-    superPixelConstituentLabels = imageClassLabels[superPixelMask]
-    labelCount = scipy.stats.itemfreq(superPixelConstituentLabels)
-    # This is nx2 matrix, each row is (label, count).  Sort in descending count order
-    if labelCount.shape[0] > 1:
-      idx = np.argsort( labelCount[:,1] )[::-1]
-      labelCount = labelCount[ idx, : ]
-    # If there are enough pixels of the max class, and the second class is not
-    # significant, include it.  Otherwise give it void so it gets discarded
-    # later on.
-    if float(labelCount[0,1])/len(superPixelConstituentLabels) >= 0.5 and \
-          ( labelCount.shape[0]<=1 or labelCount[1,1] <= labelCount[0,1]/2 ):
-      return int( labelCount[0,0] )
-    else:
-      raise Exception( 'WARNING: superpixel has conflicting GT class labels (%.3f %% majority).' % \
-                         (100.0 * float(labelCount[0,1])/len(superPixelConstituentLabels)) )
-
-
-def computeSuperPixelLabels( gtImage, superPixelObj ):
+# Table of the number of pixels of each label in each superpixel: an array of
+# shape (number of superpixels, number of labels), including void.
+def superPixelLabelCounts( gtImage, superPixelObj ):
   n = superPixelObj.getNumSuperPixels()
-  res = pomio.getVoidIdx() * np.ones( (n,), dtype=int )
-  c = 0
-  for sp in range( n ):
-    try:
-      res[sp] = assignClassLabelToSuperPixel( superPixelObj.getLabelImage()==sp, gtImage )
-    except:
-      # Keep a count of the undecided pixels.  Default label is void
-      c += 1
+  sp = np.asarray( superPixelObj.getLabelImage() ).ravel()
+  gt = np.asarray( gtImage ).ravel()
+  assert sp.shape == gt.shape, 'superpixel and ground truth images differ in size'
+  L = max( pomio.getNumLabels(), int( gt.max() ) + 1 )
+  counts = np.bincount( sp.astype(np.int64) * L + gt, minlength=n*L )
+  return counts[:n*L].reshape( (n, L) )
+
+# Mod of the function in SuperPixelClassifier.py, for all superpixels at once.
+# Each superpixel gets its most frequent label, if at least half of its pixels
+# have it and the second most frequent label is not significant.  Otherwise
+# it gets void so it gets discarded later on.
+def assignClassLabelsToSuperPixels( counts ):
+  n = counts.shape[0]
+  order = np.argsort( counts, axis=1 )
+  rows = np.arange( n )
+  first = counts[ rows, order[:,-1] ]
+  second = counts[ rows, order[:,-2] ] if counts.shape[1] > 1 else np.zeros( n, dtype=counts.dtype )
+  ok = ( 2*first >= counts.sum( axis=1 ) ) & ( second <= first/2 ) & ( first > 0 )
+  return np.where( ok, order[:,-1], pomio.getVoidIdx() ).astype(int)
+
+
+# Returns the label of each superpixel, and with returnCounts the table of
+# label counts from superPixelLabelCounts as well.
+def computeSuperPixelLabels( gtImage, superPixelObj, returnCounts=False ):
+  with profiling.timer( 'gtLabels' ):
+    counts = superPixelLabelCounts( gtImage, superPixelObj )
+    res = assignClassLabelsToSuperPixels( counts )
+  # Keep a count of the undecided superpixels.  Default label is void
+  c = np.count_nonzero( res != counts.argmax( axis=1 ) )
 
   if c > 0:
     print 'WARNING: %d of %d superpixels have conflicting GT class labels. Setting to void.' % (c,len(res))
@@ -114,9 +121,86 @@ def computeSuperPixelLabels( gtImage, superPixelObj ):
                                   imgTitle="Bad image graph", orientation="lower" )
       pdb.set_trace()
       plt.waitforbuttonpress()
-                                                                                     
+
+  if returnCounts:
+    return res, counts
   return res
 
 def computeSuperPixelLabelsMulti( gtImages, superPixelObjs ):
   return np.concatenate([ computeSuperPixelLabels( gtImg, spo ) \
                             for gtImg,spo in zip(gtImages,superPixelObjs) ]).astype(int)
+
+# All the per-image work for training data, done in one go so that it can run in
+# one worker: super-pixels, their features and their ground truth labels.
+# labelledImage is a pomio.LabelledImage, read here.  Returns (ftrs, labels).
+def computeSuperPixelFeaturesAndLabels( labelledImage, method, params, ftype, aggtype ):
+  with profiling.item( labelledImage.m_imgFn ):
+    spGraph = superPixels.computeSuperPixelGraph( labelledImage.m_img, method, params )
+    ftrs = features.computeSuperPixelFeatures( labelledImage.m_img, spGraph, ftype, aggtype )
+    labs = computeSuperPixelLabels( labelledImage.m_gt, spGraph )
+    profiling.count( 'superPixels', len(labs) )
+  return ftrs, labs
+
+# Yields computeSuperPixelFeaturesAndLabels for each image, in order, using the
+# shared workerPool if nbCores > 1.  Only the results travel back to this
+# process; the workers read the images themselves.
+def computeSuperPixelFeaturesAndLabelsMulti( labelledImages, method, params, ftype, aggtype, nbCores=1 ):
+  return workerPool.imapMulti( computeSuperPixelFeaturesAndLabels, \
+                                 ( ( img, method, params, ftype, aggtype ) for img in labelledImages ), \
+                                 nbCores )
+
+# Reads the image in imgFn and computes its superpixel graph and features, so
+# that it can all be done in a worker.  Returns (spGraph, ftrs).  If
+# skipFailures, an image that can't be read or processed is reported and
+# (None, None) is returned, so that it doesn't stop the other images.
+def computeSuperPixelGraphAndFeatures( imgFn, method, params, ftype, aggtype, skipFailures=False ):
+  try:
+    with profiling.item( imgFn ):
+      image = amntools.readImage( imgFn )
+      spGraph = superPixels.computeSuperPixelGraph( image, method, params )
+      ftrs = features.computeSuperPixelFeatures( image, spGraph, ftype, aggtype )
+      profiling.count( 'superPixels', spGraph.getNumSuperPixels() )
+  except Exception, e:
+    if not skipFailures:
+      raise
+    print '  WARNING: skipping image %s: %s: %s' % ( imgFn, type(e).__name__, e )
+    return None, None
+  return spGraph, ftrs
+
+# Yields computeSuperPixelGraphAndFeatures for each filename, in order, using
+# the shared workerPool if nbCores > 1.  imgFns can be any iterable, and is read
+# as the results are needed.
+def computeSuperPixelGraphAndFeaturesMulti( imgFns, method, params, ftype, aggtype, nbCores=1, \
+                                              skipFailures=False ):
+  return workerPool.imapMulti( computeSuperPixelGraphAndFeatures, \
+                                 ( ( fn, method, params, ftype, aggtype, skipFailures ) for fn in imgFns ), \
+                                 nbCores )
+
+# Class adjacency counts of the superpixel graph of one image, using its ground
+# truth superpixel labels.  Returns (adjMatrix,nbAdjInvolvingVoid,nbAdj) as
+# SuperPixelGraph.countClassAdjacencies.
+def computeClassAdjacencyCounts( labelledImage, method, params, nbClasses, connectivity=4 ):
+  with profiling.item( labelledImage.m_imgFn ):
+    spGraph = superPixels.computeSuperPixelGraph( labelledImage.m_img, method, params, connectivity )
+    labs = computeSuperPixelLabels( labelledImage.m_gt, spGraph )
+    return superPixels.countClassAdjacenciesMulti( nbClasses, [ spGraph ], [ labs ] )
+
+# Sum of computeClassAdjacencyCounts over the images, using the shared
+# workerPool if nbCores > 1.  Only each image's small count matrix comes back
+# from the workers.
+def computeClassAdjacencyCountsMulti( labelledImages, method, params, nbClasses, \
+                                        connectivity=4, nbCores=1, verbose=False ):
+  counts = np.zeros( (nbClasses, nbClasses) )
+  adjVoidCount = 0
+  adjCount = 0
+  results = workerPool.imapMulti( computeClassAdjacencyCounts, \
+                                    ( ( img, method, params, nbClasses, connectivity ) \
+                                        for img in labelledImages ), \
+                                    nbCores, chunksize=4, ordered=False )
+  for i, ( c, nv, n ) in enumerate( results ):
+    counts += c
+    adjVoidCount += nv
+    adjCount += n
+    if verbose and (i+1) % 50 == 0:
+      print '  - %d of %d images done' % ( i+1, len(labelledImages) )
+  return (counts, adjVoidCount, adjCount)
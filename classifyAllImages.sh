@@ -2,7 +2,7 @@
 
 # Usage:
 #
-#    classifyAllImages.sh <classifierFilename> <outDir> file1 file2 .... fileN
+#    classifyAllImages.sh <classifierFilename> <outDir> <nbSuperPix> <superPixCompact> <nbCores> file1 file2 .... fileN
 #
 # Applies superpixel classifier to each of the images and puts the labelling result in the output dir.
 # Absolute path for outDir recommended
@@ -37,38 +37,17 @@ if [ ! -f "$clfrName" ]; then
     exit 1
 fi
 
-# as we go, create a csv from labelled image to GT image
-csvFn="$outDir"/evalpairs.csv
-rm -f "$csvFn"
-
 logFn="$outDir"/log.txt
-rm -f "$logFn"
-typeset -i ctr=0
-
-for file in $*; do 
-    echo "Processing input image $file..."
-    echo "*" >> "$logFn"
-    echo "* Processing input image $file..." >> "$logFn"
-    echo "*" >> "$logFn"
-    
-    ifn=$(basename "$file")
-    extn="${ifn##*.}"
-    ifnBase="${ifn%.*}"
-    ofn="$outDir"/"$ifn"
-    ./testClassifier.py "$clfrName" "$file" --outfile "$ofn" \
-	--nbSuperPixels $nbSuperPixels \
-	--superPixelCompactness $superPixelCompactness \
-	--outprobsfile "${ofn%.$extn}.pkl" >> "$logFn" 2>&1 &
-
-    # append to csv
-    echo "${ofn},${ifnBase}_GT.$extn" >> "$csvFn"
 
-    ctr=$(($ctr+1))
-
-    if [ $(($ctr % $nbCores)) = 0 ]; then
-	wait
-    fi
-done
+# One process for all the images: it loads the classifier once and writes
+# evalpairs.csv in the output dir.  Images that fail are skipped and listed at
+# the end of the log.
+if ! ./classifyImages.py \
+    --nbSuperPixels $nbSuperPixels \
+    --superPixelCompactness $superPixelCompactness \
+    --nbCores $nbCores "$clfrName" "$outDir" "$@" > "$logFn" 2>&1; then
+    echo "Error: classifyImages.py failed, see $logFn"
+    exit 1
+fi
 
-wait
 echo "All done"
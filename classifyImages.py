@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import argparse
+
+"""
+Command-line tool to apply a superPixel classifier to many images in one
+process.  Like testClassifier.py on each image, but the classifier is loaded
+once, superpixels and features are computed in a pool of workers, and the class
+probabilities of many images are computed in one call.
+"""
+
+# Usage:
+#
+#   classifyImages.py <clfr.pkl> <outDir> file1 file2 ... fileN
+#   ls images/*.bmp | classifyImages.py <clfr.pkl> <outDir> --fileList -
+#
+# For each input image xxx.ext, writes the labelling as outDir/xxx.ext and
+# (superpixels, class probabilities) as outDir/xxx.pkl, and appends a line
+# to outDir/evalpairs.csv for evalPredictions.py.  Images that can't be read or
+# processed are reported and skipped, and then the exit status is 1.
+
+parser = argparse.ArgumentParser(description='Apply superPixel classifier to many images.')
+parser.add_argument('clfrFn', type=str, action='store', \
+                        help='filename of pkl superPixel classifier file')
+parser.add_argument('outDir', type=str, action='store', \
+                        help='directory for the output files')
+parser.add_argument('infiles', type=str, nargs='*', \
+                        help='filenames of input images to be classified')
+parser.add_argument('--fileList', type=str, action='store', \
+                        help='file with the input image filenames, one per line, or - for stdin.  Read as the images are processed.')
+parser.add_argument('--nbSuperPixels', type=int, default=400, \
+                        help='Desired number of super pixels in SLIC over-segmentation')
+parser.add_argument('--superPixelCompactness', type=float, default=10.0, \
+                        help='Super pixel compactness parameter for SLIC')
+parser.add_argument('--nbCores', type=int, default=1, \
+                        help='Number of cores to use in computing superpixels and features')
+parser.add_argument('--batchSize', type=int, default=32, \
+                        help='Number of images whose features are classified together')
+parser.add_argument('--verbose', action='store_true')
+args = parser.parse_args()
+
+import os
+import sys
+import time
+import collections
+import numpy as np
+import skimage
+import skimage.io
+import pomio
+import amntools
+import classification
+
+assert os.path.isdir( args.outDir ), 'Output directory %s does not exist' % args.outDir
+assert args.batchSize > 0
+
+def outputFilenames( infile ):
+  ifn = os.path.basename( infile )
+  ifnBase, extn = os.path.splitext( ifn )
+  ofn = os.path.join( args.outDir, ifn )
+  return ofn, os.path.join( args.outDir, ifnBase + '.pkl' ), '%s_GT%s' % ( ifnBase, extn )
+
+# Classifies the features of a batch of images in one go, and writes the
+# results for each image.
+def classifyBatch( batch, evalPairs ):
+  allFtrs = np.vstack( [ ftrs for fn, spGraph, ftrs in batch ] )
+  allProbs = classification.classProbsOfFeatures( allFtrs, clfr )
+  allPreds = clfr.classes_[ np.argmax( allProbs, 1 ) ]
+  start = 0
+  for fn, spGraph, ftrs in batch:
+    end = start + ftrs.shape[0]
+    spClassPreds = allPreds[ start:end ]
+    spClassProbs = allProbs[ start:end, : ]
+    start = end
+
+    ofn, oprobsfn, gtfn = outputFilenames( fn )
+    spClassPredsImage = spGraph.imageFromSuperPixelData( spClassPreds.reshape( (len(spClassPreds),1) ) )
+    if args.verbose:
+      print 'Writing output label file %s' % ofn
+    skimage.io.imsave( ofn, pomio.msrc_convertLabelsToRGB( spClassPredsImage ) )
+    pomio.pickleObject( (spGraph,spClassProbs), oprobsfn )
+    evalPairs.write( '%s,%s\n' % ( ofn, gtfn ) )
+  evalPairs.flush()
+
+t0 = time.time()
+clfr = pomio.unpickleObject( args.clfrFn )
+print 'Loaded classifier %s (%.1f s)' % ( args.clfrFn, time.time()-t0 )
+
+ftype = 'classic'
+aggtype = 'classic'
+
+# The workers get the filenames, and send back superpixels and features, in
+# order.  The filenames are kept here for the results.  workerPool.imapMulti
+# reads them in this thread, as it hands tasks to the pool, so a filename is
+# always queued before its result comes back.
+pending = collections.deque()
+def queuedFilenames():
+  for fn in amntools.inputFilenames( args.infiles, args.fileList ):
+    pending.append( fn )
+    yield fn
+results = classification.computeSuperPixelGraphAndFeaturesMulti( \
+  queuedFilenames(), 'slic', [args.nbSuperPixels, args.superPixelCompactness], \
+  ftype, aggtype, nbCores=args.nbCores, skipFailures=True )
+
+evalPairs = open( os.path.join( args.outDir, 'evalpairs.csv' ), 'w' )
+nbImages = 0
+failedFns = []
+batch = []
+for spGraph, ftrs in results:
+  fn = pending.popleft()
+  if spGraph == None:
+    failedFns.append( fn )
+    continue
+  print 'Classifying file ', fn
+  batch.append( ( fn, spGraph, ftrs ) )
+  nbImages += 1
+  if len(batch) == args.batchSize:
+    classifyBatch( batch, evalPairs )
+    batch = []
+if len(batch) > 0:
+  classifyBatch( batch, evalPairs )
+evalPairs.close()
+
+dt = time.time() - t0
+print 'Classified %d images in %.1f s (%.2f images/s)' % ( nbImages, dt, nbImages/max(dt,1E-6) )
+if len( failedFns ) > 0:
+  print 'Failed on %d images: %s' % ( len(failedFns), ' '.join( failedFns ) )
+  sys.exit( 1 )
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import argparse
+
+"""
+Command-line tool for computing the class adjacency counts of super-pixels over
+a data set, from the ground truth.  The output is what sceneLabelSuperPixels.py
+--adjFn (and labelAllImages.sh) loads.  Only use training images, or the
+potentials will have seen the test ground truth.
+"""
+
+# Examples, over the training partition made by createMSRCPartition.sh, or
+# over the training images listed in MSRC_dataSplit_Shotton/Train.txt:
+#
+#  ./createAdjacencyStats.py ~/data/sceneLabelling/msrcData/training msrcTraining_slic-400-010.00_adj.pkl --nbCores 8
+#  ./createAdjacencyStats.py --fileList MSRC_dataSplit_Shotton/Train.txt ~/data/sceneLabelling/MSRC_ObjCategImageDatabase_v2 msrcTraining_slic-400-010.00_adj.pkl --nbCores 8
+#
+
+parser = argparse.ArgumentParser(description='Compute super-pixel class adjacency counts over a data set.')
+
+# options
+parser.add_argument('--nbSuperPixels', type=int, default=400, \
+                        help='Desired number of super pixels in SLIC over-segmentation')
+parser.add_argument('--superPixelCompactness', type=float, default=10.0, \
+                        help='Super pixel compactness parameter for SLIC')
+parser.add_argument('--connectivity', type=int, default=4, choices=[4, 8], \
+                        help='Super pixels are adjacent if they touch on a 4 or 8 neighbourhood.  Use 4 for sceneLabelSuperPixels.py.')
+parser.add_argument('--prior', type=float, default=0.0, \
+                        help='Count added to every class pair, to smooth unseen adjacencies.  Note sceneLabelSuperPixels.py also adds 10 when it loads the counts.')
+parser.add_argument('--type', type=str, action='store', default='pkl', \
+                        choices = ['pkl', 'csv'], \
+                        help='output file type.  sceneLabelSuperPixels.py reads pkl.')
+parser.add_argument('--fileList', type=str, action='store', \
+                        help='file listing the images to use, one filename per line as in MSRC_dataSplit_Shotton/Train.txt, or - for stdin.  The default is all the images in MSRCPath/Images.')
+parser.add_argument('--nbCores', type=int, default=1, \
+                        help='Number of cores to use in processing')
+parser.add_argument('--v', action   = 'store_true')
+
+# arguments
+parser.add_argument('MSRCPath', type=str, action='store', \
+                        help='file path of MSRC-like data (should have Images and GroundTruth below this dir)')
+parser.add_argument('outfile', type=str, action='store', \
+                        help='output file for the nbClasses x nbClasses matrix of counts')
+
+args = parser.parse_args()
+
+import os
+import time
+import numpy as np
+import pomio
+import amntools
+import classification
+
+assert args.prior >= 0
+
+# Check can write this file.
+f=open(args.outfile,'w')
+f.close()
+
+t0 = time.time()
+subset = None
+if args.fileList:
+  subset = [ 'Images/' + os.path.basename( fn ) for fn in amntools.inputFilenames( [], args.fileList ) ]
+  assert len( subset ) > 0, 'No images listed in ' + args.fileList
+data = pomio.msrc_loadImages( args.MSRCPath, subset=subset )
+nbClasses = pomio.getNumClasses()
+print 'Counting class adjacencies over %d images, using %d cores' % ( len(data), args.nbCores )
+
+counts, adjVoidCount, adjCount = classification.computeClassAdjacencyCountsMulti( \
+  data,
+  'slic',
+  [args.nbSuperPixels, args.superPixelCompactness],
+  nbClasses,
+  connectivity=args.connectivity,
+  nbCores=args.nbCores,
+  verbose=args.v )
+
+if adjCount > 0:
+  print "  %d out of %d adjacencies were ignored due to void (%.2f %%)" % \
+      (adjVoidCount, adjCount, 100.0*adjVoidCount/adjCount)
+counts += args.prior
+
+if args.type == 'pkl':
+  pomio.pickleObject( counts, args.outfile )
+else:
+  pomio.writeMatToCSV( counts, args.outfile )
+
+print 'Output written to file %s (%.1f s)' % ( args.outfile, time.time()-t0 )
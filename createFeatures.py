@@ -14,8 +14,8 @@ parser = argparse.ArgumentParser(description='Create pixel or super-pixel featur
 
 # options
 parser.add_argument('--type', type=str, action='store', default='pkl', \
-                        choices = ['pkl', 'csv'], \
-                        help='output file type')
+                        choices = ['pkl', 'csv', 'npy'], \
+                        help='output file type.  npy streams the features to disk image by image, with an index csv, and can be memory mapped by trainClassifier.py.')
 parser.add_argument('--scaleFrac', type=float, action='store', default=1.0, \
                         help='Fraction of the available data to use.' )
 parser.add_argument('--splitRatio', action='store', default=[1.0,0.0,0.0], \
@@ -33,6 +33,8 @@ parser.add_argument('--aggtype', type=str, default='classic', \
 parser.add_argument('--nbCores', type=int, default=1, \
                         help='Number of cores to use in processing')
 parser.add_argument('--v', action   = 'store_true')
+parser.add_argument('--profile', type=str, action='store', \
+                        help='append stage timings as JSON lines to this file (see profiling.py)')
 
 # arguments
 parser.add_argument('MSRCPath', type=str, action='store', \
@@ -49,9 +51,12 @@ print 'Using %d cores' % args.nbCores
 
 import pomio
 import numpy as np
-import superPixels
-import features
 import classification
+import profiling
+
+# Before the workers start, so that they write their timings too.
+if args.profile:
+  profiling.enable( args.profile )
 
 # Function to take msrc data, create features and labels for superpixels and then save to disk
 def createAndSaveFeatureLabelData(
@@ -80,37 +85,61 @@ def createAndSaveFeatureLabelData(
     f=open(outfileLabs,'w')
     f.close()
 
+    if outfileType == 'npy':
+        # Appended to the output image by image, with an index csv.
+        store = None
+        outfileIndex = outfileFtrs.replace('_ftrs.npy', '_index.csv')
+    else:
+        # Only the rows to write are kept, until the end.
+        allFtrs = []
+        allLabs = []
+
+    # Each image goes through SLIC, features and labels in one worker, and only
+    # its non-void rows are kept here.  The LabelledImages are passed rather
+    # than their images, so that with several cores each worker reads its own
+    # images.
     if verbose:
-      print '  - computing superpixels'
-    allSuperPixels = superPixels.computeSuperPixelGraphMulti( \
-      [ z.m_img for z in msrcData ],
+      print '  - computing superpixels, features and labels for %d images' % len(msrcData)
+    nbVoid = 0
+    nbRows = 0
+    dim = None
+    results = classification.computeSuperPixelFeaturesAndLabelsMulti( \
+      msrcData,
       'slic',
-      [nbSuperPixels, superPixelCompactness], nbCores=args.nbCores )
-    if verbose:
-      print '  - computing features'
-    superPixelFeatures = features.computeSuperPixelFeaturesMulti(
-      [z.m_img for z in msrcData], allSuperPixels, ftype, aggtype, asMatrix=True, nbCores=args.nbCores
-      )
-    if verbose:
-      print '  - extracting labels'
-    superPixelLabels = classification.computeSuperPixelLabelsMulti( \
-      [z.m_gt for z in msrcData], allSuperPixels )
-
-    assert np.all( np.isfinite( superPixelFeatures ) )
-
-    # Don't save features with void labels.
-    good = ( superPixelLabels != pomio.getVoidIdx() )
-    if not np.all(good):
-      if verbose:
-        print '   - discarding %d superpixels with void labels' % np.count_nonzero( np.logical_not( good ) )
-      superPixelLabels = superPixelLabels[good]
-      superPixelFeatures = superPixelFeatures[good,:]
-
+      [nbSuperPixels, superPixelCompactness],
+      ftype, aggtype, nbCores=args.nbCores )
+    for i, ( ftrs, labs ) in enumerate( results ):
+        assert np.all( np.isfinite( ftrs ) )
+        # Don't save features with void labels.
+        good = ( labs != pomio.getVoidIdx() )
+        nbVoid += np.count_nonzero( np.logical_not( good ) )
+        ftrs = ftrs[good,:]
+        labs = labs[good]
+        nbRows += len(labs)
+        dim = ftrs.shape[1]
+        if outfileType == 'npy':
+            if store == None:
+              store = pomio.FeatureStoreWriter( outfileFtrs, outfileLabs, outfileIndex, dim )
+            store.append( msrcData[i].m_imgFn, ftrs, labs )
+        else:
+            allFtrs.append( ftrs )
+            allLabs.append( labs )
+
+    assert dim != None, 'No images to process'
     if verbose:
+      print '   - discarded %d superpixels with void labels' % nbVoid
       print '  - writing %d feature vectors of dimension %d to output files' % \
-          (superPixelFeatures.shape[0], superPixelFeatures.shape[1])
+          ( nbRows, dim )
 
     # Output
+    if outfileType == 'npy':
+        store.close()
+        print 'Output written to file ', outfileFtrs, ' and ', outfileLabs, ', index ', outfileIndex
+        return
+
+    superPixelFeatures = np.vstack( allFtrs )
+    superPixelLabels = np.concatenate( allLabs )
+    del allFtrs, allLabs
     if outfileType == 'pkl':
         pomio.pickleObject( superPixelFeatures, outfileFtrs )
         pomio.pickleObject( superPixelLabels,   outfileLabs )
@@ -138,7 +167,7 @@ testSplit = float(splitRatio[2])
 
 # This has already been checked.  To be sure, to be sure
 assert (trainSplit + cvSplit + testSplit) == 1.0 , "Data split values do not add up to 1 : " + str(trainSplit + cvSplit + testSplit) + ".  Check input data: " + str(splitRatio)
-assert outfileType in ['csv', 'pkl'], 'Unknown outfile type ' + outfileType
+assert outfileType in ['csv', 'pkl', 'npy'], 'Unknown outfile type ' + outfileType
 assert 0 <= scaleFrac and scaleFrac <= 1
 
 # Only write the type of data (i.e. train, validation, test) if a non-default split is provided as input
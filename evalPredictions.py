@@ -19,18 +19,21 @@ import argparse
 
 parser = argparse.ArgumentParser(description='Evaluate predicted class labels against ground truth image labels')
 
-parser.add_argument('evalFile', type=str, action='store', \
-                        help='CSV file listing predictions+ground truth pairs')
+parser.add_argument('evalFile', type=str, nargs='+', \
+                        help='CSV file listing predictions+ground truth pairs.  Give several (e.g. one per value of K) to evaluate each of them, decoding each ground truth image once.')
 parser.add_argument('sourceData', type=str, action='store', \
                         help='Path to source data directory for reference data (assumed to be same structure as MSRC data)')
 parser.add_argument('predictData', type=str, action='store', \
                         help='Parent path for relative filenames for predictions')
-
-args = parser.parse_args()
-
+parser.add_argument('--nbThreads', type=int, default=4, \
+                        help='Number of threads decoding the image files')
 
 import amntools
+import os
 import sys
+import collections
+import itertools
+import multiprocessing.pool
 import pomio, superPixels
 import numpy as np
 import pandas    
@@ -40,50 +43,85 @@ import pandas
 
 avgAccuracyPhrase = "**Avg prediction accuracy="
 
-def evaluateFromFile(evalFile, sourceData, predictDir):
-    evalData = None
-    
-    evalData = pomio.readEvaluationListFromCsv(evalFile)
+def evaluateFromFile(evalFile, sourceData, predictDir, nbThreads=4):
+    evaluateFromFiles([evalFile], sourceData, predictDir, nbThreads)
+
+
+# Evaluates each list of (prediction, ground truth) pairs in evalFiles, e.g. the
+# outputs of one labelling run per value of K.  Each ground truth image is
+# decoded once for all the lists.  Images are decoded by nbThreads threads,
+# which run in parallel as the decoding releases the GIL.
+def evaluateFromFiles(evalFiles, sourceData, predictDir, nbThreads=4):
+    evalDatas = []
+    for evalFile in evalFiles:
+        evalData = pomio.readEvaluationListFromCsv(evalFile)
     
-    assert evalData != None , "Exception reading evaluation data from " + str(evalFile)
+        assert evalData != None , "Exception reading evaluation data from " + str(evalFile)
 
-    print "\nINFO: Eval file list = " + str(evalFile)
-    print "INFO: Source data = " + str(sourceData)
-    print "\nINFO 1st element in eval result::" , evalData[0]
+        print "\nINFO: Eval file list = " + str(evalFile)
+        print "INFO: Source data = " + str(sourceData)
+        print "\nINFO 1st element in eval result::" , evalData[0]
+        evalDatas.append(evalData)
 
     if predictDir.endswith("/") == False:
         predictDir = predictDir + "/"
 
     # Tells us what the elements of the results are
     headers = [ "numCorrectPixels" , "numberValidGroundTruthPixels" , "numberVoidGroundTruthPixels" , "numberPixelsInImage" ]
-    
-    results = None
-    confMat = None
 
-    # for each eval pair (prediction labels and ground truth labels) do pixel count
-    
-    for idx in range(0, len(evalData)):
-    
-        predictFile = evalData[idx][0]
-        gtFile = evalData[idx][1]
-        
+    numClasses = pomio.getNumClasses()
+    results = [ np.zeros(len(headers), int) for evalData in evalDatas ]
+    confMats = [ np.zeros([numClasses, numClasses], int) for evalData in evalDatas ]
+
+    # The predictions of each ground truth image, as (run index, filename).
+    predictionsOfGt = collections.OrderedDict()
+    for run, evalData in enumerate(evalDatas):
+        for pair in evalData:
+            predictionsOfGt.setdefault(pair[1], []).append( (run, pair[0]) )
+
+    # for each ground truth, do pixel counts of its predictions
+    def evaluateGroundTruth(item):
+        gtFile, predictions = item
         gt = loadReferenceGroundTruthLabels(sourceData, gtFile)
-        predict = loadPredictionImageLabels(predictDir + predictFile)
-        
-        result = evaluatePrediction(predict, gt, gtFile)
-        cmat = evaluateConfusionMatrix(predict, gt)
+        res = []
+        for run, predictFile in predictions:
+            predict = loadPredictionImageLabels(predictDir + predictFile)
+            res.append( (run, evaluatePrediction(predict, gt, gtFile), evaluateConfusionMatrix(predict, gt)) )
+        return res
+
+    pool = None
+    if nbThreads > 1:
+        pool = multiprocessing.pool.ThreadPool(nbThreads)
+        imap = pool.imap_unordered
+    else:
+        imap = itertools.imap
+    try:
+        for res in imap(evaluateGroundTruth, predictionsOfGt.iteritems()):
+            for run, result, cmat in res:
+                results[run] += result
+                confMats[run] += cmat
+    finally:
+        if pool != None:
+            pool.terminate()
+
+    for evalFile, evalData, result, confMat in zip(evalFiles, evalDatas, results, confMats):
+        if len(evalFiles) > 1:
+            print "\n" + str(evalFile) + ":"
+        printEvaluation(len(evalData), result, confMat)
+
+    if len(evalFiles) > 1:
+        print "\nSummary:"
+        print pandas.DataFrame( [ [ 100.0 * result[0] / float( result[1] ), evaluateClassPerformance( confMat ).mean() ] \
+                                    for result, confMat in zip(results, confMats) ], \
+                                  columns=[ "pixelAccuracy", "classAccuracy" ], index=evalFiles ).to_string()
+    print "Processing complete."
 
-        if idx == 0:
-          results = result
-          confMat = cmat
-        else:
-          results += result
-          confMat += cmat
 
+def printEvaluation(numPredictions, results, confMat):
     # Aggregate results
     perClass = evaluateClassPerformance( confMat )
 
-    print "Processed total of ", len(evalData) , "predictions:"
+    print "Processed total of ", numPredictions , "predictions:"
     print "  Average accuracy per pixel: ", 100.0 * results[0] / float( results[1] )
     print "  Average accuracy per class: ", perClass.mean()
     print "  Accuracy per class: "
@@ -93,7 +131,6 @@ def evaluateFromFile(evalFile, sourceData, predictDir):
     print "  Confusion matrix (row=gt, col=predicted): "
     print pandas.DataFrame( confMat, columns=pomio.getClasses()[:-1], \
                               index=pomio.getClasses()[:-1] ).to_string()
-    print "Processing complete."
 
 
 def evaluatePrediction(predictLabels, gtLabels, gtimageName, dbg=False):
@@ -139,16 +176,17 @@ def evaluateConfusionMatrix(predictedImg, gtImg):
     
     numClasses = pomio.getNumClasses()
     
-    confusionMatrix = np.zeros([numClasses , numClasses] , int)
-    # rows are actual, cols are predicted
-    for cl in range(numClasses):
-      clMask = (gtImg == cl)
-      # It's easy, just histogram those values
-      vals = predictedImg[clMask]
-      assert np.all( np.logical_and( 0 <= vals, vals < numClasses ) ), vals.max()
-      confusionMatrix[cl,:] = np.histogram( vals, range(numClasses+1) )[0]
+    # rows are actual, cols are predicted.  One histogram of gt*numClasses+pred
+    # over the non-void pixels.
+    validMask = (np.asarray(gtImg) != pomio.getVoidIdx())
+    gtVals = np.asarray(gtImg)[validMask].astype(np.intp)
+    vals = np.asarray(predictedImg)[validMask].astype(np.intp)
+    assert np.all( gtVals < numClasses ), gtVals.max()
+    assert np.all( np.logical_and( 0 <= vals, vals < numClasses ) ), vals.max()
+    confusionMatrix = np.bincount( gtVals*numClasses + vals, minlength=numClasses*numClasses )
+    confusionMatrix = confusionMatrix.reshape((numClasses, numClasses))
     
-    assert confusionMatrix.sum() == np.count_nonzero( gtImg != pomio.getVoidIdx() ) 
+    assert confusionMatrix.sum() == np.count_nonzero( validMask ) 
 
     return confusionMatrix;
     
@@ -161,11 +199,11 @@ def evaluateClassPerformance( confusionMatrix ):
 
 
 def loadReferenceGroundTruthLabels(sourceData, imgName):
-    gtFile = str(sourceData) + "/GroundTruth/" + str(imgName)
-    if "_GT" in imgName:
-        imgName = imgName.replace("_GT" , "")
-
-    gtImgLabels = pomio.msrc_loadImages(sourceData , ["Images/" + imgName] )[0].m_gt
+    if "_GT" not in imgName:
+        base, ext = os.path.splitext(imgName)
+        imgName = base + "_GT" + ext
+    # Decoded ground truth is cached on disk, see pomio.labelCacheDir
+    gtImgLabels = pomio.msrc_readLabelImage( str(sourceData) + "/GroundTruth/" + str(imgName) )
     return gtImgLabels
 
 
@@ -179,11 +217,14 @@ def loadPredictionImageLabels(predictImgLabelsFile):
 
 if __name__ == "__main__":
 
-    evalFile = args.evalFile
+    # Parsed here so that the functions above can be imported, e.g. by
+    # benchPipeline.py.
+    args = parser.parse_args()
+    evalFiles = args.evalFile
     sourceData = args.sourceData
     predictData = args.predictData
     
-    evaluateFromFile(evalFile, sourceData, predictData)
+    evaluateFromFiles(evalFiles, sourceData, predictData, args.nbThreads)
 
 
 
@@ -54,12 +54,13 @@ for K in $Kvals; do
     #for each MSRC class probabilities image in validation set:
     ./labelAllImagesGivenProbs.sh "$adjFile" "$K" "$outDir" "$inDir"/*.pkl \
 	>/dev/null 2>/dev/null
+done
 
-    # evaluate output labellings against GT
-    #echo ./evalPredictions.py "$outDir"/evalpairs.csv "$msrcPath" ''
-    acc=$( ( ./evalPredictions.py "$outDir"/evalpairs.csv "$msrcPath" '' 2>/dev/null ) | grep 'Avg prediction' | cut -d '=' -f 2 )
-
-    echo $acc
-    # report accuracy for this K
-    echo "  K = $K, average accuracy = $acc"
+# evaluate the output labellings of all the K values against GT in one go, so
+# that each GT image is decoded once.  Ends with a summary table of the
+# accuracy for each K.
+evalFiles=""
+for K in $Kvals; do
+    evalFiles="$evalFiles $outDirBase/Kis${K}/evalpairs.csv"
 done
+./evalPredictions.py $evalFiles "$msrcPath" '' 2>/dev/null
@@ -9,10 +9,13 @@ is what matlab does and has ended up what sklearn etc does.
 """
 
 import superPixels
+import pomio
+import arrayCache
 import FeatureGenerator
 import numpy as np
 import scipy
-import multiprocessing as mp
+import workerPool
+import profiling
 
 # Returns a DxN matrix, D the feature dimension and N the number of pixels.
 def computePixelFeatures( rgbImage, ftype ):
@@ -49,31 +52,18 @@ def aggregateFeaturesBySuperPixel( pixelFeatures, superPixelsObj, aggtype ):
       res[i,:] = hh
   elif aggtype == 'classic':
     # Same as FeatureGenerator.py generateSuperPixelFeatures
-    dim = 0
-    D = 4*Dp + 1
     # The resulting feature matrix has a row per super-pixel that looks like
     # this:
     #
     #    m1,m2,...mDp,  s1,...sDp,  skew1,...skewDp,  kurt1,...kurtDp,  n
     #
     # where n is the number of pixels in the super-pixel.
-    res = np.zeros( (N,D), dtype=float )
     # Turn label image into same dim as matrix width
     labs = superPixelsObj.getLabelImage().flatten()
     assert len(labs) == Np
     assert N-1 == labs.max() and 0 == labs.min()
-    # Visit each super pixel
-    for i in range(N):
-      X = pixelFeatures[labs==i,:]
-      assert X.shape[0] > 0, "Empty superpixel!"
-      with np.errstate( invalid='ignore' ):
-        res[i,:] = np.concatenate([
-            X.mean(dim),
-            X.std(dim),
-            scipy.stats.skew(X,dim),
-            scipy.stats.kurtosis(X,dim),
-            [X.shape[dim]]
-            ])
+    count, mean, std, skew, kurt = superPixelMoments( pixelFeatures, labs, N )
+    res = np.hstack( [ mean, std, skew, kurt, count.reshape((N,1)) ] )
   else:
     raise Exception('Invalid super-pixel feature aggregation type "%s"' % aggtype)
 
@@ -83,27 +73,91 @@ def aggregateFeaturesBySuperPixel( pixelFeatures, superPixelsObj, aggtype ):
   return res
 
 
+# Returns (count, mean, std, skew, kurt) of the pixel features in each super
+# pixel.  count has length N, the others are NxDp.  labs is the flattened label
+# image, values 0..N-1.
+#
+# The pixels are sorted by label once, then each statistic is a single
+# np.add.reduceat over the sorted rows.  Moments are central (mean first, then
+# powers of the deviations), as in scipy.stats, so that constant super-pixels
+# get exactly zero variance.  For those, and single-pixel super-pixels, skew is
+# 0 and kurtosis is -3, which is what scipy.stats.skew/kurtosis give.
+def superPixelMoments( pixelFeatures, labs, N ):
+  order = np.argsort( labs, kind='mergesort' )
+  count = np.bincount( labs, minlength=N )
+  assert np.all( count > 0 ), "Empty superpixel!"
+  starts = np.concatenate( [ [0], np.cumsum( count )[:-1] ] )
+  X = np.asarray( pixelFeatures[ order, : ], dtype=float )
+  n = count.astype(float).reshape((N,1))
+
+  mean = np.add.reduceat( X, starts, axis=0 ) / n
+  X -= np.repeat( mean, count, axis=0 )
+  X2 = X * X
+  m2 = np.add.reduceat( X2, starts, axis=0 ) / n
+  m3 = np.add.reduceat( X2 * X, starts, axis=0 ) / n
+  X2 *= X2
+  m4 = np.add.reduceat( X2, starts, axis=0 ) / n
+
+  zero = ( m2 == 0 )
+  with np.errstate( invalid='ignore', divide='ignore' ):
+    skew = np.where( zero, 0.0, m3 / m2**1.5 )
+    kurt = np.where( zero, 0.0, m4 / m2**2 ) - 3.0
+  return count, mean, np.sqrt(m2), skew, kurt
+
+# The original per-super-pixel implementation of the 'classic' aggregation.  Kept
+# as the reference for superPixelMoments.
+def aggregateFeaturesBySuperPixelLoop( pixelFeatures, superPixelsObj ):
+  dim = 0
+  Np, Dp = pixelFeatures.shape
+  N = superPixelsObj.getNumSuperPixels()
+  res = np.zeros( (N,4*Dp+1), dtype=float )
+  labs = superPixelsObj.getLabelImage().flatten()
+  # Visit each super pixel
+  for i in range(N):
+    X = pixelFeatures[labs==i,:]
+    assert X.shape[0] > 0, "Empty superpixel!"
+    with np.errstate( invalid='ignore' ):
+      res[i,:] = np.concatenate([
+          X.mean(dim),
+          X.std(dim),
+          scipy.stats.skew(X,dim),
+          scipy.stats.kurtosis(X,dim),
+          [X.shape[dim]]
+          ])
+  return res
+
+# Version of computeSuperPixelFeatures in arrayCache.  Bump it whenever the
+# pixel features or their aggregation change.
+spFeaturesCacheVersion = 1
+
+# rgbImage can also be a pomio.LabelledImage, whose image is read here.  Results
+# are kept in arrayCache, keyed by the image and super-pixel label contents and
+# the feature types.
 def computeSuperPixelFeatures( rgbImage, superPixelsObj, ftype, aggtype ):
-  pixelFeatures = computePixelFeatures( rgbImage, ftype )
-  spFeatures = aggregateFeaturesBySuperPixel(
-    pixelFeatures, superPixelsObj, aggtype
-    )
+  rgbImage = pomio.msrc_imageOf( rgbImage )
+  if arrayCache.enabled():
+    key = arrayCache.makeKey( spFeaturesCacheVersion, rgbImage, superPixelsObj.m_labels, ftype, aggtype )
+    cached = arrayCache.load( 'spfeatures', key )
+    if cached != None:
+      return cached['ftrs']
+  with profiling.timer( 'pixelFeatures' ):
+    pixelFeatures = computePixelFeatures( rgbImage, ftype )
+  with profiling.timer( 'aggregation' ):
+    spFeatures = aggregateFeaturesBySuperPixel(
+      pixelFeatures, superPixelsObj, aggtype
+      )
+  if arrayCache.enabled():
+    arrayCache.save( 'spfeatures', key, ftrs=spFeatures )
   return spFeatures
 
 def computeSuperPixelFeaturesMulti(
   images, superPixelObjs, ftype, aggtype, asMatrix, nbCores=1
   ):
   assert len(images) == len(superPixelObjs)
-  if nbCores>1:
-    job_server = mp.Pool(nbCores)
-    jres = [ job_server.apply_async( computeSuperPixelFeatures, \
-                                       ( img, spo, ftype, aggtype ) ) \
-               for img,spo in zip(images, superPixelObjs) ]
-    tOutSecs = 10*60 # 10 mins
-    res = [ jr.get(timeout=tOutSecs) for jr in jres ]
-  else:
-    res = [ computeSuperPixelFeatures( img, spo, ftype, aggtype ) for \
-              img,spo in zip(images, superPixelObjs) ]
+  # Runs in the shared workerPool if nbCores > 1.
+  res = workerPool.mapMulti( computeSuperPixelFeatures, \
+                               ( ( img, spo, ftype, aggtype ) \
+                                   for img,spo in zip(images, superPixelObjs) ), nbCores )
   if asMatrix:
     return np.vstack( res )
   else:
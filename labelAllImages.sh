@@ -3,11 +3,12 @@
 # Usage:
 #
 #    labelAllImages.sh <classifierFilename> <adjacencyStatsFilename> K 
-#                         <outDir> file1 file2 .... fileN
+#                         <outDir> <nbCores> file1 file2 .... fileN
 #
 # Applies superpixel classifier and MRF to each of the images and puts
 # the labelling result in the output dir.  Absolute path for outDir
-# recommended.
+# recommended.  The adjacency stats file can be made from the training
+# images with createAdjacencyStats.py.
 #
 # Example:
 #    ./labelAllImages \
@@ -15,18 +16,22 @@
 #           /vagrant/features/msrcTraining_slic-400-010.00_adj.pkl \
 #           0.1 \
 #           /vagrant/results/imagesLabelled  \
+#           4 \
 #           /vagrant/msrcData/training/Images/*.bmp
 #
 
 function Usage() {
     echo "Usage:"
-    echo "   ./labelAllImages.sh <classifierFilename> <adjacencyStatsFilename> K <outDir> file1 file2 .... fileN"
+    echo "   ./labelAllImages.sh <classifierFilename> <adjacencyStatsFilename> K <outDir> <nbCores> file1 file2 .... fileN"
 }
 
 clfrName="$1"; shift
 adjName="$1"; shift
 K="$1"; shift
 outDir="$1"; shift
+typeset -i nbCores="$1"; shift
+
+echo "Using $nbCores cores"
 
 if [ ! -d "$outDir" ]; then
     echo "Error: output directory $outDir does not exist."
@@ -42,33 +47,16 @@ fi
 
 echo "MRF Smoothness K = $K"
 
-# as we go, create a csv from labelled image to GT image
-csvFn="$outDir"/evalpairs.csv
-echo "" > "$csvFn"
-
 logFn="$outDir"/log.txt
-echo "" > "$logFn"
-
-for file in $*; do 
-    echo "Processing input image $file..."
-    echo "*" >> "$logFn"
-    echo "* Processing input image $file..." >> "$logFn"
-    echo "*" >> "$logFn"
-    
-    ifn=$(basename "$file")
-    extn="${ifn##*.}"
-    ifnBase="${ifn%.*}"
-    ofn="$outDir"/"$ifn"
-
-    ./sceneLabelSuperPixels.py "$file" \
-	--clfrFn="$clfrName" \
-	--adjFn="$adjName" \
-	--nbrPotentialMethod=adjacencyAndDegreeSensitive  \
-	--nbSuperPixels=400 --superPixelCompactness=10 --K=$K \
-	--outfile="$ofn"
 
-    # append to csv
-    echo "${ofn},${ifnBase}_GT.$extn" >> "$csvFn"
-done
+# One process for all the images, with nbCores workers: it loads the
+# classifier and adjacency stats once and writes evalpairs.csv and timing.csv
+# in the output dir.
+./labelImages.py \
+    --clfrFn="$clfrName" \
+    --adjFn="$adjName" \
+    --nbrPotentialMethod=adjacencyAndDegreeSensitive  \
+    --nbSuperPixels=400 --superPixelCompactness=10 --K=$K --nbCores $nbCores \
+    "$outDir" "$@" > "$logFn" 2>&1
 
 echo "All done"
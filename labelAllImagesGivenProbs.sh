@@ -34,39 +34,13 @@ fi
 
 echo "MRF Smoothness K = $K"
 
-# as we go, create a csv from labelled image to GT image
-csvFn="$outDir"/evalpairs.csv
-rm -f "$csvFn"
-
 logFn="$outDir"/log.txt
-rm -f "$logFn"
-typeset -i ctr=0
-
-for file in $*; do 
-    echo "Processing input probability pickle file $file..."
-    echo "*" >> "$logFn"
-    echo "* Processing input probability pickle file $file..." >> "$logFn"
-    echo "*" >> "$logFn"
-    
-    ifn=$(basename "$file")
-    extn="${ifn##*.}"
-    ifnBase="${ifn%.*}"
-    ofn="$outDir"/"$ifnBase".bmp
-
-    ./sceneLabelSuperPixels.py "$file" \
-	--nbrPotentialMethod=degreeSensitive  \
-	--K=$K \
-	--outfile="$ofn" >> "$logFn" 2>&1 &
-
-    # append to csv
-    echo "${ofn},${ifnBase}_GT.bmp" >> "$csvFn"
-
-    ctr=$(($ctr+1))
 
-    if [ $(($ctr % $nbCores)) = 0 ]; then
-	wait
-    fi
-done
+# One process for all the files, with nbCores workers.  It writes
+# evalpairs.csv and timing.csv in the output dir.
+./labelImages.py \
+    --nbrPotentialMethod=degreeSensitive  \
+    --K=$K --nbCores $nbCores \
+    "$outDir" "$@" > "$logFn" 2>&1
 
-wait
 echo "All done"
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+import argparse
+
+"""
+Command-line tool to do N-class super-pixel MRF segmentation of many images in
+one process.  Like sceneLabelSuperPixels.py on each image, but the classifier
+and adjacency probs are loaded once and shared by a pool of workers, each of
+which classifies and labels whole images.
+"""
+
+# Usage:
+#
+#   labelImages.py --clfrFn clfr.pkl --adjFn adj.pkl <outDir> image1 ... imageN
+#   labelImages.py <outDir> classified/*.pkl
+#
+# Inputs are images, or .pkl (superpixels, class probabilities) files from
+# classifyImages.py.  For each input xxx.ext, writes the labelling to outDir as
+# xxx.ext for images or xxx.bmp otherwise, a line of outDir/evalpairs.csv for
+# evalPredictions.py and a line of per-stage times to outDir/timing.csv.
+
+parser = argparse.ArgumentParser(description='Classify images and apply MRF at the superPixel level.')
+parser.add_argument('outDir', type=str, action='store', \
+                        help='directory for the output files')
+parser.add_argument('infiles', type=str, nargs='*', \
+                        help='filenames of input images, or pkl files of superpixels and class probabilities')
+parser.add_argument('--fileList', type=str, action='store', \
+                        help='file with the input filenames, one per line, or - for stdin')
+parser.add_argument('--clfrFn', type=str, action='store', \
+                        help='filename of pkl superPixel classifier file.  Needed for image inputs.')
+parser.add_argument('--adjFn', type=str, action='store', \
+                        help='filename of pkl superPixel class adjacency probability matrix file')
+parser.add_argument('--K', type=float, action='store', default=0.1, \
+                        help='Weighting for pairwise potential term in MRF.')
+parser.add_argument('--inferenceMethod', type=str, action='store', \
+                        choices=['abswap', 'aexpansion'], default='abswap',\
+                        help='Move-making algorithm for MRF inference.')
+parser.add_argument('--nbrPotentialMethod', type=str, action='store', \
+                        choices=['degreeSensitive', 'adjacencyAndDegreeSensitive'], default='degreeSensitive',\
+                        help='Neighbour potential method.  If adjacency is used, then --adjFn must be specified.')
+parser.add_argument('--nbSuperPixels', type=int, default=400, \
+                        help='Desired number of super pixels in SLIC over-segmentation')
+parser.add_argument('--superPixelCompactness', type=float, default=10.0, \
+                        help='Super pixel compactness parameter for SLIC')
+parser.add_argument('--nbCores', type=int, default=1, \
+                        help='Number of worker processes')
+args = parser.parse_args()
+
+import os
+import time
+import pomio
+import amntools
+import profiling
+import labelling
+
+assert os.path.isdir( args.outDir ), 'Output directory %s does not exist' % args.outDir
+if args.nbrPotentialMethod == 'adjacencyAndDegreeSensitive':
+    assert args.adjFn != None, 'You asked for neighbour potential method "%s", but no adjacency probs specified'\
+        % args.nbrPotentialMethod
+
+# Pairs of (input file, output label image file).
+def filenamePairs():
+    for infile in amntools.inputFilenames( args.infiles, args.fileList ):
+        ifnBase, extn = os.path.splitext( os.path.basename( infile ) )
+        if extn in [ '.pkl', '.mat' ]:
+            extn = '.bmp'
+        yield infile, os.path.join( args.outDir, ifnBase + extn )
+
+# The stage times for timing.csv come from profiling, which is turned on here
+# (without a file, unless AMN_PROFILE gives one) before the workers start.
+if not profiling.enabled():
+    profiling.enable()
+
+t0 = time.time()
+clfr = None
+if args.clfrFn:
+    print 'Loading classifier...'
+    clfr = pomio.unpickleObject( args.clfrFn )
+# Loaded before the workers start, so they share these rather than each
+# loading them.
+labelling.setClassifierAndAdjProbs( clfr, labelling.getAdjProbs( args.adjFn ) )
+
+evalPairs = open( os.path.join( args.outDir, 'evalpairs.csv' ), 'w' )
+timing = open( os.path.join( args.outDir, 'timing.csv' ), 'w' )
+stages = [ 'load', 'superPixels', 'features', 'classify', 'inference', 'write' ]
+timing.write( 'file,%s,total\n' % ','.join( stages ) )
+
+nbImages = 0
+results = labelling.labelImagesMulti( filenamePairs(), \
+                                        args.inferenceMethod, args.nbrPotentialMethod, args.K, \
+                                        args.nbSuperPixels, args.superPixelCompactness, \
+                                        nbCores=args.nbCores )
+for infile, outfile, times in results:
+    total = times.get( 'total', 0.0 )
+    print 'Labelled %s in %.2f s' % ( infile, total )
+    ifnBase, extn = os.path.splitext( os.path.basename( outfile ) )
+    evalPairs.write( '%s,%s_GT%s\n' % ( outfile, ifnBase, extn ) )
+    timing.write( '%s,%s,%f\n' % ( infile, ','.join( [ '%f' % times.get( s, 0.0 ) for s in stages ] ), total ) )
+    nbImages += 1
+evalPairs.close()
+timing.close()
+
+dt = time.time() - t0
+print 'Labelled %d images in %.1f s (%.2f images/s)' % ( nbImages, dt, nbImages/max(dt,1E-6) )
@@ -0,0 +1,93 @@
+"""
+Superpixel MRF labelling of one image, as done by sceneLabelSuperPixels.py, in
+a form that labelImages.py can run in the worker pool.
+"""
+import os
+import numpy as np
+import skimage
+import skimage.io
+import cython_uflow as uflow
+import amntools
+import pomio
+import superPixels
+import features
+import classification
+import isprs
+import workerPool
+import profiling
+
+# Loads the class adjacency counts from createAdjacencyStats.py as neighbour
+# potentials, or None if no name given.
+def getAdjProbs(name):
+    if name != None and len(name)>0:
+        print 'Loading adjacency probs...'
+        adjProbs = pomio.unpickleObject(name)
+        # This is actually a bunch of counts.  Some will be zero, which is probably
+        # a sampling error, so let's offset with some default number of counts.
+        adjProbs += 10.0
+        # Now turn it into normalised probabilities.
+        # todo: hey but this is not normalised for default class probability!
+        adjProbs /= adjProbs.sum()
+        # transform
+        adjProbs = -np.log( adjProbs )
+    else:
+        adjProbs = None
+    return adjProbs
+
+# Makes the classifier and adjacency potentials available to labelImage in the
+# workers.  Call before labelling, so that the workers are forked with them.
+def setClassifierAndAdjProbs( clfr, adjProbs ):
+    workerPool.setShared( 'classifier', clfr )
+    workerPool.setShared( 'adjProbs', adjProbs )
+
+# Labels infile and writes the label image to outfile.  infile is an image, or
+# a .pkl of (superpixels, class probabilities) from classifyImages.py, or an
+# ISPRS .mat result.  The classifier and adjacency potentials are those given
+# to setClassifierAndAdjProbs.  Returns (infile, outfile, times) where times
+# is profiling.lastItemTimes() for the image: the seconds spent in each stage,
+# if profiling is on.
+def labelImage( infile, outfile, inferenceMethod, nbrPotentialMethod, K, \
+                  nbSuperPixels, superPixelCompactness ):
+    with profiling.item( infile ):
+        colourMap = pomio.msrc_classToRGB
+        if infile.endswith('.pkl'):
+            with profiling.timer( 'load' ):
+                spix, classProbs = pomio.unpickleObject( infile )
+        elif infile.endswith('.mat'):
+            with profiling.timer( 'load' ):
+                spix, classProbs = isprs.loadISPRSResultFromMatlab( infile )
+            colourMap = isprs.colourMap
+        else:
+            clfr = workerPool.getShared( 'classifier' )
+            assert clfr != None, 'No classifier given for image %s' % infile
+            # Timed as 'load' by readImage.
+            imgRGB = amntools.readImage( infile )
+            with profiling.timer( 'superPixels' ):
+                spix = superPixels.computeSuperPixelGraph( imgRGB, 'slic', [nbSuperPixels,superPixelCompactness] )
+            with profiling.timer( 'features' ):
+                ftrs = features.computeSuperPixelFeatures( imgRGB, spix, ftype='classic', aggtype='classic' )
+            with profiling.timer( 'classify' ):
+                classProbs = classification.classProbsOfFeatures( ftrs, clfr )
+
+        # Timed as 'inference'.
+        segResult = profiling.inference( uflow.inferenceSuperPixel, \
+            spix,\
+            -np.log( np.maximum(1E-10, np.ascontiguousarray(classProbs) ) ), \
+            workerPool.getShared( 'adjProbs' ), \
+            inferenceMethod,\
+            nbrPotentialMethod,\
+            K, verbose=False )
+
+        with profiling.timer( 'write' ):
+            skimage.io.imsave( outfile, pomio.msrc_convertLabelsToRGB( segResult, colourMap ) )
+    return infile, outfile, profiling.lastItemTimes()
+
+# Yields labelImage for each pair of (infile, outfile), in the order they
+# finish, using the shared workerPool if nbCores > 1.
+def labelImagesMulti( fnPairs, inferenceMethod, nbrPotentialMethod, K, \
+                        nbSuperPixels, superPixelCompactness, nbCores=1 ):
+    return workerPool.imapMulti( labelImage, \
+                                   ( ( infile, outfile, inferenceMethod, nbrPotentialMethod, K, \
+                                         nbSuperPixels, superPixelCompactness ) \
+                                       for infile, outfile in fnPairs ), \
+                                   nbCores, ordered=False )
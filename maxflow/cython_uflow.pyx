@@ -13,6 +13,10 @@ import cython
 #
 #   > cd maxflow
 #   > python setup.py build_ext --inplace
+#
+# The non-callback inference functions release the GIL while the C++ code
+# runs, so python threads can label several images at once (see
+# inferenceNBatch).  The callback ones can't, as the callback is python.
 
 
 
@@ -28,6 +32,14 @@ cdef extern from "uflow.hpp": # essential!
         void*   cbdata
         )
         
+cdef extern from "uflow.hpp": # essential!
+    ctypedef struct UflowStats:
+        int    nbIterations
+        int    nbCuts
+        double energy
+        double flowSeconds
+        double energySeconds
+
 cdef extern from "uflow.hpp": # essential!
     extern double ultraflow_inference2(
       int             nhoodSize,
@@ -69,8 +81,112 @@ cdef extern from "uflow.hpp": # essential!
       double*         cMatLabelWeights,
       char*           nbrPotentialMethod, 
       double*         nbrPotentialParams,
-      np.int32_t*     cMatOut
-    )
+      np.int32_t*     cMatOut,
+      UflowStats*     stats,
+      bint            verbose
+    ) nogil except +
+
+cdef extern from "uflow.hpp": # essential!
+    extern void ultraflow_inferenceN(
+      char*           method,
+      int             nhoodSize,
+      int             rows,
+      int             cols,
+      int             nbImgChannels,
+      int             nbLabels,
+      float*          cMatInputImage,
+      float*          cMatLabelWeights,
+      char*           nbrPotentialMethod, 
+      double*         nbrPotentialParams,
+      np.int32_t*     cMatOut,
+      UflowStats*     stats,
+      bint            verbose
+    ) nogil except +
+
+cdef extern from "uflow.hpp": # essential!
+    extern void ultraflow_inferenceN(
+      char*           method,
+      int             nhoodSize,
+      int             rows,
+      int             cols,
+      int             nbImgChannels,
+      int             nbLabels,
+      float*          cMatInputImage,
+      np.int16_t*     cMatLabelWeights,
+      double          weightScale,
+      char*           nbrPotentialMethod, 
+      double*         nbrPotentialParams,
+      np.int32_t*     cMatOut,
+      UflowStats*     stats,
+      bint            verbose
+    ) nogil except +
+
+cdef extern from "uflow.hpp": # essential!
+    extern void ultraflow_inferenceNTiled(
+      char*           method,
+      int             nhoodSize,
+      int             rows,
+      int             cols,
+      int             nbImgChannels,
+      int             nbLabels,
+      double*         cMatInputImage,
+      double*         cMatLabelWeights,
+      char*           nbrPotentialMethod, 
+      double*         nbrPotentialParams,
+      int             tileSize,
+      int             tileOverlap,
+      int             nbThreads,
+      int             maxPasses,
+      np.int32_t*     cMatOut,
+      UflowStats*     stats,
+      bint            verbose
+    ) nogil except +
+
+cdef extern from "uflow.hpp": # essential!
+    extern void ultraflow_inferenceNTiled(
+      char*           method,
+      int             nhoodSize,
+      int             rows,
+      int             cols,
+      int             nbImgChannels,
+      int             nbLabels,
+      float*          cMatInputImage,
+      float*          cMatLabelWeights,
+      char*           nbrPotentialMethod, 
+      double*         nbrPotentialParams,
+      int             tileSize,
+      int             tileOverlap,
+      int             nbThreads,
+      int             maxPasses,
+      np.int32_t*     cMatOut,
+      UflowStats*     stats,
+      bint            verbose
+    ) nogil except +
+
+cdef extern from "uflow.hpp": # essential!
+    extern void ultraflow_inferenceNTiled(
+      char*           method,
+      int             nhoodSize,
+      int             rows,
+      int             cols,
+      int             nbImgChannels,
+      int             nbLabels,
+      float*          cMatInputImage,
+      np.int16_t*     cMatLabelWeights,
+      double          weightScale,
+      char*           nbrPotentialMethod, 
+      double*         nbrPotentialParams,
+      int             tileSize,
+      int             tileOverlap,
+      int             nbThreads,
+      int             maxPasses,
+      np.int32_t*     cMatOut,
+      UflowStats*     stats,
+      bint            verbose
+    ) nogil except +
+
+cdef extern from "uflow.hpp": # essential!
+    extern void ultraflow_setCheckEnergy( bint check )
 
 cdef extern from "uflow.hpp": # essential!
     extern void ultraflow_inferenceSuperPixel(
@@ -83,8 +199,10 @@ cdef extern from "uflow.hpp": # essential!
       double*         cMatAdjProbs, # can be null
       char*           nbrPotentialMethod, 
       double          K,
-      np.int32_t*     cMatOut
-    )
+      np.int32_t*     cMatOut,
+      UflowStats*     stats,
+      bint            verbose
+    ) nogil except +
 
 
 #  cdef void ultraflow_inference2( 
@@ -139,20 +257,57 @@ def inference2( np.ndarray[double, ndim=3, mode="c"] inputImage not None,
 
 
 
-# 'method' can be aexpansion or abswap
-def inferenceN( np.ndarray[double, ndim=3, mode="c"] inputImage not None,
-                np.ndarray[double, ndim=3, mode="c"] labelWeights not None,
+# Debugging: if check is True, inferenceN and inferenceSuperPixel compare
+# their incrementally tracked energy against a full recompute after every
+# move, and raise an exception if they differ.  Slow.
+def setCheckEnergy( check ):
+    ultraflow_setCheckEnergy( check )
+
+cdef statsToDict( UflowStats stats ):
+    return { 'nbIterations'  : stats.nbIterations,
+             'nbCuts'        : stats.nbCuts,
+             'energy'        : stats.energy,
+             'flowSeconds'   : stats.flowSeconds,
+             'energySeconds' : stats.energySeconds }
+
+# 'method' can be aexpansion or abswap.  If returnStats is True, returns
+# (labels, stats) where stats is a dict of nbIterations, nbCuts, the energy
+# of the final labelling, and flowSeconds and energySeconds, the time spent in
+# max-flow moves and evaluating their energies.
+#
+# For large images, tileSize > 0 splits the image into tiles solved by
+# nbThreads threads, each over a window tileOverlap pixels bigger on each side.
+# Borders are then reconciled by up to maxTilePasses passes that fix the
+# labels outside each window.  nbIterations then counts passes.
+#
+# verbose=False turns off the progress output.
+# labelWeights can be float64, float32 or int16.  int16 weights are
+# round( weightScale * potential ), so weightScale must be given; the nbr
+# potentials are scaled to match, and the energy in the stats is unscaled.  For
+# float32 and int16 weights the input image is used as float32.
+def inferenceN( inputImage not None,
+                np.ndarray labelWeights not None,
                 method,
                 int nhoodSize,
                 nbrPotentialMethod,
-                np.ndarray[double, ndim=1, mode="c"] nbrPotentialParams not None ):
+                np.ndarray[double, ndim=1, mode="c"] nbrPotentialParams not None,
+                returnStats=False,
+                int tileSize=0,
+                int tileOverlap=16,
+                int nbThreads=1,
+                int maxTilePasses=4,
+                verbose=True,
+                weightScale=None ):
+    assert labelWeights.ndim == 3
     rows = labelWeights.shape[0]
     cols = labelWeights.shape[1]
 
     assert( method == 'abswap' or method == 'aexpansion' )
     assert( nhoodSize == 4 or nhoodSize == 8 )
-    print 'Input image has shape %s, should be (%d,%d,3)' \
-        % (str(np.shape(inputImage)),rows,cols)
+    assert nbrPotentialMethod in [ 'contrastSensitive', 'edge' ]
+    if verbose:
+        print 'Input image has shape %s, should be (%d,%d,3)' \
+            % (str(np.shape(inputImage)),rows,cols)
     assert inputImage.ndim == 3 and inputImage.shape[0] == rows and \
         inputImage.shape[1] == cols
 
@@ -166,18 +321,127 @@ def inferenceN( np.ndarray[double, ndim=3, mode="c"] inputImage not None,
 
     imgChannels = inputImage.shape[2]
 
+    if tileSize > 0:
+        assert nbThreads > 0 and tileOverlap >= 0 and maxTilePasses > 0
+
+    cdef np.ndarray[double, ndim=3, mode="c"] dInputImage = None
+    cdef np.ndarray[double, ndim=3, mode="c"] dLabelWeights = None
+    cdef np.ndarray[float, ndim=3, mode="c"] fInputImage = None
+    cdef np.ndarray[float, ndim=3, mode="c"] fLabelWeights = None
+    cdef np.ndarray[np.int16_t, ndim=3, mode="c"] iLabelWeights = None
+    cdef double cWeightScale = 1.0
+    if labelWeights.dtype == np.float64:
+        assert weightScale is None, 'weightScale is only for int16 labelWeights'
+        dInputImage = inputImage
+        dLabelWeights = labelWeights
+    elif labelWeights.dtype == np.float32:
+        assert weightScale is None, 'weightScale is only for int16 labelWeights'
+        fInputImage = np.ascontiguousarray( inputImage, dtype=np.float32 )
+        fLabelWeights = labelWeights
+    elif labelWeights.dtype == np.int16:
+        assert weightScale is not None and weightScale > 0, \
+            'int16 labelWeights need weightScale > 0'
+        cWeightScale = weightScale
+        fInputImage = np.ascontiguousarray( inputImage, dtype=np.float32 )
+        iLabelWeights = labelWeights
+    else:
+        raise ValueError( 'labelWeights must be float64, float32 or int16, not %s' \
+                              % labelWeights.dtype )
+
     #  create output label array
     cdef np.ndarray[np.int32_t, ndim=2, mode="c"] labelResult = \
         np.zeros( (rows,cols), dtype=np.int32 )
+    cdef UflowStats stats
+
+    # Everything the C++ code needs, so it can run without the GIL.
+    cdef char* cMethod = method
+    cdef char* cNbrPotentialMethod = nbrPotentialMethod
+    cdef int cRows = rows, cCols = cols, cImgChannels = imgChannels
+    cdef int cNbLabels = nbLabels
+    cdef double* cInputImage = NULL
+    cdef double* cLabelWeights = NULL
+    cdef float* cFloatInputImage = NULL
+    cdef float* cFloatLabelWeights = NULL
+    cdef np.int16_t* cInt16LabelWeights = NULL
+    if dLabelWeights is not None:
+        cInputImage = &dInputImage[0,0,0]
+        cLabelWeights = &dLabelWeights[0,0,0]
+    else:
+        cFloatInputImage = &fInputImage[0,0,0]
+        if fLabelWeights is not None:
+            cFloatLabelWeights = &fLabelWeights[0,0,0]
+        else:
+            cInt16LabelWeights = &iLabelWeights[0,0,0]
+    cdef double* cNbrPotentialParams = &nbrPotentialParams[0]
+    cdef np.int32_t* cLabelResult = &labelResult[0,0]
+    cdef bint cVerbose = verbose
 
     # Call C++ inference function
-    ultraflow_inferenceN( method, nhoodSize, rows, cols, imgChannels, nbLabels,
-                          &inputImage[0,0,0], 
-                          &labelWeights[0,0,0], 
-                          nbrPotentialMethod, 
-                          &nbrPotentialParams[0],
-                          &labelResult[0,0] )
-
+    with nogil:
+        if tileSize > 0:
+            if cLabelWeights != NULL:
+                ultraflow_inferenceNTiled( cMethod, nhoodSize, cRows, cCols, cImgChannels, cNbLabels,
+                                           cInputImage,
+                                           cLabelWeights,
+                                           cNbrPotentialMethod,
+                                           cNbrPotentialParams,
+                                           tileSize, tileOverlap, nbThreads, maxTilePasses,
+                                           cLabelResult,
+                                           &stats,
+                                           cVerbose )
+            elif cFloatLabelWeights != NULL:
+                ultraflow_inferenceNTiled( cMethod, nhoodSize, cRows, cCols, cImgChannels, cNbLabels,
+                                           cFloatInputImage,
+                                           cFloatLabelWeights,
+                                           cNbrPotentialMethod,
+                                           cNbrPotentialParams,
+                                           tileSize, tileOverlap, nbThreads, maxTilePasses,
+                                           cLabelResult,
+                                           &stats,
+                                           cVerbose )
+            else:
+                ultraflow_inferenceNTiled( cMethod, nhoodSize, cRows, cCols, cImgChannels, cNbLabels,
+                                           cFloatInputImage,
+                                           cInt16LabelWeights,
+                                           cWeightScale,
+                                           cNbrPotentialMethod,
+                                           cNbrPotentialParams,
+                                           tileSize, tileOverlap, nbThreads, maxTilePasses,
+                                           cLabelResult,
+                                           &stats,
+                                           cVerbose )
+        else:
+            if cLabelWeights != NULL:
+                ultraflow_inferenceN( cMethod, nhoodSize, cRows, cCols, cImgChannels, cNbLabels,
+                                      cInputImage,
+                                      cLabelWeights,
+                                      cNbrPotentialMethod,
+                                      cNbrPotentialParams,
+                                      cLabelResult,
+                                      &stats,
+                                      cVerbose )
+            elif cFloatLabelWeights != NULL:
+                ultraflow_inferenceN( cMethod, nhoodSize, cRows, cCols, cImgChannels, cNbLabels,
+                                      cFloatInputImage,
+                                      cFloatLabelWeights,
+                                      cNbrPotentialMethod,
+                                      cNbrPotentialParams,
+                                      cLabelResult,
+                                      &stats,
+                                      cVerbose )
+            else:
+                ultraflow_inferenceN( cMethod, nhoodSize, cRows, cCols, cImgChannels, cNbLabels,
+                                      cFloatInputImage,
+                                      cInt16LabelWeights,
+                                      cWeightScale,
+                                      cNbrPotentialMethod,
+                                      cNbrPotentialParams,
+                                      cLabelResult,
+                                      &stats,
+                                      cVerbose )
+
+    if returnStats:
+        return labelResult, statsToDict( stats )
     return labelResult
 
 # 'method' can be aexpansion or abswap
@@ -222,14 +486,16 @@ def inferenceNCallback( np.ndarray[double, ndim=3, mode="c"] inputImage not None
 
 
 
-# 'method' can be aexpansion or abswap
+# 'method' can be aexpansion or abswap.  returnStats as for inferenceN.
 def inferenceSuperPixel(\
     superPixelGraph,
     np.ndarray[double, ndim=2, mode="c"] labelWeights not None,
     np.ndarray[double, ndim=2, mode="c"] adjProbs, # can be None
     method,
     nbrPotentialMethod,
-    K ):
+    K,
+    returnStats=False,
+    verbose=True ):
     #    np.ndarray[double, ndim=1, mode="c"] nbrPotentialParams not None ):
 
     N = superPixelGraph.getNumSuperPixels()
@@ -238,21 +504,23 @@ def inferenceSuperPixel(\
 
     nbLabels = labelWeights.shape[1]
     assert( nbLabels > 1, "Only 1 label class?" );
+    assert nbrPotentialMethod in [ 'degreeSensitive', 'adjacencyAndDegreeSensitive' ]
+    if nbrPotentialMethod == 'adjacencyAndDegreeSensitive':
+        assert adjProbs is not None, 'adjacency potentials need adjProbs'
+    if adjProbs is not None:
+        assert adjProbs.shape[0] == nbLabels and adjProbs.shape[1] == nbLabels
 
     # make sure contiguous
     assert labelWeights.flags['C_CONTIGUOUS']
     #assert nbrPotentialParams.flags['C_CONTIGUOUS']
 
-    # turn edge array into an Nx2 matrix
-    # cython no like
+    # The edges are already an Ex2 int32 matrix; this only copies for graphs
+    # pickled with a list of edges.
     cdef np.ndarray[np.int32_t, ndim=2, mode="c"] edgeMat = \
-        np.vstack( superPixelGraph.m_edges ).astype(np.int32)
-    #     cdef np.ndarray[np.int32_t, ndim=2, mode="c"] edgeMat
-    #     for i,e in enumerate(superPixelGraph.m_edges):
-    #         edgeMat[i,0] = e[0]
-    #         edgeMat[i,1] = e[1]
-    print type(edgeMat)
-    print edgeMat
+        np.ascontiguousarray( superPixelGraph.m_edges, dtype=np.int32 ).reshape( (-1,2) )
+    if verbose:
+        print type(edgeMat)
+        print edgeMat
     assert edgeMat.shape[1] == 2 
 
     # create output label array of length nbSuperPixels
@@ -261,27 +529,80 @@ def inferenceSuperPixel(\
 
     # Call C++ inference function.  This will get us a label per superpixel.
     cdef double* adjProbsRef
-    if adjProbs == None:
+    cdef UflowStats stats
+    if adjProbs is None:
         adjProbsRef = NULL
     else:
         adjProbsRef = &adjProbs[0,0]
 
-    ultraflow_inferenceSuperPixel(
-        method,
-        N,
-        nbLabels,
-        len( superPixelGraph.m_edges ), 
-        &edgeMat[0,0],
-        &labelWeights[0,0], 
-        adjProbsRef,
-        nbrPotentialMethod, 
-        K,
-        &labelResult[0] 
-      )
-        #&nbrPotentialParams[0],
+    # Everything the C++ code needs, so it can run without the GIL.
+    cdef char* cMethod = method
+    cdef char* cNbrPotentialMethod = nbrPotentialMethod
+    cdef int cN = N, cNbLabels = nbLabels, cNbEdges = edgeMat.shape[0]
+    cdef double cK = K
+    cdef np.int32_t* cEdges = &edgeMat[0,0]
+    cdef double* cLabelWeights = &labelWeights[0,0]
+    cdef np.int32_t* cLabelResult = &labelResult[0]
+    cdef bint cVerbose = verbose
+
+    with nogil:
+        ultraflow_inferenceSuperPixel(
+            cMethod,
+            cN,
+            cNbLabels,
+            cNbEdges,
+            cEdges,
+            cLabelWeights,
+            adjProbsRef,
+            cNbrPotentialMethod,
+            cK,
+            cLabelResult,
+            &stats,
+            cVerbose
+          )
+            #&nbrPotentialParams[0],
 
     # turn labels to image array
 #    print 'LabelResult has shape ', np.shape(labelResult), ' and is ', \
 #        labelResult
-    return superPixelGraph.imageFromSuperPixelData( \
+    labelImage = superPixelGraph.imageFromSuperPixelData( \
         np.reshape(labelResult, (len(labelResult),1) ) )
+    if returnStats:
+        return labelImage, statsToDict( stats )
+    return labelImage
+
+
+# The arguments of inferenceN in order, for the tuple problems of
+# inferenceNBatch.
+_inferenceNArgNames = [ 'inputImage', 'labelWeights', 'method', 'nhoodSize', \
+                          'nbrPotentialMethod', 'nbrPotentialParams', 'returnStats', \
+                          'tileSize', 'tileOverlap', 'nbThreads', 'maxTilePasses', \
+                          'verbose', 'weightScale' ]
+
+# Labels several images at once with a pool of nbThreads python threads.  Each
+# problem is a tuple or dict of the arguments to inferenceN.  inferenceN runs
+# without the GIL, so the problems really are solved in parallel.  It does not
+# copy float64 or float32 unaries or a float64 image, but with float32 or int16
+# unaries the image is converted to float32 unless it already is, so give it
+# as float32 then.  Returns a list of results in the same order as the
+# problems.  Progress output is off unless the problems ask for it.
+def inferenceNBatch( problems, nbThreads ):
+    from multiprocessing.pool import ThreadPool
+
+    def solve( problem ):
+        if isinstance( problem, dict ):
+            kwargs = dict( problem )
+        else:
+            assert len( problem ) <= len( _inferenceNArgNames ), \
+                'Too many arguments for inferenceN'
+            kwargs = dict( zip( _inferenceNArgNames, problem ) )
+        kwargs.setdefault( 'verbose', False )
+        return inferenceN( **kwargs )
+
+    assert nbThreads > 0
+    pool = ThreadPool( nbThreads )
+    try:
+        return pool.map( solve, problems, chunksize=1 )
+    finally:
+        pool.close()
+        pool.join()
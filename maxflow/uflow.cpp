@@ -8,6 +8,9 @@
 #include <boost/scoped_array.hpp>
 #include <cmath>
 #include <vector>
+#include <sstream>
+#include <pthread.h>
+#include <time.h>
 
 #include "graph.h"
 
@@ -17,10 +20,68 @@
 // todo: nclass need to make edge callback return 0 for non a-b edges
 //   Need to explicitly compute energy for whole graph.
 
+// Wall clock time in seconds, for the times in UflowStats.  Only read when
+// there are stats to fill in.
+static inline double statsTime( const UflowStats* stats )
+{
+  if ( !stats ) return 0.0;
+  timespec ts;
+  clock_gettime( CLOCK_MONOTONIC, &ts );
+  return ts.tv_sec + 1E-9 * ts.tv_nsec;
+}
+
+// Counts a max-flow move started at statsTime() t0.
+static inline void countCut( UflowStats* stats, double t0 )
+{
+  if ( !stats ) return;
+  ++stats->nbCuts;
+  stats->flowSeconds += statsTime( stats ) - t0;
+}
+
+static inline void countEnergyTime( UflowStats* stats, double t0 )
+{
+  if ( stats ) stats->energySeconds += statsTime( stats ) - t0;
+}
+
 // Type used in computations.
 typedef double DType;
 typedef Graph<DType,DType,DType> GraphType;
 
+// The N-label pixel solvers also take float32 or scaled int16 unaries.  The
+// max-flow graph then has capacities of the matching type: float, or int for
+// int16 so that sums of weights don't overflow.
+template < typename WEIGHT_TYPE > struct UflowTypes;
+
+template <> struct UflowTypes< double > {
+  typedef double                          CapType;
+  typedef Graph< double, double, double > GraphType;
+};
+
+template <> struct UflowTypes< float > {
+  typedef float                        CapType;
+  typedef Graph< float, float, float > GraphType;
+};
+
+template <> struct UflowTypes< int > {
+  typedef int                          CapType;
+  typedef Graph< int, int, long long > GraphType;
+};
+
+template <> struct UflowTypes< int16_t > : public UflowTypes< int > {};
+
+// Converts a (scaled) nbr potential to a capacity, rounding for integers.
+template < typename CAP_TYPE >
+inline CAP_TYPE toCapacity( double x )
+{
+  return static_cast< CAP_TYPE >( x );
+}
+
+template <>
+inline int toCapacity< int >( double x )
+{
+  return static_cast< int >( std::floor( x + 0.5 ) );
+}
+
 const int s_nhood4[][2] = { // r, c
   {0,1}, // h-edge to right
   {1,0}  // v-edge to bottom
@@ -33,6 +94,29 @@ const int s_nhood8[][2] = { // r, c
   {1,-1},// d-edge bottom-left
 };
 
+// Progress messages from the N-label solvers.  These can be turned off, for
+// example when several solvers run at once in worker threads.
+class UflowLog {
+  public:
+    UflowLog( bool on ) : m_on( on ) {}
+
+    template < typename T >
+    UflowLog& operator<<( const T& x )
+    {
+      if ( m_on ) std::cout << x;
+      return *this;
+    }
+
+    UflowLog& operator<<( std::ios_base& (*manip)( std::ios_base& ) )
+    {
+      if ( m_on ) std::cout << manip;
+      return *this;
+    }
+
+  private:
+    const bool m_on;
+};
+
 ////////////////////////////////////////////////////////////////////////////////
 // Inline Functors for Neighbour Potentials
 ////////////////////////////////////////////////////////////////////////////////
@@ -167,6 +251,118 @@ class NbrPotentialFunctorAdjacencyAndDegreeSensitive {
     const double m_K;
 };
 
+////////////////////////////////////////////////////////////////////////////////
+// Binary move energy terms.  In a move, node i takes t_i=0 if it ends up in the
+// SOURCE segment and t_i=1 in the SINK segment.
+////////////////////////////////////////////////////////////////////////////////
+
+// Adds E(t_i) = { E0, E1 }.
+template < typename GRAPH_TYPE, typename T >
+inline void addMoveUnary( GRAPH_TYPE& g, int i, T E0, T E1 )
+{
+  // Ending up in the sink cuts the source edge, and vice-versa.
+  g.add_tweights( i, E1, E0 );
+}
+
+// Adds E(t_i,t_j) = { A=E(0,0), B=E(0,1), C=E(1,0), D=E(1,1) }, using the
+// decomposition
+//
+//    E = A + (C-A) t_i + (D-C) t_j + (B+C-A-D) (1-t_i) t_j
+//
+// from Kolmogorov & Zabih.  The term must be submodular, B+C >= A+D.  If it is
+// not then it is truncated by lowering B (Rother et al. 2005), so the move is
+// only approximately optimal.  Callers check the true energy before accepting a
+// move anyway.
+template < typename GRAPH_TYPE, typename T >
+inline void addMovePairwise(
+  GRAPH_TYPE& g, int i, int j, T A, T B, T C, T D
+)
+{
+  T BCAD = B + C - A - D;
+  if ( BCAD < 0 )
+  {
+    BCAD = 0;
+  }
+  // (C-A) t_i
+  if ( C > A ) g.add_tweights( i, C-A, 0 ); else g.add_tweights( i, 0, A-C );
+  // (D-C) t_j
+  if ( D > C ) g.add_tweights( j, D-C, 0 ); else g.add_tweights( j, 0, C-D );
+  // Paid when i is in the source and j in the sink, ie cut edge i->j.
+  if ( BCAD > 0 )
+  {
+    g.add_edge( i, j, BCAD, 0 );
+  }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// Neighbour edges of the pixel grid and their weights.  For the pixel functors
+// the weights depend only on the image, not the labelling, so the move-making
+// algorithms compute them once per image, as capacities of type CAP_TYPE.
+template < typename CAP_TYPE >
+struct PixelNbrEdges
+{
+  std::vector< int >      m_i;
+  std::vector< int >      m_j;
+  std::vector< CAP_TYPE > m_wt;
+
+  int size() const { return (int)m_wt.size(); }
+};
+
+// weightScale multiplies the nbr potentials, to match scaled integer unaries.
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename CAP_TYPE >
+static void computePixelNbrEdges(
+  int                        nhoodSize,
+  int                        rows,
+  int                        cols,
+  int                        nbImgChannels,
+  const IMG_TYPE*            cMatInputImage,
+  FUNCTOR_TYPE&              functor,
+  double                     weightScale,
+  PixelNbrEdges< CAP_TYPE >& edges
+)
+{
+  assert( nhoodSize == 4 || nhoodSize == 8 );
+  const int (*nhood)[2] = ( nhoodSize == 4 ) ? s_nhood4 : s_nhood8;
+  const int nhoodLen    = ( nhoodSize == 4 ) ? 2        : 4;
+  const int nbNEdges = ( nhoodSize==4 ) ? (rows-1)*cols + (cols-1)*rows 
+    : (rows-1)*cols + (cols-1)*rows + 2*(rows-1)*(cols-1);
+
+  edges.m_i.clear();
+  edges.m_j.clear();
+  edges.m_wt.clear();
+  edges.m_i.reserve( nbNEdges );
+  edges.m_j.reserve( nbNEdges );
+  edges.m_wt.reserve( nbNEdges );
+
+  int idx = 0;
+  for ( int r=0; r<rows; ++r ){
+    for ( int c=0; c<cols; ++c, ++idx ){
+      const IMG_TYPE* pix = cMatInputImage + idx*nbImgChannels;
+      for ( int j=0; j<nhoodLen; ++j ){
+        const int nr = r + nhood[j][0];
+        const int nc = c + nhood[j][1];
+        if ( 0 <= nr && nr < rows && 0 <= nc && nc < cols )
+        {
+          const int nidx = nr*cols + nc;
+          const IMG_TYPE* nbr = cMatInputImage + nidx*nbImgChannels;
+          edges.m_i.push_back( idx );
+          edges.m_j.push_back( nidx );
+          edges.m_wt.push_back(
+            toCapacity< CAP_TYPE >(
+              weightScale * functor(
+                pix[0], pix[1], pix[2],
+                nbr[0], nbr[1], nbr[2],
+                r,c, nr,nc
+              )
+            )
+          );
+        }
+      }// for j
+    }// for c
+  }// for r
+  assert( edges.size() == nbNEdges );
+}
+
 ////////////////////////////////////////////////////////////////////////////////
 template < typename FUNCTOR_TYPE >
 static double inference2FunctorBased(
@@ -315,92 +511,6 @@ void computeSuperPixelDegree(
   // }
 }
 
-////////////////////////////////////////////////////////////////////////////////
-template < typename FUNCTOR_TYPE >
-static double inference2SuperPixelFunctorBased(
-  int             nbSuperPixels,
-  int             nbEdges,
-  int32_t*        cMatEdges,
-  double*         cMatSourceEdge,
-  double*         cMatSinkEdge,
-  FUNCTOR_TYPE&   functor,
-  int32_t*        cMatOut,
-  bool*           validMask,
-  int             srcClass,  // todo: hope I got this order right! doesn't matter.
-  int             snkClass
-)
-{
-  std::cout << "Inference superpixel 2-label:\n";
-
-  // inference time  // The length nbSuperPixels array validMask indicates whether each pixel is a
-  // valid part of the optimisation.  For example in ab-swaps non-ab pixels are
-  // not part of it so have different nbr weights.  If the array is null then
-  // not used at all.
-  const bool dbg = false;
-  const int n = nbSuperPixels;
-  std::vector< int > spDegree( n );
-
-  computeSuperPixelDegree( n, nbEdges, cMatEdges, spDegree );
-
-  std::auto_ptr< GraphType > g(
-    new GraphType(
-      n,        /*estimated # of nodes*/
-      nbEdges   /*estimated # of edges not inc src/snk*/
-    )
-  );
-
-  int firstNode = g->add_node( n );
-  assert( firstNode == 0 );
-
-  // Add source and sink edge weights from given matrices.
-  for ( int i=0; i<n; ++i ) {
-    // std::cout << "sp " << i << ", adding src wt = " << cMatSourceEdge[i] 
-    //           << ", snk wt = " <<  cMatSinkEdge[i] << "\n";
-    g->add_tweights( i, cMatSourceEdge[i], cMatSinkEdge[i] );
-  }
-
-  // Now add the neighbour edges.
-  for ( int i=0; i<nbEdges; ++i ){
-    const int idx  = cMatEdges[2*i+0];
-    const int nidx = cMatEdges[2*i+1];
-    const bool validSP    = validMask==NULL || validMask[idx];
-    const bool nbrValidSP = validMask==NULL || validMask[nidx];
-    double wt;
-
-    if ( validSP && nbrValidSP )
-    {
-      // todo: this is a bit shonky.  There is some adjacency probability for a
-      // class to itself.  However in this case the weight will be zero.  Maybe
-      // normalise probs relative to this prob, but how for difft classes?
-      wt = functor( spDegree[idx], spDegree[nidx], srcClass, snkClass );
-    }
-    else
-    {
-      wt = 0.0;
-    }
-    // std::cout << "  edge (" << idx << "," << nidx << "), v=" << validSP
-    //           << ", nv = " << nbrValidSP << ", wt = " << wt << "\n";
-    g->add_edge( idx, nidx, wt, wt );
-  }
-
-  // inference time
-  double flow = g->maxflow();
-
-  if (dbg)
-  {
-    std::cout << "Flow = " << flow << std::endl;
-  }
-
-  // Store min cut labels in output array.
-  for ( int i=0; i<n; ++i )
-  {
-    cMatOut[i] = g->what_segment( i );
-  }
-
-  return flow;
-}
-
-
 ////////////////////////////////////////////////////////////////////////////////
 double ultraflow_inference2(
   int             nhoodSize,
@@ -432,19 +542,24 @@ double ultraflow_inference2(
 }
 
 ////////////////////////////////////////////////////////////////////////////////
-template < typename FUNCTOR_TYPE >
+// The nbr potentials are scaled by weightScale and converted to capacities as
+// for the solvers, so the result is comparable with their energies.
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename WEIGHT_TYPE >
 double energyOfLabellingN(
-  int             nhoodSize,
-  int             rows,
-  int             cols,
-  int             nbImgChannels,
-  int             nbLabels,
-  double*         cMatInputImage,
-  double*         cMatLabelWeights,
-  FUNCTOR_TYPE&   functor,
-  int32_t*        cMatLabels
+  int                 nhoodSize,
+  int                 rows,
+  int                 cols,
+  int                 nbImgChannels,
+  int                 nbLabels,
+  const IMG_TYPE*     cMatInputImage,
+  const WEIGHT_TYPE*  cMatLabelWeights,
+  FUNCTOR_TYPE&       functor,
+  double              weightScale,
+  const int32_t*      cMatLabels
 )
 {
+  typedef typename UflowTypes< WEIGHT_TYPE >::CapType CapType;
+
   // Wot we got comin in:
   //
   //   cMatLabelWeights: -log P(x), that is they are potentials.
@@ -460,8 +575,6 @@ double energyOfLabellingN(
     assert( 0 <= cMatLabels[i] && cMatLabels[i] < nbLabels );
     res += cMatLabelWeights[ i*nbLabels + cMatLabels[i] ];
   }
-  std::cout << "dbg: just unary = " << std::fixed << res << "\n";
-  const double un = res;
 
   // Nbr Edge potentials:
   // Only sum each edge once.
@@ -480,13 +593,13 @@ double energyOfLabellingN(
         // vertical edge down from here
         if ( lbl != cMatLabels[idx+cols] )
         {
-          res += functor(
+          res += toCapacity< CapType >( weightScale * functor(
             pixR, pixG, pixB,
             cMatInputImage[(idx+cols)*nbImgChannels+0],
             cMatInputImage[(idx+cols)*nbImgChannels+1],
             cMatInputImage[(idx+cols)*nbImgChannels+2],
             r, c, r+1, c
-          );
+          ) );
         }
         // else Same label, no penalty.
       }
@@ -495,19 +608,18 @@ double energyOfLabellingN(
         // horizontal edge right of here
         if ( lbl != cMatLabels[idx+1] )
         {
-          res += functor(
+          res += toCapacity< CapType >( weightScale * functor(
             pixR, pixG, pixB,
             cMatInputImage[(idx+1)*nbImgChannels+0],
             cMatInputImage[(idx+1)*nbImgChannels+1],
             cMatInputImage[(idx+1)*nbImgChannels+2],
             r, c, r, c+1
-          );
+          ) );
         }
         // else Same label, no penalty.
       }
     }// for c
   }// for r
-  std::cout << "dbg: just binary = " << std::fixed << res-un << "\n";
 
   if ( nhoodSize == 8 ) {
     // Add two sets of diagonal edges too.
@@ -524,13 +636,13 @@ double energyOfLabellingN(
           // diagonal down to right
           if ( lbl != cMatLabels[idx+cols+1] )
           {
-            res += functor(
+            res += toCapacity< CapType >( weightScale * functor(
               pixR, pixG, pixB,
               cMatInputImage[(idx+cols+1)*nbImgChannels+0],
               cMatInputImage[(idx+cols+1)*nbImgChannels+1],
               cMatInputImage[(idx+cols+1)*nbImgChannels+2],
               r, c, r+1, c+1
-            );
+            ) );
           }
           // else Same label, no penalty.
         }
@@ -539,13 +651,13 @@ double energyOfLabellingN(
           // diagonal edge down to left
           if ( lbl != cMatLabels[idx+cols-1] )
           {
-            res += functor(
+            res += toCapacity< CapType >( weightScale * functor(
               pixR, pixG, pixB,
               cMatInputImage[(idx+cols-1)*nbImgChannels+0],
               cMatInputImage[(idx+cols-1)*nbImgChannels+1],
               cMatInputImage[(idx+cols-1)*nbImgChannels+2],
               r, c, r+1, c-1
-            );
+            ) );
           }
           // else Same label, no penalty.
         }
@@ -586,7 +698,6 @@ double energyOfLabellingNSuperPixel(
     assert( 0 <= cMatLabels[i] && cMatLabels[i] < nbLabels );
     res += cMatLabelWeights[ i*nbLabels + cMatLabels[i] ];
   }
-  std::cout << "dbg: just unary = " << std::fixed << res << "\n";
 
   // Nbr Edge potentials:
   // Only sum each edge once.
@@ -602,182 +713,562 @@ double energyOfLabellingNSuperPixel(
     }
     // else Same label, no penalty.
   }
-
-  std::cout << "dbg: unary + binary = " << std::fixed << res << "\n";
   return res;
 }
 
 ////////////////////////////////////////////////////////////////////////////////
-template < typename FUNCTOR_TYPE >
-static void inferenceNABSwap(
-  int             nhoodSize,
-  int             rows,
-  int             cols,
-  int             nbImgChannels,
-  int             nbLabels,
-  double*         cMatInputImage,
-  double*         cMatLabelWeights,
-  FUNCTOR_TYPE&   functor,
-  int32_t*        cMatOut
-)
+// The edges incident on each node, in compressed row form: the edges of node i
+// are m_edges[ m_start[i] ... m_start[i+1]-1 ].
+struct NodeEdgeIndex
 {
-  std::cout << "N-label AB swap algorithm, " << nbLabels << " labels.\n";
-  // todo: for now include whole graph.  But actually the graph only needs to
-  // have nodes whose label is alpha or beta.  See PyMaxFlow for example.  It's
-  // more complicated because then the cut weight is not the energy of the
-  // labelling.
-  
-  const int maxIterations = 100;
-  const int npix = rows*cols;
-
-  // std::cout << "I think image ul pix = " << cMatInputImage[0]
-  //           << ", " << cMatInputImage[1] << ", "
-  //           << cMatInputImage[2] << "\n";
-
-  // start with arbitrary labelling.  Note our current labelling is called "x"
-  // in the alg (chaper 3 of the MRF book), here x == cMatOut.
-  //
-  std::fill( cMatOut, cMatOut + npix, 0 );
-  // Compute energy of intial labelling.
-  double Ex = energyOfLabellingN(
-    nhoodSize,
-    rows,
-    cols,
-    nbImgChannels,
-    nbLabels,
-    cMatInputImage,
-    cMatLabelWeights,
-    functor,
-    cMatOut
-  );
-  std::cout << "\t\t Initial energy = " 
-            << std::fixed << std::setprecision(8)
-            << Ex << "\n";
-
-  bool success;
-  boost::scoped_array< int32_t > t( new int32_t[npix] );
-  boost::scoped_array< int32_t > proposedLabelling( new int32_t[npix] );
-  boost::scoped_array< double > srcEdges( new double[npix] );
-  boost::scoped_array< double > snkEdges( new double[npix] );
-  boost::scoped_array< bool >   validMask( new bool[npix] );
+  std::vector< int > m_start;
+  std::vector< int > m_edges;
+
+  // The ends of edge e are iEnds[e*stride] and jEnds[e*stride].
+  template < typename INT_TYPE >
+  void build(
+    int n, int nbEdges, const INT_TYPE* iEnds, const INT_TYPE* jEnds, int stride
+  )
+  {
+    m_start.assign( n+1, 0 );
+    for ( int e=0; e<nbEdges; ++e )
+    {
+      ++m_start[ iEnds[e*stride]+1 ];
+      ++m_start[ jEnds[e*stride]+1 ];
+    }
+    for ( int i=0; i<n; ++i )
+    {
+      m_start[i+1] += m_start[i];
+    }
+    m_edges.resize( 2*nbEdges );
+    std::vector< int > pos( m_start.begin(), m_start.end()-1 );
+    for ( int e=0; e<nbEdges; ++e )
+    {
+      m_edges[ pos[ iEnds[e*stride] ]++ ] = e;
+      m_edges[ pos[ jEnds[e*stride] ]++ ] = e;
+    }
+  }
+};
 
-  for ( int ic=0; ic<maxIterations; ++ic )
+////////////////////////////////////////////////////////////////////////////////
+// An a-b swap move only involves the nodes currently labelled a or b.  This
+// holds the compact graph over just those nodes.  The graph is reset rather
+// than reallocated for each move.
+template < typename GRAPH_TYPE >
+struct ABSwapSubgraph
+{
+  ABSwapSubgraph( int n, int nbEdges )
+    : m_g( new GRAPH_TYPE( n, nbEdges ) ), m_compactId( n, -1 )
   {
-    std::cout << "\t** iteration " << ic << "\n";
+    m_nodes.reserve( n );
+  }
 
-    success = false;
-    // for each UNIQUE pair of labels {a,b} in L
-    for ( int a=0; a<nbLabels; ++a )
+  // Sets up an empty graph with a node for each node of the labelling with
+  // label a or b.
+  void reset( int n, const int32_t* labels, int a, int b )
+  {
+    for ( size_t k=0; k<m_nodes.size(); ++k )
     {
-      for ( int b=a+1; b<nbLabels; ++b )
+      m_compactId[ m_nodes[k] ] = -1;
+    }
+    m_nodes.clear();
+    for ( int i=0; i<n; ++i )
+    {
+      if ( labels[i] == a || labels[i] == b )
       {
-        std::cout << "\t**  ab = " << a << "," << b << "\n";
-        // find xhat = argmin E(x') among x' within one a-b swap of x
-
-        // Use our 2-class inference to determine the transformation labels t.
-
-        // Set up source and sink edges.
-        for ( int i=0; i<npix; ++i )
-        {
-          assert( 0 <= cMatOut[i] && cMatOut[i] < nbLabels );
+        m_compactId[i] = (int)m_nodes.size();
+        m_nodes.push_back( i );
+      }
+    }
+    m_g->reset();
+    if ( !m_nodes.empty() )
+    {
+      m_g->add_node( (int)m_nodes.size() );
+    }
+  }
 
-          if ( cMatOut[i] == a || cMatOut[i] == b )
-          {
-            // t == 0 case, label a is assigned.  Cut snk edge with higher prob,
-            // lower potential ==> put alpha weight on snk edge.
-            snkEdges[i] = cMatLabelWeights[ i*nbLabels + a ];
-            // t == 1 case, label b is assigned.
-            srcEdges[i] = cMatLabelWeights[ i*nbLabels + b ];
-            validMask[i] = true;
-          }
-          else
-          {
-            // This pixel is not a candidate for swapping.  Arbitrarily
-            // associate with the source.  Guarantee that by setting one
-            // weight to Inf.
-            snkEdges[i] = cMatLabelWeights[ i*nbLabels + cMatOut[i] ];
-            srcEdges[i] = std::numeric_limits<double>::infinity();
-            validMask[i] = false;
-          }
-        }// for i
-        
-        // For the edge weight we need to wrap the simple 2-class callback 
-        // with a function of the 
-        // todo: make nbr cost as function of a-b class labels
-        double Exhat = inference2FunctorBased(
-          nhoodSize,
-          rows,
-          cols,
-          nbImgChannels,
-          cMatInputImage,
-          srcEdges.get(),
-          snkEdges.get(),
-          functor,
-          t.get(),
-          NULL
-        );
+  int size() const { return (int)m_nodes.size(); }
 
-        // To compute the energy, have to construct the proposed labelling.
-        // We set x = xhat, which means use optimal move / transformation to
-        // construct xhat.
-        for ( int i=0; i<npix; ++i )
-        {
-          if ( cMatOut[i] == a || cMatOut[i] == b )
-          {
-            // A candidate for swap.  Depends on t.
-            proposedLabelling[i] = t[i] ? b : a;
-          }
-          else
-          {
-            proposedLabelling[i] = cMatOut[i];
-          }
-        }
+  std::auto_ptr< GRAPH_TYPE > m_g;
+  // Graph node of each node, -1 if not in the move.
+  std::vector< int >          m_compactId;
+  // Node of each graph node.
+  std::vector< int >          m_nodes;
+};
 
-        Exhat = energyOfLabellingN(
-          nhoodSize,
-          rows,
-          cols,
-          nbImgChannels,
-          nbLabels,
-          cMatInputImage,
-          cMatLabelWeights,
-          functor,
-          proposedLabelling.get()
-        );
-        std::cout << "\t\t Computed energy = " 
-                  << std::fixed << std::setprecision(8)
-                  << Exhat << "\n";
+////////////////////////////////////////////////////////////////////////////////
+// Pairwise potentials for EnergyTracker.  Each gives the ends of edge e and its
+// cost for a pair of labels, which is zero for equal labels.
 
-        // If E(xhat) < E(x) set x = xhat and success = 1
-        if ( Exhat < Ex )
-        {
-          Ex = Exhat;
-          std::cout << "\t**  went downhill, criterion Ex = " << Ex << "\n";
-          std::copy(
-            proposedLabelling.get(), proposedLabelling.get()+npix, cMatOut
-          );
-          success = true;
-        }
+// Pixel grid, with the Potts weights computed once per image.
+template < typename CAP_TYPE >
+class PixelPairwise {
+  public:
+    PixelPairwise( const PixelNbrEdges< CAP_TYPE >& edges ) : m_edges( edges ) {}
 
-      }// for b
-    }// for a
+    inline int nbEdges() const { return m_edges.size(); }
+    inline int first( int e ) const { return m_edges.m_i[e]; }
+    inline int second( int e ) const { return m_edges.m_j[e]; }
 
-    if ( !success )
+    inline double operator()( int e, int l1, int l2 ) const
     {
-      break;
+      return ( l1 != l2 ) ? m_edges.m_wt[e] : 0.0;
     }
-  }// for ic
 
-  if ( success )
-  {
-    std::cerr << "Warning: maximum iterations reached in inferenceNABSwap"
-              << std::endl;
-  }
-  std::cout << "** abswap complete!\n";
-}
+  private:
+    const PixelNbrEdges< CAP_TYPE >& m_edges;
+};
 
-////////////////////////////////////////////////////////////////////////////////
-// todo: repeated code...
+// Super-pixel graph, with the degree / adjacency functors.
+template < typename FUNCTOR_TYPE >
+class SuperPixelPairwise {
+  public:
+    SuperPixelPairwise(
+      int nbEdges, const int32_t* cMatEdges, const std::vector<int>& spDegree,
+      FUNCTOR_TYPE& functor
+    )
+      : m_nbEdges( nbEdges ), m_edges( cMatEdges ), m_spDegree( spDegree ),
+        m_functor( functor )
+    {
+    }
+
+    inline int nbEdges() const { return m_nbEdges; }
+    inline int first( int e ) const { return m_edges[2*e+0]; }
+    inline int second( int e ) const { return m_edges[2*e+1]; }
+
+    inline double operator()( int e, int l1, int l2 ) const
+    {
+      if ( l1 == l2 )
+      {
+        return 0.0;
+      }
+      return m_functor(
+        m_spDegree[ first(e) ], m_spDegree[ second(e) ], l1, l2
+      );
+    }
+
+  private:
+    const int                m_nbEdges;
+    const int32_t*           m_edges;
+    const std::vector<int>&  m_spDegree;
+    FUNCTOR_TYPE&            m_functor;
+};
+
+////////////////////////////////////////////////////////////////////////////////
+// Keeps the energy of the current labelling as moves are applied to it.  A move
+// changes few labels, so its change in energy is summed over just those nodes
+// and their edges rather than the whole graph.
+template < typename PAIRWISE_TYPE, typename WEIGHT_TYPE >
+class EnergyTracker {
+  public:
+    EnergyTracker(
+      int                   n,
+      int                   nbLabels,
+      const WEIGHT_TYPE*    cMatLabelWeights,
+      const PAIRWISE_TYPE&  pairwise,
+      const NodeEdgeIndex&  nodeEdges
+    )
+      : m_nbLabels( nbLabels ), m_labelWeights( cMatLabelWeights ),
+        m_pairwise( pairwise ), m_nodeEdges( nodeEdges ),
+        m_moved( n, false ), m_newLabel( n ), m_energy( 0.0 )
+    {
+    }
+
+    // Computes the energy of the labelling from scratch.
+    double reset( int n, const int32_t* labels )
+    {
+      m_energy = 0.0;
+      for ( int i=0; i<n; ++i )
+      {
+        m_energy += unary( i, labels[i] );
+      }
+      for ( int e=0; e<m_pairwise.nbEdges(); ++e )
+      {
+        m_energy += m_pairwise(
+          e, labels[ m_pairwise.first(e) ], labels[ m_pairwise.second(e) ]
+        );
+      }
+      return m_energy;
+    }
+
+    double energy() const { return m_energy; }
+
+    // The change in energy if each nodes[k] takes label newLabels[k].
+    double delta(
+      const int32_t*              labels,
+      const std::vector<int>&     nodes,
+      const std::vector<int32_t>& newLabels
+    )
+    {
+      for ( size_t k=0; k<nodes.size(); ++k )
+      {
+        m_moved[ nodes[k] ] = true;
+        m_newLabel[ nodes[k] ] = newLabels[k];
+      }
+
+      double res = 0.0;
+      for ( size_t k=0; k<nodes.size(); ++k )
+      {
+        const int i = nodes[k];
+        res += unary( i, newLabels[k] ) - unary( i, labels[i] );
+
+        for ( int ie=m_nodeEdges.m_start[i]; ie<m_nodeEdges.m_start[i+1]; ++ie )
+        {
+          const int e  = m_nodeEdges.m_edges[ie];
+          const int e1 = m_pairwise.first(e);
+          const int e2 = m_pairwise.second(e);
+          const int j  = ( e1 == i ) ? e2 : e1;
+          if ( m_moved[j] && j < i )
+          {
+            // Both ends moved, counted from j.
+            continue;
+          }
+          res += m_pairwise(
+            e,
+            m_moved[e1] ? m_newLabel[e1] : labels[e1],
+            m_moved[e2] ? m_newLabel[e2] : labels[e2]
+          ) - m_pairwise( e, labels[e1], labels[e2] );
+        }
+      }
+
+      for ( size_t k=0; k<nodes.size(); ++k )
+      {
+        m_moved[ nodes[k] ] = false;
+      }
+      return res;
+    }
+
+    // Makes the move, given its change in energy from delta().
+    void apply(
+      int32_t*                    labels,
+      const std::vector<int>&     nodes,
+      const std::vector<int32_t>& newLabels,
+      double                      dE
+    )
+    {
+      for ( size_t k=0; k<nodes.size(); ++k )
+      {
+        labels[ nodes[k] ] = newLabels[k];
+      }
+      m_energy += dE;
+    }
+
+  private:
+    inline double unary( int i, int lbl ) const
+    {
+      assert( 0 <= lbl && lbl < m_nbLabels );
+      return m_labelWeights[ i*m_nbLabels + lbl ];
+    }
+
+    const int              m_nbLabels;
+    const WEIGHT_TYPE*     m_labelWeights;
+    const PAIRWISE_TYPE&   m_pairwise;
+    const NodeEdgeIndex&   m_nodeEdges;
+    std::vector< bool >    m_moved;
+    std::vector< int32_t > m_newLabel;
+    double                 m_energy;
+};
+
+// A move is only taken if it lowers the energy by more than rounding error,
+// otherwise equal-energy moves could go round in circles.
+inline bool isDownhill( double dE, double E )
+{
+  return dE < -1E-10 * std::max( 1.0, std::fabs( E ) );
+}
+
+// When set, the tracked energy is checked against a full recompute after each
+// move.  For debugging, it is slow.
+static bool s_checkEnergy = false;
+
+void ultraflow_setCheckEnergy( bool check )
+{
+  s_checkEnergy = check;
+}
+
+static void checkTrackedEnergy( double tracked, double full, const char* where )
+{
+  if ( std::fabs( tracked - full ) > 1E-6 * std::max( 1.0, std::fabs( full ) ) )
+  {
+    std::ostringstream msg;
+    msg << where << ": tracked energy " << std::setprecision(12) << tracked
+        << " != recomputed energy " << full;
+    throw( UflowException( msg.str().c_str() ) );
+  }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// One a-b swap move for the pixel grid.  On return t[i] is 0 for pixels that
+// should take label a and 1 for label b; t is only set for pixels in the move.
+template < typename WEIGHT_TYPE >
+static double abSwapMoveN(
+  int                     nbLabels,
+  const WEIGHT_TYPE*      cMatLabelWeights,
+  const PixelNbrEdges< typename UflowTypes< WEIGHT_TYPE >::CapType >& edges,
+  const NodeEdgeIndex&    nodeEdges,
+  const int32_t*          labels,
+  int                     a,
+  int                     b,
+  ABSwapSubgraph< typename UflowTypes< WEIGHT_TYPE >::GraphType >& sub,
+  int32_t*                t
+)
+{
+  typedef typename UflowTypes< WEIGHT_TYPE >::CapType   CapType;
+  typedef typename UflowTypes< WEIGHT_TYPE >::GraphType GraphT;
+  GraphT& g = *sub.m_g;
+  for ( int k=0; k<sub.size(); ++k )
+  {
+    const int i = sub.m_nodes[k];
+    addMoveUnary(
+      g, k,
+      static_cast< CapType >( cMatLabelWeights[ i*nbLabels + a ] ),
+      static_cast< CapType >( cMatLabelWeights[ i*nbLabels + b ] )
+    );
+    // Edges to pixels with other labels cost the same whether this pixel is a
+    // or b, so they are a constant and drop out.  Edges inside the move are
+    // added once, from the lower numbered end.
+    for ( int ie=nodeEdges.m_start[i]; ie<nodeEdges.m_start[i+1]; ++ie )
+    {
+      const int e = nodeEdges.m_edges[ie];
+      const int j = ( edges.m_i[e] == i ) ? edges.m_j[e] : edges.m_i[e];
+      const int kj = sub.m_compactId[j];
+      if ( kj > k )
+      {
+        g.add_edge( k, kj, edges.m_wt[e], edges.m_wt[e] );
+      }
+    }
+  }
+
+  double flow = ( sub.size() > 0 ) ? (double)g.maxflow() : 0.0;
+
+  for ( int k=0; k<sub.size(); ++k )
+  {
+    t[ sub.m_nodes[k] ] = g.what_segment( k );
+  }
+  return flow;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// One a-b swap move on the super-pixel graph.  The adjacency potentials depend
+// on the labels, so the edges to super-pixels outside the move go into the
+// terminal weights.
+template < typename FUNCTOR_TYPE >
+static double abSwapMoveSuperPixel(
+  int                     nbLabels,
+  int32_t*                cMatEdges,
+  const std::vector<int>& spDegree,
+  const NodeEdgeIndex&    nodeEdges,
+  double*                 cMatLabelWeights,
+  FUNCTOR_TYPE&           functor,
+  const int32_t*          labels,
+  int                     a,
+  int                     b,
+  ABSwapSubgraph< GraphType >& sub,
+  int32_t*                t
+)
+{
+  GraphType& g = *sub.m_g;
+  for ( int k=0; k<sub.size(); ++k )
+  {
+    const int i = sub.m_nodes[k];
+    DType E0 = cMatLabelWeights[ i*nbLabels + a ];
+    DType E1 = cMatLabelWeights[ i*nbLabels + b ];
+
+    for ( int ie=nodeEdges.m_start[i]; ie<nodeEdges.m_start[i+1]; ++ie )
+    {
+      const int e = nodeEdges.m_edges[ie];
+      // Keep the edge's own order, as energyOfLabellingNSuperPixel does.
+      const int ei = cMatEdges[2*e+0];
+      const int ej = cMatEdges[2*e+1];
+      const bool iFirst = ( ei == i );
+      const int j = iFirst ? ej : ei;
+      const int kj = sub.m_compactId[j];
+      const double di = spDegree[ei], dj = spDegree[ej];
+      if ( kj < 0 )
+      {
+        const int lj = labels[j];
+        E0 += iFirst ? functor( di, dj, a, lj ) : functor( di, dj, lj, a );
+        E1 += iFirst ? functor( di, dj, b, lj ) : functor( di, dj, lj, b );
+      }
+      else if ( kj > k )
+      {
+        // Cutting k->kj puts k in a, kj in b.
+        g.add_edge(
+          k, kj,
+          iFirst ? functor( di, dj, a, b ) : functor( di, dj, b, a ),
+          iFirst ? functor( di, dj, b, a ) : functor( di, dj, a, b )
+        );
+      }
+    }
+    addMoveUnary( g, k, E0, E1 );
+  }
+
+  double flow = ( sub.size() > 0 ) ? (double)g.maxflow() : 0.0;
+
+  for ( int k=0; k<sub.size(); ++k )
+  {
+    t[ sub.m_nodes[k] ] = g.what_segment( k );
+  }
+  return flow;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// The unaries are WEIGHT_TYPE, and the nbr potentials are scaled by weightScale
+// to match them.  The energies reported are divided by weightScale again.
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename WEIGHT_TYPE >
+static void inferenceNABSwap(
+  int                 nhoodSize,
+  int                 rows,
+  int                 cols,
+  int                 nbImgChannels,
+  int                 nbLabels,
+  const IMG_TYPE*     cMatInputImage,
+  const WEIGHT_TYPE*  cMatLabelWeights,
+  double              weightScale,
+  FUNCTOR_TYPE&       functor,
+  int32_t*            cMatOut,
+  UflowStats*         stats,
+  bool                verbose
+)
+{
+  typedef typename UflowTypes< WEIGHT_TYPE >::CapType   CapType;
+  typedef typename UflowTypes< WEIGHT_TYPE >::GraphType GraphT;
+  UflowLog log( verbose );
+  log << "N-label AB swap algorithm, " << nbLabels << " labels.\n";
+  
+  const int maxIterations = 100;
+  const int npix = rows*cols;
+
+  // The nbr weights don't depend on the labelling, so are computed once.
+  PixelNbrEdges< CapType > nbrEdges;
+  computePixelNbrEdges(
+    nhoodSize, rows, cols, nbImgChannels, cMatInputImage, functor, weightScale,
+    nbrEdges
+  );
+  NodeEdgeIndex nodeEdges;
+  nodeEdges.build(
+    npix, nbrEdges.size(), &nbrEdges.m_i[0], &nbrEdges.m_j[0], 1
+  );
+  ABSwapSubgraph< GraphT > sub( npix, nbrEdges.size() );
+  PixelPairwise< CapType > pairwise( nbrEdges );
+  EnergyTracker< PixelPairwise< CapType >, WEIGHT_TYPE > tracker(
+    npix, nbLabels, cMatLabelWeights, pairwise, nodeEdges
+  );
+
+  // start with arbitrary labelling.  Note our current labelling is called "x"
+  // in the alg (chaper 3 of the MRF book), here x == cMatOut.
+  //
+  std::fill( cMatOut, cMatOut + npix, 0 );
+  // Compute energy of intial labelling.
+  double Ex = tracker.reset( npix, cMatOut );
+  log << "\t\t Initial energy = " 
+            << std::fixed << std::setprecision(8)
+            << Ex << "\n";
+
+  bool success;
+  boost::scoped_array< int32_t > t( new int32_t[npix] );
+  std::vector< int >     moved;
+  std::vector< int32_t > movedLabels;
+
+  for ( int ic=0; ic<maxIterations; ++ic )
+  {
+    log << "\t** iteration " << ic << "\n";
+    if ( stats ) ++stats->nbIterations;
+
+    success = false;
+    // for each UNIQUE pair of labels {a,b} in L
+    for ( int a=0; a<nbLabels; ++a )
+    {
+      for ( int b=a+1; b<nbLabels; ++b )
+      {
+        // find xhat = argmin E(x') among x' within one a-b swap of x
+
+        // Use a 2-class cut over just the a and b pixels to determine the
+        // transformation labels t.
+        sub.reset( npix, cMatOut, a, b );
+        const double tFlow = statsTime( stats );
+        abSwapMoveN(
+          nbLabels,
+          cMatLabelWeights,
+          nbrEdges,
+          nodeEdges,
+          cMatOut,
+          a,
+          b,
+          sub,
+          t.get()
+        );
+        countCut( stats, tFlow );
+
+        // The pixels that change label under the optimal move.
+        moved.clear();
+        movedLabels.clear();
+        for ( int k=0; k<sub.size(); ++k )
+        {
+          const int i = sub.m_nodes[k];
+          const int32_t lbl = t[i] ? b : a;
+          if ( lbl != cMatOut[i] )
+          {
+            moved.push_back( i );
+            movedLabels.push_back( lbl );
+          }
+        }
+        if ( moved.empty() )
+        {
+          continue;
+        }
+
+        // If E(xhat) < E(x) set x = xhat and success = 1
+        const double tEnergy = statsTime( stats );
+        const double dE = tracker.delta( cMatOut, moved, movedLabels );
+        countEnergyTime( stats, tEnergy );
+        if ( isDownhill( dE, Ex ) )
+        {
+          tracker.apply( cMatOut, moved, movedLabels, dE );
+          Ex = tracker.energy();
+          log << "\t**  ab = " << a << "," << b
+                    << " went downhill, criterion Ex = " << Ex << "\n";
+          if ( s_checkEnergy )
+          {
+            checkTrackedEnergy(
+              Ex,
+              energyOfLabellingN(
+                nhoodSize,
+                rows,
+                cols,
+                nbImgChannels,
+                nbLabels,
+                cMatInputImage,
+                cMatLabelWeights,
+                functor,
+                weightScale,
+                cMatOut
+              ),
+              "inferenceNABSwap"
+            );
+          }
+          success = true;
+        }
+
+      }// for b
+    }// for a
+
+    if ( !success )
+    {
+      break;
+    }
+  }// for ic
+
+  if ( success )
+  {
+    std::cerr << "Warning: maximum iterations reached in inferenceNABSwap"
+              << std::endl;
+  }
+  if ( stats ) stats->energy = Ex / weightScale;
+  log << "** abswap complete!\n";
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// todo: repeated code...
 template < typename FUNCTOR_TYPE >
 static void inferenceSuperPixelABSwap(
   int             nbSuperPixels,
@@ -786,41 +1277,47 @@ static void inferenceSuperPixelABSwap(
   int32_t*        cMatEdges,
   double*         cMatLabelWeights,
   FUNCTOR_TYPE&   functor,
-  int32_t*        cMatOut
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
 )
 {
-  std::cout << "N-label AB swap algorithm, " << nbLabels << " labels.\n";
+  UflowLog log( verbose );
+  log << "N-label AB swap algorithm, " << nbLabels << " labels.\n";
   
   // todo: parameterise
   const int maxIterations = 100;
 
+  std::vector< int > spDegree( nbSuperPixels );
+  computeSuperPixelDegree( nbSuperPixels, nbEdges, cMatEdges, spDegree );
+  NodeEdgeIndex nodeEdges;
+  nodeEdges.build( nbSuperPixels, nbEdges, cMatEdges, cMatEdges+1, 2 );
+  ABSwapSubgraph< GraphType > sub( nbSuperPixels, nbEdges );
+  SuperPixelPairwise< FUNCTOR_TYPE > pairwise(
+    nbEdges, cMatEdges, spDegree, functor
+  );
+  EnergyTracker< SuperPixelPairwise< FUNCTOR_TYPE >, double > tracker(
+    nbSuperPixels, nbLabels, cMatLabelWeights, pairwise, nodeEdges
+  );
+
   // start with arbitrary labelling.  Note our current labelling is called "x"
   // in the alg (chaper 3 of the MRF book), here x == cMatOut.
   std::fill( cMatOut, cMatOut + nbSuperPixels, 0 );
   // Compute energy of intial labelling.
-  double Ex = energyOfLabellingNSuperPixel(
-    nbSuperPixels,
-    nbLabels,
-    nbEdges,
-    cMatEdges,
-    cMatLabelWeights,
-    functor,
-    cMatOut
-  );
-  std::cout << "\t\t Initial energy = " 
+  double Ex = tracker.reset( nbSuperPixels, cMatOut );
+  log << "\t\t Initial energy = " 
             << std::fixed << std::setprecision(8)
             << Ex << "\n";
 
   bool success;
   boost::scoped_array< int32_t > t( new int32_t[nbSuperPixels] );
-  boost::scoped_array< int32_t > proposedLabelling( new int32_t[nbSuperPixels] );
-  boost::scoped_array< double > srcEdges( new double[nbSuperPixels] );
-  boost::scoped_array< double > snkEdges( new double[nbSuperPixels] );
-  boost::scoped_array< bool >   validMask( new bool[nbSuperPixels] );
+  std::vector< int >     moved;
+  std::vector< int32_t > movedLabels;
 
   for ( int ic=0; ic<maxIterations; ++ic )
   {
-    std::cout << "\t** iteration " << ic << "\n";
+    log << "\t** iteration " << ic << "\n";
+    if ( stats ) ++stats->nbIterations;
 
     success = false;
     // for each UNIQUE pair of labels {a,b} in L
@@ -828,88 +1325,71 @@ static void inferenceSuperPixelABSwap(
     {
       for ( int b=a+1; b<nbLabels; ++b )
       {
-        std::cout << "\t**  ab = " << a << "," << b << "\n";
         // find xhat = argmin E(x') among x' within one a-b swap of x
 
-        // Use our 2-class inference to determine the transformation labels t.
-
-        // Set up source and sink edges.
-        for ( int i=0; i<nbSuperPixels; ++i )
-        {
-          assert( 0 <= cMatOut[i] && cMatOut[i] < nbLabels );
-
-          if ( cMatOut[i] == a || cMatOut[i] == b )
-          {
-            // t == 0 case, label a is assigned.  Cut snk edge with higher prob,
-            // lower potential ==> put alpha weight on snk edge.
-            snkEdges[i] = cMatLabelWeights[ i*nbLabels + a ];
-            // t == 1 case, label b is assigned.
-            srcEdges[i] = cMatLabelWeights[ i*nbLabels + b ];
-            validMask[i] = true;
-          }
-          else
-          {
-            // This pixel is not a candidate for swapping.  Arbitrarily
-            // associate with the source.  Guarantee that by setting one
-            // weight to Inf.
-            snkEdges[i] = cMatLabelWeights[ i*nbLabels + cMatOut[i] ];
-            srcEdges[i] = std::numeric_limits<double>::infinity();
-            validMask[i] = false;
-          }
-        }// for i
-        
-        double Exhat = inference2SuperPixelFunctorBased(
-          nbSuperPixels,
-          nbEdges,
+        // Use a 2-class cut over just the a and b super-pixels to determine
+        // the transformation labels t.
+        sub.reset( nbSuperPixels, cMatOut, a, b );
+        const double tFlow = statsTime( stats );
+        abSwapMoveSuperPixel(
+          nbLabels,
           cMatEdges,
-          srcEdges.get(),
-          snkEdges.get(),
+          spDegree,
+          nodeEdges,
+          cMatLabelWeights,
           functor,
-          t.get(),
-          NULL, 
-          a, 
-          b
+          cMatOut,
+          a,
+          b,
+          sub,
+          t.get()
         );
+        countCut( stats, tFlow );
 
-        // To compute the energy, have to construct the proposed labelling.
-        // We set x = xhat, which means use optimal move / transformation to
-        // construct xhat.
-        for ( int i=0; i<nbSuperPixels; ++i )
+        // The super-pixels that change label under the optimal move.
+        moved.clear();
+        movedLabels.clear();
+        for ( int k=0; k<sub.size(); ++k )
         {
-          if ( cMatOut[i] == a || cMatOut[i] == b )
-          {
-            // A candidate for swap.  Depends on t.
-            proposedLabelling[i] = t[i] ? b : a;
-          }
-          else
+          const int i = sub.m_nodes[k];
+          const int32_t lbl = t[i] ? b : a;
+          if ( lbl != cMatOut[i] )
           {
-            proposedLabelling[i] = cMatOut[i];
+            moved.push_back( i );
+            movedLabels.push_back( lbl );
           }
         }
-
-        Exhat = energyOfLabellingNSuperPixel(
-          nbSuperPixels,
-          nbLabels,
-          nbEdges,
-          cMatEdges,
-          cMatLabelWeights,
-          functor,
-          proposedLabelling.get()
-        );
-        std::cout << "\t\t Computed energy = " 
-                  << std::fixed << std::setprecision(8)
-                  << Exhat << "\n";
+        if ( moved.empty() )
+        {
+          continue;
+        }
 
         // If E(xhat) < E(x) set x = xhat and success = 1
-        if ( Exhat < Ex )
+        const double tEnergy = statsTime( stats );
+        const double dE = tracker.delta( cMatOut, moved, movedLabels );
+        countEnergyTime( stats, tEnergy );
+        if ( isDownhill( dE, Ex ) )
         {
-          Ex = Exhat;
-          std::cout << "\t**  went downhill, criterion Ex = " << Ex << "\n";
-          std::copy(
-            proposedLabelling.get(),
-            proposedLabelling.get()+nbSuperPixels,
-            cMatOut
-          );
+          tracker.apply( cMatOut, moved, movedLabels, dE );
+          Ex = tracker.energy();
+          log << "\t**  ab = " << a << "," << b
+                    << " went downhill, criterion Ex = " << Ex << "\n";
+          if ( s_checkEnergy )
+          {
+            checkTrackedEnergy(
+              Ex,
+              energyOfLabellingNSuperPixel(
+                nbSuperPixels,
+                nbLabels,
+                nbEdges,
+                cMatEdges,
+                cMatLabelWeights,
+                functor,
+                cMatOut
+              ),
+              "inferenceSuperPixelABSwap"
+            );
+          }
           success = true;
         }
 
@@ -927,22 +1407,407 @@ static void inferenceSuperPixelABSwap(
     std::cerr << "Warning: maximum iterations reached in inferenceSuperPixelABSwap"
               << std::endl;
   }
-  std::cout << "** abswap complete!\n";
+  if ( stats ) stats->energy = Ex;
+  log << "** abswap complete!\n";
 }
 
 ////////////////////////////////////////////////////////////////////////////////
+// One alpha-expansion move for the pixel grid: t[i] is set to 1 for pixels that
+// should switch to label alpha, 0 for those that keep their current label.
+template < typename WEIGHT_TYPE >
+static double alphaExpansionMoveN(
+  int                   npix,
+  int                   nbLabels,
+  const WEIGHT_TYPE*    cMatLabelWeights,
+  const PixelNbrEdges< typename UflowTypes< WEIGHT_TYPE >::CapType >& edges,
+  const int32_t*        labels,
+  int                   alpha,
+  int32_t*              t
+)
+{
+  typedef typename UflowTypes< WEIGHT_TYPE >::CapType   CapType;
+  typedef typename UflowTypes< WEIGHT_TYPE >::GraphType GraphT;
+  std::auto_ptr< GraphT > g( new GraphT( npix, edges.size() ) );
+  g->add_node( npix );
+
+  for ( int i=0; i<npix; ++i )
+  {
+    addMoveUnary(
+      *g, i,
+      static_cast< CapType >( cMatLabelWeights[ i*nbLabels + labels[i] ] ),
+      static_cast< CapType >( cMatLabelWeights[ i*nbLabels + alpha ] )
+    );
+  }
+
+  // Potts model: an edge of weight w costs w if its two labels differ.
+  for ( int e=0; e<edges.size(); ++e )
+  {
+    const int i = edges.m_i[e];
+    const int j = edges.m_j[e];
+    const int li = labels[i];
+    const int lj = labels[j];
+    if ( li == alpha && lj == alpha )
+    {
+      // Both already alpha, no cost whatever the move.
+      continue;
+    }
+    const CapType wt = edges.m_wt[e];
+    const CapType zero = 0;
+    addMovePairwise(
+      *g, i, j,
+      ( li != lj    ) ? wt : zero, // keep, keep
+      ( li != alpha ) ? wt : zero, // keep, alpha
+      ( alpha != lj ) ? wt : zero, // alpha, keep
+      zero                         // alpha, alpha
+    );
+  }
+
+  double flow = (double)g->maxflow();
+
+  for ( int i=0; i<npix; ++i )
+  {
+    t[i] = g->what_segment( i );
+  }
+  return flow;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// Alpha-expansion (Boykov, Veksler & Zabih 2001).  One cut per label per sweep,
+// instead of one per label pair for ab-swap.  The pixel nbr potentials are
+// Potts, so every expansion move is submodular.
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename WEIGHT_TYPE >
+static void inferenceNAlphaExpansion(
+  int                 nhoodSize,
+  int                 rows,
+  int                 cols,
+  int                 nbImgChannels,
+  int                 nbLabels,
+  const IMG_TYPE*     cMatInputImage,
+  const WEIGHT_TYPE*  cMatLabelWeights,
+  double              weightScale,
+  FUNCTOR_TYPE&       functor,
+  int32_t*            cMatOut,
+  UflowStats*         stats,
+  bool                verbose
+)
+{
+  typedef typename UflowTypes< WEIGHT_TYPE >::CapType CapType;
+  UflowLog log( verbose );
+  log << "N-label alpha expansion algorithm, " << nbLabels << " labels.\n";
+  assert( nbImgChannels == 3 ); // currently only support RGB
+  assert( nhoodSize == 4 || nhoodSize == 8 );
+
+  const int maxIterations = 100;
+  const int npix = rows*cols;
+
+  PixelNbrEdges< CapType > nbrEdges;
+  computePixelNbrEdges(
+    nhoodSize, rows, cols, nbImgChannels, cMatInputImage, functor, weightScale,
+    nbrEdges
+  );
+  NodeEdgeIndex nodeEdges;
+  nodeEdges.build(
+    npix, nbrEdges.size(), &nbrEdges.m_i[0], &nbrEdges.m_j[0], 1
+  );
+  PixelPairwise< CapType > pairwise( nbrEdges );
+  EnergyTracker< PixelPairwise< CapType >, WEIGHT_TYPE > tracker(
+    npix, nbLabels, cMatLabelWeights, pairwise, nodeEdges
+  );
+
+  // Same arbitrary initial labelling as ab-swap.
+  std::fill( cMatOut, cMatOut + npix, 0 );
+  double Ex = tracker.reset( npix, cMatOut );
+  log << "\t\t Initial energy = " 
+            << std::fixed << std::setprecision(8)
+            << Ex << "\n";
+
+  bool success;
+  boost::scoped_array< int32_t > t( new int32_t[npix] );
+  std::vector< int >     moved;
+  std::vector< int32_t > movedLabels;
+
+  for ( int ic=0; ic<maxIterations; ++ic )
+  {
+    log << "\t** iteration " << ic << "\n";
+    if ( stats ) ++stats->nbIterations;
+
+    success = false;
+    for ( int alpha=0; alpha<nbLabels; ++alpha )
+    {
+      const double tFlow = statsTime( stats );
+      alphaExpansionMoveN(
+        npix,
+        nbLabels,
+        cMatLabelWeights,
+        nbrEdges,
+        cMatOut,
+        alpha,
+        t.get()
+      );
+      countCut( stats, tFlow );
+
+      moved.clear();
+      movedLabels.clear();
+      for ( int i=0; i<npix; ++i )
+      {
+        if ( t[i] && cMatOut[i] != alpha )
+        {
+          moved.push_back( i );
+          movedLabels.push_back( alpha );
+        }
+      }
+      if ( moved.empty() )
+      {
+        continue;
+      }
+
+      const double tEnergy = statsTime( stats );
+      const double dE = tracker.delta( cMatOut, moved, movedLabels );
+      countEnergyTime( stats, tEnergy );
+      if ( isDownhill( dE, Ex ) )
+      {
+        tracker.apply( cMatOut, moved, movedLabels, dE );
+        Ex = tracker.energy();
+        log << "\t**  alpha = " << alpha
+                  << " went downhill, criterion Ex = " << Ex << "\n";
+        if ( s_checkEnergy )
+        {
+          checkTrackedEnergy(
+            Ex,
+            energyOfLabellingN(
+              nhoodSize,
+              rows,
+              cols,
+              nbImgChannels,
+              nbLabels,
+              cMatInputImage,
+              cMatLabelWeights,
+              functor,
+              weightScale,
+              cMatOut
+            ),
+            "inferenceNAlphaExpansion"
+          );
+        }
+        success = true;
+      }
+    }// for alpha
+
+    if ( !success )
+    {
+      break;
+    }
+  }// for ic
+
+  if ( success )
+  {
+    std::cerr << "Warning: maximum iterations reached in inferenceNAlphaExpansion"
+              << std::endl;
+  }
+  if ( stats ) stats->energy = Ex / weightScale;
+  log << "** aexpansion complete!\n";
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// One alpha-expansion move on the super-pixel graph.
 template < typename FUNCTOR_TYPE >
-static void inferenceNUsingTFunctor(
-  char*           method,
-  int             nhoodSize,
-  int             rows,
-  int             cols,
-  int             nbImgChannels,
+static double alphaExpansionMoveSuperPixel(
+  int                     nbSuperPixels,
+  int                     nbLabels,
+  int                     nbEdges,
+  int32_t*                cMatEdges,
+  const std::vector<int>& spDegree,
+  double*                 cMatLabelWeights,
+  FUNCTOR_TYPE&           functor,
+  const int32_t*          labels,
+  int                     alpha,
+  int32_t*                t
+)
+{
+  const int n = nbSuperPixels;
+  std::auto_ptr< GraphType > g( new GraphType( n, nbEdges ) );
+  g->add_node( n );
+
+  for ( int i=0; i<n; ++i )
+  {
+    addMoveUnary(
+      *g, i,
+      cMatLabelWeights[ i*nbLabels + labels[i] ],
+      cMatLabelWeights[ i*nbLabels + alpha ]
+    );
+  }
+
+  for ( int e=0; e<nbEdges; ++e ){
+    const int i = cMatEdges[2*e+0];
+    const int j = cMatEdges[2*e+1];
+    const int li = labels[i];
+    const int lj = labels[j];
+    if ( li == alpha && lj == alpha )
+    {
+      continue;
+    }
+    // As in energyOfLabellingNSuperPixel, equal labels cost nothing.  The
+    // adjacency potential depends on the labels, and need not be a metric.
+    const double di = spDegree[i], dj = spDegree[j];
+    addMovePairwise(
+      *g, i, j,
+      ( li != lj    ) ? functor( di, dj, li,    lj    ) : 0.0,
+      ( li != alpha ) ? functor( di, dj, li,    alpha ) : 0.0,
+      ( alpha != lj ) ? functor( di, dj, alpha, lj    ) : 0.0,
+      0.0
+    );
+  }
+
+  double flow = g->maxflow();
+
+  for ( int i=0; i<n; ++i )
+  {
+    t[i] = g->what_segment( i );
+  }
+  return flow;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+template < typename FUNCTOR_TYPE >
+static void inferenceSuperPixelAlphaExpansion(
+  int             nbSuperPixels,
   int             nbLabels,
-  double*         cMatInputImage,
+  int             nbEdges,
+  int32_t*        cMatEdges,
   double*         cMatLabelWeights,
   FUNCTOR_TYPE&   functor,
-  int32_t*        cMatOut
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
+)
+{
+  UflowLog log( verbose );
+  log << "N-label alpha expansion algorithm, " << nbLabels << " labels.\n";
+
+  const int maxIterations = 100;
+
+  std::vector< int > spDegree( nbSuperPixels );
+  computeSuperPixelDegree( nbSuperPixels, nbEdges, cMatEdges, spDegree );
+  NodeEdgeIndex nodeEdges;
+  nodeEdges.build( nbSuperPixels, nbEdges, cMatEdges, cMatEdges+1, 2 );
+  SuperPixelPairwise< FUNCTOR_TYPE > pairwise(
+    nbEdges, cMatEdges, spDegree, functor
+  );
+  EnergyTracker< SuperPixelPairwise< FUNCTOR_TYPE >, double > tracker(
+    nbSuperPixels, nbLabels, cMatLabelWeights, pairwise, nodeEdges
+  );
+
+  std::fill( cMatOut, cMatOut + nbSuperPixels, 0 );
+  double Ex = tracker.reset( nbSuperPixels, cMatOut );
+  log << "\t\t Initial energy = " 
+            << std::fixed << std::setprecision(8)
+            << Ex << "\n";
+
+  bool success;
+  boost::scoped_array< int32_t > t( new int32_t[nbSuperPixels] );
+  std::vector< int >     moved;
+  std::vector< int32_t > movedLabels;
+
+  for ( int ic=0; ic<maxIterations; ++ic )
+  {
+    log << "\t** iteration " << ic << "\n";
+    if ( stats ) ++stats->nbIterations;
+
+    success = false;
+    for ( int alpha=0; alpha<nbLabels; ++alpha )
+    {
+      const double tFlow = statsTime( stats );
+      alphaExpansionMoveSuperPixel(
+        nbSuperPixels,
+        nbLabels,
+        nbEdges,
+        cMatEdges,
+        spDegree,
+        cMatLabelWeights,
+        functor,
+        cMatOut,
+        alpha,
+        t.get()
+      );
+      countCut( stats, tFlow );
+
+      moved.clear();
+      movedLabels.clear();
+      for ( int i=0; i<nbSuperPixels; ++i )
+      {
+        if ( t[i] && cMatOut[i] != alpha )
+        {
+          moved.push_back( i );
+          movedLabels.push_back( alpha );
+        }
+      }
+      if ( moved.empty() )
+      {
+        continue;
+      }
+
+      // The move may be approximate if the adjacency potential is not a
+      // metric, so the energy check matters here.
+      const double tEnergy = statsTime( stats );
+      const double dE = tracker.delta( cMatOut, moved, movedLabels );
+      countEnergyTime( stats, tEnergy );
+      if ( isDownhill( dE, Ex ) )
+      {
+        tracker.apply( cMatOut, moved, movedLabels, dE );
+        Ex = tracker.energy();
+        log << "\t**  alpha = " << alpha
+                  << " went downhill, criterion Ex = " << Ex << "\n";
+        if ( s_checkEnergy )
+        {
+          checkTrackedEnergy(
+            Ex,
+            energyOfLabellingNSuperPixel(
+              nbSuperPixels,
+              nbLabels,
+              nbEdges,
+              cMatEdges,
+              cMatLabelWeights,
+              functor,
+              cMatOut
+            ),
+            "inferenceSuperPixelAlphaExpansion"
+          );
+        }
+        success = true;
+      }
+    }// for alpha
+
+    if ( !success )
+    {
+      break;
+    }
+  }// for ic
+
+  if ( success )
+  {
+    std::cerr << "Warning: maximum iterations reached in inferenceSuperPixelAlphaExpansion"
+              << std::endl;
+  }
+  if ( stats ) stats->energy = Ex;
+  log << "** aexpansion complete!\n";
+}
+
+////////////////////////////////////////////////////////////////////////////////
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename WEIGHT_TYPE >
+static void inferenceNUsingTFunctor(
+  char*               method,
+  int                 nhoodSize,
+  int                 rows,
+  int                 cols,
+  int                 nbImgChannels,
+  int                 nbLabels,
+  const IMG_TYPE*     cMatInputImage,
+  const WEIGHT_TYPE*  cMatLabelWeights,
+  double              weightScale,
+  FUNCTOR_TYPE&       functor,
+  int32_t*            cMatOut,
+  UflowStats*         stats,
+  bool                verbose = true
 )
 {
   if ( method == std::string("abswap") )
@@ -955,13 +1820,29 @@ static void inferenceNUsingTFunctor(
       nbLabels,
       cMatInputImage,
       cMatLabelWeights,
+      weightScale,
       functor,
-      cMatOut
+      cMatOut,
+      stats,
+      verbose
     );
   }
   else if ( method == std::string("aexpansion") )
   {
-    throw( UflowException( "alpha expansion not yet implemented" ) );
+    inferenceNAlphaExpansion(
+      nhoodSize,
+      rows,
+      cols,
+      nbImgChannels,
+      nbLabels,
+      cMatInputImage,
+      cMatLabelWeights,
+      weightScale,
+      functor,
+      cMatOut,
+      stats,
+      verbose
+    );
   }
   else
   {
@@ -980,7 +1861,9 @@ static void inferenceSuperPixelUsingTFunctor(
   int32_t*        cMatEdges,
   double*         cMatLabelWeights,
   FUNCTOR_TYPE&   functor,
-  int32_t*        cMatOut
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose = true
 )
 {
   if ( method == std::string("abswap") )
@@ -992,12 +1875,24 @@ static void inferenceSuperPixelUsingTFunctor(
       cMatEdges,
       cMatLabelWeights,
       functor,
-      cMatOut
+      cMatOut,
+      stats,
+      verbose
     );
   }
   else if ( method == std::string("aexpansion") )
   {
-    throw( UflowException( "alpha expansion not yet implemented" ) );
+    inferenceSuperPixelAlphaExpansion(
+      nbSuperPixels,
+      nbLabels,
+      nbEdges,
+      cMatEdges,
+      cMatLabelWeights,
+      functor,
+      cMatOut,
+      stats,
+      verbose
+    );
   }
   else
   {
@@ -1006,6 +1901,363 @@ static void inferenceSuperPixelUsingTFunctor(
   }
 }
 
+////////////////////////////////////////////////////////////////////////////////
+// Tiled pixel inference for large images.  The image is cut into tiles of
+// tileSize x tileSize, and each tile is solved over a window that extends
+// tileOverlap pixels past it on each side; only the tile's own pixels are kept.
+// Tiles are independent so are solved by a pool of worker threads.
+//
+// In the first pass the windows are solved on their own.  In later passes the
+// pixels just outside each window are fixed at the labels from the previous
+// pass, and their edges folded into the window's unaries, so the tiles see each
+// other's borders.  A tile is only solved again if those fixed labels changed.
+// Passes stop when no label changes, or after maxPasses.
+////////////////////////////////////////////////////////////////////////////////
+
+struct PixelTile
+{
+  int m_r0, m_r1, m_c0, m_c1; // the tile's own pixels [r0,r1) x [c0,c1)
+  int m_wr0, m_wr1, m_wc0, m_wc1; // the window solved
+};
+
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename WEIGHT_TYPE >
+struct TiledInferenceJob
+{
+  char*                   m_method;
+  int                     m_nhoodSize;
+  int                     m_rows;
+  int                     m_cols;
+  int                     m_nbImgChannels;
+  int                     m_nbLabels;
+  const IMG_TYPE*         m_inputImage;
+  const WEIGHT_TYPE*      m_labelWeights;
+  double                  m_weightScale;
+  FUNCTOR_TYPE*           m_functor;
+  std::vector<PixelTile>  m_tiles;
+  int                     m_pass;
+  // Labels from the previous two passes, and the labels being computed.
+  const int32_t*          m_prevLabels;
+  const int32_t*          m_prevPrevLabels;
+  int32_t*                m_labels;
+
+  // Next tile to solve, nb of cuts so far, and any error from a worker.
+  pthread_mutex_t         m_mutex;
+  size_t                  m_nextTile;
+  int                     m_nbCuts;
+  double                  m_flowSeconds;
+  double                  m_energySeconds;
+  std::string             m_error;
+};
+
+// Whether the fixed pixels around a tile's window changed over the last pass.
+// If not, solving the tile again would give the same answer.
+template < typename JOB_TYPE >
+static bool tileBorderChanged( const JOB_TYPE& job, const PixelTile& tile )
+{
+  for ( int r=tile.m_wr0-1; r<=tile.m_wr1; ++r ){
+    if ( r < 0 || r >= job.m_rows ) continue;
+    const bool wholeRow = ( r == tile.m_wr0-1 || r == tile.m_wr1 );
+    for ( int c=tile.m_wc0-1; c<=tile.m_wc1; ++c ){
+      if ( c < 0 || c >= job.m_cols ) continue;
+      if ( !wholeRow && c != tile.m_wc0-1 && c != tile.m_wc1 ) continue;
+      const int idx = r*job.m_cols + c;
+      if ( job.m_prevLabels[idx] != job.m_prevPrevLabels[idx] )
+      {
+        return true;
+      }
+    }
+  }
+  return false;
+}
+
+// Solves one tile's window, writing the tile's pixels into job.m_labels.  The
+// window's unaries are copied as capacities, so that int16 unaries can take the
+// folded border edges without overflowing.
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename WEIGHT_TYPE >
+static UflowStats solvePixelTile(
+  TiledInferenceJob< FUNCTOR_TYPE, IMG_TYPE, WEIGHT_TYPE >& job,
+  const PixelTile& tile
+)
+{
+  typedef typename UflowTypes< WEIGHT_TYPE >::CapType CapType;
+  const int nbCh = job.m_nbImgChannels;
+  const int L    = job.m_nbLabels;
+  const int h    = tile.m_wr1 - tile.m_wr0;
+  const int w    = tile.m_wc1 - tile.m_wc0;
+
+  std::vector< IMG_TYPE > img( h*w*nbCh );
+  std::vector< CapType >  wts( h*w*L );
+  std::vector< int32_t > out( h*w );
+  for ( int r=0; r<h; ++r )
+  {
+    const int src = (tile.m_wr0+r)*job.m_cols + tile.m_wc0;
+    std::copy(
+      job.m_inputImage + src*nbCh, job.m_inputImage + (src+w)*nbCh,
+      img.begin() + r*w*nbCh
+    );
+    std::copy(
+      job.m_labelWeights + src*L, job.m_labelWeights + (src+w)*L,
+      wts.begin() + r*w*L
+    );
+  }
+
+  if ( job.m_pass > 0 )
+  {
+    // Fold the edges to fixed pixels outside the window into the unaries.
+    // Edges keep the orientation of computePixelNbrEdges, from the pixel
+    // first in raster order.
+    const int (*nhood)[2] = ( job.m_nhoodSize == 4 ) ? s_nhood4 : s_nhood8;
+    const int nhoodLen    = ( job.m_nhoodSize == 4 ) ? 2        : 4;
+    for ( int r=0; r<h; ++r ){
+      for ( int c=0; c<w; ++c ){
+        if ( r > 0 && r < h-1 && c > 0 && c < w-1 )
+        {
+          continue;
+        }
+        const int pr = tile.m_wr0 + r;
+        const int pc = tile.m_wc0 + c;
+        const IMG_TYPE* pix = job.m_inputImage + (pr*job.m_cols + pc)*nbCh;
+        for ( int j=0; j<nhoodLen; ++j ){
+          for ( int sgn=-1; sgn<=1; sgn+=2 ){
+            const int qr = pr + sgn*nhood[j][0];
+            const int qc = pc + sgn*nhood[j][1];
+            if ( qr < 0 || qr >= job.m_rows || qc < 0 || qc >= job.m_cols )
+            {
+              continue;
+            }
+            if ( tile.m_wr0 <= qr && qr < tile.m_wr1
+                 && tile.m_wc0 <= qc && qc < tile.m_wc1 )
+            {
+              continue;
+            }
+            const int qidx = qr*job.m_cols + qc;
+            const IMG_TYPE* nbr = job.m_inputImage + qidx*nbCh;
+            const CapType wt = toCapacity< CapType >( job.m_weightScale * ( ( sgn > 0 )
+              ? (*job.m_functor)(
+                pix[0], pix[1], pix[2], nbr[0], nbr[1], nbr[2], pr,pc, qr,qc )
+              : (*job.m_functor)(
+                nbr[0], nbr[1], nbr[2], pix[0], pix[1], pix[2], qr,qc, pr,pc ) ) );
+            const int lq = job.m_prevLabels[qidx];
+            CapType* pw = &wts[ (r*w + c)*L ];
+            for ( int l=0; l<L; ++l )
+            {
+              if ( l != lq ) pw[l] += wt;
+            }
+          }// for sgn
+        }// for j
+      }// for c
+    }// for r
+  }
+
+  UflowStats tileStats;
+  inferenceNUsingTFunctor(
+    job.m_method,
+    job.m_nhoodSize,
+    h,
+    w,
+    nbCh,
+    L,
+    &img[0],
+    &wts[0],
+    job.m_weightScale,
+    *job.m_functor,
+    &out[0],
+    &tileStats,
+    false
+  );
+
+  for ( int r=tile.m_r0; r<tile.m_r1; ++r )
+  {
+    const int32_t* src = &out[ (r-tile.m_wr0)*w + (tile.m_c0-tile.m_wc0) ];
+    std::copy( src, src + (tile.m_c1-tile.m_c0), job.m_labels + r*job.m_cols + tile.m_c0 );
+  }
+  return tileStats;
+}
+
+template < typename JOB_TYPE >
+static void* pixelTileWorker( void* arg )
+{
+  JOB_TYPE& job = *static_cast< JOB_TYPE* >( arg );
+  for (;;)
+  {
+    pthread_mutex_lock( &job.m_mutex );
+    const size_t k = job.m_nextTile++;
+    const bool stop = k >= job.m_tiles.size() || !job.m_error.empty();
+    pthread_mutex_unlock( &job.m_mutex );
+    if ( stop )
+    {
+      break;
+    }
+
+    UflowStats tileStats;
+    std::string error;
+    try
+    {
+      if ( job.m_prevPrevLabels == NULL
+           || tileBorderChanged( job, job.m_tiles[k] ) )
+      {
+        tileStats = solvePixelTile( job, job.m_tiles[k] );
+      }
+    }
+    catch ( std::exception& e )
+    {
+      error = e.what();
+    }
+
+    pthread_mutex_lock( &job.m_mutex );
+    job.m_nbCuts        += tileStats.nbCuts;
+    job.m_flowSeconds   += tileStats.flowSeconds;
+    job.m_energySeconds += tileStats.energySeconds;
+    if ( !error.empty() && job.m_error.empty() )
+    {
+      job.m_error = error;
+    }
+    pthread_mutex_unlock( &job.m_mutex );
+  }
+  return NULL;
+}
+
+template < typename FUNCTOR_TYPE, typename IMG_TYPE, typename WEIGHT_TYPE >
+static void inferenceNTiledUsingTFunctor(
+  char*               method,
+  int                 nhoodSize,
+  int                 rows,
+  int                 cols,
+  int                 nbImgChannels,
+  int                 nbLabels,
+  const IMG_TYPE*     cMatInputImage,
+  const WEIGHT_TYPE*  cMatLabelWeights,
+  double              weightScale,
+  FUNCTOR_TYPE&       functor,
+  int                 tileSize,
+  int                 tileOverlap,
+  int                 nbThreads,
+  int                 maxPasses,
+  int32_t*            cMatOut,
+  UflowStats*         stats,
+  bool                verbose
+)
+{
+  typedef TiledInferenceJob< FUNCTOR_TYPE, IMG_TYPE, WEIGHT_TYPE > JobType;
+  typedef typename UflowTypes< WEIGHT_TYPE >::CapType CapType;
+  UflowLog log( verbose );
+  if ( tileSize <= 0 || tileOverlap < 0 || nbThreads <= 0 || maxPasses <= 0 )
+  {
+    throw( UflowException(
+        "inferenceNTiled: need tileSize, nbThreads, maxPasses > 0 and tileOverlap >= 0" ) );
+  }
+  const int npix = rows*cols;
+
+  JobType job;
+  job.m_method        = method;
+  job.m_nhoodSize     = nhoodSize;
+  job.m_rows          = rows;
+  job.m_cols          = cols;
+  job.m_nbImgChannels = nbImgChannels;
+  job.m_nbLabels      = nbLabels;
+  job.m_inputImage    = cMatInputImage;
+  job.m_labelWeights  = cMatLabelWeights;
+  job.m_weightScale   = weightScale;
+  job.m_functor       = &functor;
+  job.m_nbCuts        = 0;
+  job.m_flowSeconds   = 0.0;
+  job.m_energySeconds = 0.0;
+  job.m_labels        = cMatOut;
+  pthread_mutex_init( &job.m_mutex, NULL );
+  std::fill( cMatOut, cMatOut + npix, 0 );
+
+  for ( int r0=0; r0<rows; r0+=tileSize ){
+    for ( int c0=0; c0<cols; c0+=tileSize ){
+      PixelTile tile;
+      tile.m_r0  = r0;
+      tile.m_r1  = std::min( rows, r0 + tileSize );
+      tile.m_c0  = c0;
+      tile.m_c1  = std::min( cols, c0 + tileSize );
+      tile.m_wr0 = std::max( 0,    tile.m_r0 - tileOverlap );
+      tile.m_wr1 = std::min( rows, tile.m_r1 + tileOverlap );
+      tile.m_wc0 = std::max( 0,    tile.m_c0 - tileOverlap );
+      tile.m_wc1 = std::min( cols, tile.m_c1 + tileOverlap );
+      job.m_tiles.push_back( tile );
+    }
+  }
+  nbThreads = std::min( nbThreads, (int)job.m_tiles.size() );
+
+  log << "Tiled N-label inference, " << job.m_tiles.size() << " tiles, "
+            << nbThreads << " threads.\n";
+
+  std::vector< int32_t > prevLabels( npix, 0 );
+  std::vector< int32_t > prevPrevLabels( npix, 0 );
+  std::vector< pthread_t > threads( nbThreads );
+  int pass = 0;
+  for ( ; pass<maxPasses; ++pass )
+  {
+    prevPrevLabels.swap( prevLabels );
+    std::copy( cMatOut, cMatOut + npix, prevLabels.begin() );
+    job.m_prevLabels     = &prevLabels[0];
+    // Until the second pass the tiles have not all seen their borders.
+    job.m_prevPrevLabels = ( pass >= 2 ) ? &prevPrevLabels[0] : NULL;
+    job.m_pass           = pass;
+    job.m_nextTile       = 0;
+
+    int nbStarted = 0;
+    for ( ; nbStarted<nbThreads; ++nbStarted )
+    {
+      if ( pthread_create(
+          &threads[nbStarted], NULL, pixelTileWorker< JobType >, &job ) != 0 )
+      {
+        break;
+      }
+    }
+    if ( nbStarted == 0 )
+    {
+      // Could not start any threads, so do the work here.
+      pixelTileWorker< JobType >( &job );
+    }
+    for ( int k=0; k<nbStarted; ++k )
+    {
+      pthread_join( threads[k], NULL );
+    }
+    if ( !job.m_error.empty() )
+    {
+      pthread_mutex_destroy( &job.m_mutex );
+      throw( UflowException( job.m_error.c_str() ) );
+    }
+
+    int nbChanged = 0;
+    for ( int i=0; i<npix; ++i )
+    {
+      if ( cMatOut[i] != prevLabels[i] ) ++nbChanged;
+    }
+    log << "\t** tile pass " << pass << ", "
+              << nbChanged << " labels changed\n";
+    if ( pass > 0 && nbChanged == 0 )
+    {
+      ++pass;
+      break;
+    }
+  }
+  pthread_mutex_destroy( &job.m_mutex );
+
+  if ( stats )
+  {
+    PixelNbrEdges< CapType > nbrEdges;
+    computePixelNbrEdges(
+      nhoodSize, rows, cols, nbImgChannels, cMatInputImage, functor,
+      weightScale, nbrEdges
+    );
+    NodeEdgeIndex nodeEdges; // not needed by reset()
+    PixelPairwise< CapType > pairwise( nbrEdges );
+    EnergyTracker< PixelPairwise< CapType >, WEIGHT_TYPE > tracker(
+      npix, nbLabels, cMatLabelWeights, pairwise, nodeEdges
+    );
+    stats->nbIterations += pass;
+    stats->nbCuts        += job.m_nbCuts;
+    stats->flowSeconds   += job.m_flowSeconds;
+    stats->energySeconds += job.m_energySeconds;
+    stats->energy        = tracker.reset( npix, cMatOut ) / weightScale;
+  }
+}
+
 ////////////////////////////////////////////////////////////////////////////////
 // callback version
 void ultraflow_inferenceNCallback(
@@ -1032,25 +2284,36 @@ void ultraflow_inferenceNCallback(
     nbLabels,
     cMatInputImage,
     cMatLabelWeights,
+    1.0,
     functor,
-    cMatOut
+    cMatOut,
+    NULL
   );
 }
 
 ////////////////////////////////////////////////////////////////////////////////
-// non-callback version
-void ultraflow_inferenceN(
-  char*           method,
-  int             nhoodSize,
-  int             rows,
-  int             cols,
-  int             nbImgChannels,
-  int             nbLabels,
-  double*         cMatInputImage,
-  double*         cMatLabelWeights,
-  char*           nbrPotentialMethod, 
-  double*         nbrPotentialParams,
-  int32_t*        cMatOut
+// Builds the nbr potential functor, then solves the whole image, or in tiles if
+// tileSize > 0.
+template < typename IMG_TYPE, typename WEIGHT_TYPE >
+static void inferenceNByNbrPotential(
+  char*               method,
+  int                 nhoodSize,
+  int                 rows,
+  int                 cols,
+  int                 nbImgChannels,
+  int                 nbLabels,
+  const IMG_TYPE*     cMatInputImage,
+  const WEIGHT_TYPE*  cMatLabelWeights,
+  double              weightScale,
+  char*               nbrPotentialMethod, 
+  double*             nbrPotentialParams,
+  int                 tileSize,
+  int                 tileOverlap,
+  int                 nbThreads,
+  int                 maxPasses,
+  int32_t*            cMatOut,
+  UflowStats*         stats,
+  bool                verbose
 )
 {
   if ( nbrPotentialMethod == std::string("contrastSensitive") )
@@ -1060,18 +2323,22 @@ void ultraflow_inferenceN(
     double K  = nbrPotentialParams[1];
     double sigmaSq = nbrPotentialParams[2];
     NbrPotentialFunctorContrastSensitive functor( K0, K, sigmaSq );
-    inferenceNUsingTFunctor(
-      method,
-      nhoodSize,
-      rows,
-      cols,
-      nbImgChannels,
-      nbLabels,
-      cMatInputImage,
-      cMatLabelWeights,
-      functor,
-      cMatOut
-    );
+    if ( tileSize > 0 )
+    {
+      inferenceNTiledUsingTFunctor(
+        method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+        cMatInputImage, cMatLabelWeights, weightScale, functor,
+        tileSize, tileOverlap, nbThreads, maxPasses, cMatOut, stats, verbose
+      );
+    }
+    else
+    {
+      inferenceNUsingTFunctor(
+        method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+        cMatInputImage, cMatLabelWeights, weightScale, functor,
+        cMatOut, stats, verbose
+      );
+    }
   }
   else if ( nbrPotentialMethod == std::string("edge") )
   {
@@ -1079,18 +2346,22 @@ void ultraflow_inferenceN(
     double K0 = nbrPotentialParams[0];
     double K  = nbrPotentialParams[1];
     NbrPotentialFunctorEdge functor( K0, K );
-    inferenceNUsingTFunctor(
-      method,
-      nhoodSize,
-      rows,
-      cols,
-      nbImgChannels,
-      nbLabels,
-      cMatInputImage,
-      cMatLabelWeights,
-      functor,
-      cMatOut
-    );
+    if ( tileSize > 0 )
+    {
+      inferenceNTiledUsingTFunctor(
+        method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+        cMatInputImage, cMatLabelWeights, weightScale, functor,
+        tileSize, tileOverlap, nbThreads, maxPasses, cMatOut, stats, verbose
+      );
+    }
+    else
+    {
+      inferenceNUsingTFunctor(
+        method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+        cMatInputImage, cMatLabelWeights, weightScale, functor,
+        cMatOut, stats, verbose
+      );
+    }
   }
   else
   {
@@ -1098,6 +2369,179 @@ void ultraflow_inferenceN(
           + std::string(nbrPotentialMethod) + "'").c_str() ) );
   }
 }
+
+static void checkTileSize( int tileSize )
+{
+  if ( tileSize <= 0 )
+  {
+    throw( UflowException( "inferenceNTiled: need tileSize > 0" ) );
+  }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// non-callback version
+void ultraflow_inferenceN(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  double*         cMatInputImage,
+  double*         cMatLabelWeights,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
+)
+{
+  inferenceNByNbrPotential(
+    method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+    cMatInputImage, cMatLabelWeights, 1.0,
+    nbrPotentialMethod, nbrPotentialParams, 0, 0, 1, 1, cMatOut, stats, verbose
+  );
+}
+
+// float32 version: half the memory for the unaries, and float capacities.
+void ultraflow_inferenceN(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  float*          cMatLabelWeights,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
+)
+{
+  inferenceNByNbrPotential(
+    method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+    cMatInputImage, cMatLabelWeights, 1.0,
+    nbrPotentialMethod, nbrPotentialParams, 0, 0, 1, 1, cMatOut, stats, verbose
+  );
+}
+
+// int16 version: the unaries are round( weightScale * potential ), and the nbr
+// potentials are scaled and rounded to match.  Integer capacities.
+void ultraflow_inferenceN(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  int16_t*        cMatLabelWeights,
+  double          weightScale,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
+)
+{
+  inferenceNByNbrPotential(
+    method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+    cMatInputImage, cMatLabelWeights, weightScale,
+    nbrPotentialMethod, nbrPotentialParams, 0, 0, 1, 1, cMatOut, stats, verbose
+  );
+}
+    
+////////////////////////////////////////////////////////////////////////////////
+// non-callback tiled version
+void ultraflow_inferenceNTiled(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  double*         cMatInputImage,
+  double*         cMatLabelWeights,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int             tileSize,
+  int             tileOverlap,
+  int             nbThreads,
+  int             maxPasses,
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
+)
+{
+  checkTileSize( tileSize );
+  inferenceNByNbrPotential(
+    method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+    cMatInputImage, cMatLabelWeights, 1.0,
+    nbrPotentialMethod, nbrPotentialParams,
+    tileSize, tileOverlap, nbThreads, maxPasses, cMatOut, stats, verbose
+  );
+}
+
+void ultraflow_inferenceNTiled(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  float*          cMatLabelWeights,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int             tileSize,
+  int             tileOverlap,
+  int             nbThreads,
+  int             maxPasses,
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
+)
+{
+  checkTileSize( tileSize );
+  inferenceNByNbrPotential(
+    method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+    cMatInputImage, cMatLabelWeights, 1.0,
+    nbrPotentialMethod, nbrPotentialParams,
+    tileSize, tileOverlap, nbThreads, maxPasses, cMatOut, stats, verbose
+  );
+}
+
+void ultraflow_inferenceNTiled(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  int16_t*        cMatLabelWeights,
+  double          weightScale,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int             tileSize,
+  int             tileOverlap,
+  int             nbThreads,
+  int             maxPasses,
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
+)
+{
+  checkTileSize( tileSize );
+  inferenceNByNbrPotential(
+    method, nhoodSize, rows, cols, nbImgChannels, nbLabels,
+    cMatInputImage, cMatLabelWeights, weightScale,
+    nbrPotentialMethod, nbrPotentialParams,
+    tileSize, tileOverlap, nbThreads, maxPasses, cMatOut, stats, verbose
+  );
+}
     
 ////////////////////////////////////////////////////////////////////////////////
 // non-callback version
@@ -1111,7 +2555,9 @@ void ultraflow_inferenceSuperPixel(
   double*         cMatAdjProbs, // can be null
   char*           nbrPotentialMethod,
   double          K,
-  int32_t*        cMatOut
+  int32_t*        cMatOut,
+  UflowStats*     stats,
+  bool            verbose
 )
 {
   if ( nbrPotentialMethod == std::string("degreeSensitive") )
@@ -1125,7 +2571,9 @@ void ultraflow_inferenceSuperPixel(
       cMatEdges,
       cMatLabelWeights,
       functor,
-      cMatOut
+      cMatOut,
+      stats,
+      verbose
     );
   }
   else if ( nbrPotentialMethod == std::string("adjacencyAndDegreeSensitive") )
@@ -1142,7 +2590,9 @@ void ultraflow_inferenceSuperPixel(
       cMatEdges,
       cMatLabelWeights,
       functor,
-      cMatOut
+      cMatOut,
+      stats,
+      verbose
     );
   }
   else
@@ -2,6 +2,21 @@
 #include <exception>
 #include <string>
 
+// Counters filled in by the N-label inference functions, if given.  Those
+// functions also take a verbose flag, which turns their progress output on or
+// off.
+struct UflowStats
+{
+  UflowStats() : nbIterations(0), nbCuts(0), energy(0.0), flowSeconds(0.0),
+                 energySeconds(0.0) {}
+
+  int    nbIterations;  // sweeps over the labels (or label pairs)
+  int    nbCuts;        // max-flow computations
+  double energy;        // energy of the final labelling
+  double flowSeconds;   // time in the max-flow moves, summed over threads
+  double energySeconds; // time evaluating move energies
+};
+
 typedef double (*NbrCallbackType)(
   double  pixR, double pixG, double pixB,
   double  nbrR, double nbrG, double nbrB,
@@ -52,7 +67,113 @@ extern void ultraflow_inferenceN(
   double*         cMatLabelWeights,
   char*           nbrPotentialMethod, 
   double*         nbrPotentialParams,
-  int32_t*        cMatOut
+  int32_t*        cMatOut,
+  UflowStats*     stats = NULL,
+  bool            verbose = true
+);
+
+// Reduced precision versions.  float32 unaries use float capacities.  int16
+// unaries are round( weightScale * potential ); the nbr potentials are scaled
+// by weightScale and rounded to match, and the capacities are int.  The energy
+// in stats is divided by weightScale again.
+extern void ultraflow_inferenceN(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  float*          cMatLabelWeights,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int32_t*        cMatOut,
+  UflowStats*     stats = NULL,
+  bool            verbose = true
+);
+
+extern void ultraflow_inferenceN(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  int16_t*        cMatLabelWeights,
+  double          weightScale,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int32_t*        cMatOut,
+  UflowStats*     stats = NULL,
+  bool            verbose = true
+);
+
+// Non-callback tiled version, for large images.  The image is cut into
+// tileSize x tileSize tiles that are solved in parallel by nbThreads threads,
+// each over a window tileOverlap pixels bigger on each side.  Further passes
+// fix the labels outside each window at the previous pass's result, until no
+// label changes or maxPasses passes are done.  In stats, nbIterations counts
+// passes.
+extern void ultraflow_inferenceNTiled(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  double*         cMatInputImage,
+  double*         cMatLabelWeights,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int             tileSize,
+  int             tileOverlap,
+  int             nbThreads,
+  int             maxPasses,
+  int32_t*        cMatOut,
+  UflowStats*     stats = NULL,
+  bool            verbose = true
+);
+
+extern void ultraflow_inferenceNTiled(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  float*          cMatLabelWeights,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int             tileSize,
+  int             tileOverlap,
+  int             nbThreads,
+  int             maxPasses,
+  int32_t*        cMatOut,
+  UflowStats*     stats = NULL,
+  bool            verbose = true
+);
+
+extern void ultraflow_inferenceNTiled(
+  char*           method,
+  int             nhoodSize,
+  int             rows,
+  int             cols,
+  int             nbImgChannels,
+  int             nbLabels,
+  float*          cMatInputImage,
+  int16_t*        cMatLabelWeights,
+  double          weightScale,
+  char*           nbrPotentialMethod, 
+  double*         nbrPotentialParams,
+  int             tileSize,
+  int             tileOverlap,
+  int             nbThreads,
+  int             maxPasses,
+  int32_t*        cMatOut,
+  UflowStats*     stats = NULL,
+  bool            verbose = true
 );
 
 // Non-callback superpixel inference.
@@ -69,9 +190,16 @@ extern void ultraflow_inferenceSuperPixel(
   double*         cMatAdjProbs, // can be null
   char*           nbrPotentialMethod,
   double          K, //      double* nbrPotentialParams,
-  int32_t*        cMatOut
+  int32_t*        cMatOut,
+  UflowStats*     stats = NULL,
+  bool            verbose = true
 );
 
+// Debugging: if set, the N-label inference functions check the energy they
+// track incrementally against a full recompute after every move, and throw a
+// UflowException if they differ.
+extern void ultraflow_setCheckEnergy( bool check );
+
 class UflowException: public std::exception
 {
   public:
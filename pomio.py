@@ -1,11 +1,16 @@
 # Module for image and data i/o
 import amntools
+import arrayCache
 import glob
 import pylab
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
 import pickle
+import struct
+import collections
+import hashlib
+import os
 
 import skimage.io
 
@@ -68,10 +73,89 @@ def getNumClasses():
 def getClasses():
     return msrc_classLabels
 
-def msrc_convertRGBToLabels( imgRGB, fn='' ):
+# Colours are packed into 24 bit keys, R<<16 | G<<8 | B.  Each colour map gets
+# a 2^24 entry key -> label table (16MB, built on first use), and a 256 entry
+# label -> colour palette that is black after the colour map's classes.
+_labelCodecs = {}
+
+def _getLabelCodec( colourMap ):
+    clrs = tuple( ctuple[1] for ctuple in colourMap )
+    codec = _labelCodecs.get( clrs )
+    if codec is None:
+        assert len(clrs) < 255, 'Too many classes for uint8 labels'
+        palette = np.zeros( (256,3), dtype='uint8' )
+        palette[ :len(clrs) ] = clrs
+        table = np.empty( 1<<24, dtype='uint8' )
+        table.fill( 255 )
+        table[ rgbToKeys( palette[ :len(clrs) ] ) ] = np.arange( len(clrs) )
+        codec = ( table, palette )
+        _labelCodecs[ clrs ] = codec
+    return codec
+
+def rgbToKeys( imgRGB ):
+    imgRGB = np.asarray( imgRGB )
+    res = imgRGB[...,0].astype('uint32') << 16
+    res |= imgRGB[...,1].astype('uint32') << 8
+    res |= imgRGB[...,2]
+    return res
+
+# Pixels with colours not in colourMap are set to void for the MSRC colours,
+# and to 255 otherwise.
+def msrc_convertRGBToLabels( imgRGB, fn='', colourMap = msrc_classToRGB ):
+    table, palette = _getLabelCodec( colourMap )
+    imgL = table[ rgbToKeys( imgRGB ) ]
+    dodgyMsk = (imgL==255)
+    if colourMap is msrc_classToRGB and np.any( dodgyMsk ):
+        s = '' if fn=='' else ' in image '+fn
+        print '  WARNING: there are %d pixels with invalid colours%s.  Setting these to void. (might be the deleted classes?)' % (dodgyMsk.sum(), s)
+        imgL[ dodgyMsk ] = getVoidIdx()
+    return imgL
+
+# Decoded label images are cached on disk as .npy files in labelCacheDir, keyed
+# by the colour image's path, mtime and size and by the colour map.  Set
+# labelCacheDir to None (or the environment variable AMN_LABEL_CACHE_DIR to '')
+# to always decode.
+labelCacheDir = os.environ.get( 'AMN_LABEL_CACHE_DIR', \
+                                  os.path.expanduser( '~/.cache/alienMarkovNetworks/labels' ) )
+
+def labelCacheFilename( fn, colourMap = msrc_classToRGB ):
+    st = os.stat( fn )
+    key = repr( ( os.path.abspath( fn ), st.st_mtime, st.st_size, \
+                    tuple( ctuple[1] for ctuple in colourMap ) ) )
+    base = os.path.splitext( os.path.basename( fn ) )[0]
+    return os.path.join( labelCacheDir, '%s_%s.npy' % ( base, hashlib.sha1( key ).hexdigest() ) )
+
+# Reads a label colour image (such as a ground truth) as a uint8 label image,
+# through the on-disk cache.  Raises IOError if fn isn't there.
+def msrc_readLabelImage( fn, colourMap = msrc_classToRGB ):
+    if not labelCacheDir or not os.path.isfile( fn ):
+        return msrc_convertRGBToLabels( amntools.readImage( fn ), fn, colourMap )
+    cacheFn = labelCacheFilename( fn, colourMap )
+    if os.path.isfile( cacheFn ):
+        try:
+            return np.load( cacheFn )
+        except ( IOError, ValueError ):
+            # Damaged, so decode it again.
+            pass
+    imgL = msrc_convertRGBToLabels( amntools.readImage( fn ), fn, colourMap )
+    # The cache is best effort.
+    arrayCache.writeAtomically( cacheFn, lambda f: np.save( f, imgL ) )
+    return imgL
+
+# Labels not in colourMap are black.
+def msrc_convertLabelsToRGB( imgL, colourMap = msrc_classToRGB ):
+    assert imgL.ndim == 2 
+    table, palette = _getLabelCodec( colourMap )
+    if imgL.dtype != np.uint8:
+        imgL = np.where( np.logical_and( imgL >= 0, imgL < 256 ), imgL, 255 )
+    return palette[ imgL ]
+
+# The original per-class mask implementations.  They are kept as the reference
+# for the lookup table versions above, see benchLabelCodec.py.
+def msrc_convertRGBToLabelsMasks( imgRGB, fn='', colourMap = msrc_classToRGB ):
     imgL = 255 * np.ones( imgRGB.shape[0:2], dtype='uint8' )
     # For each label, find matching RGB and set that value
-    for l,ctuple in enumerate(msrc_classToRGB):
+    for l,ctuple in enumerate(colourMap):
         # Get a mask of matching pixels
         clr = ctuple[1]
         msk = np.logical_and( imgRGB[:,:,0]==clr[0], \
@@ -79,17 +163,14 @@ def msrc_convertRGBToLabels( imgRGB, fn='' ):
                                                       imgRGB[:,:,2]==clr[2] ) )
         # Set these in the output image
         imgL[msk] = l
-    # Check we got every pixel
-    #plt.imshow(imgL==255)
-    #plt.show()
     dodgyMsk = (imgL==255)
-    if np.any( dodgyMsk ):
+    if colourMap is msrc_classToRGB and np.any( dodgyMsk ):
         s = '' if fn=='' else ' in image '+fn
         print '  WARNING: there are %d pixels with invalid colours%s.  Setting these to void. (might be the deleted classes?)' % (dodgyMsk.sum(), s)
         imgL[ dodgyMsk ] = getVoidIdx()
     return imgL
 
-def msrc_convertLabelsToRGB( imgL, colourMap = msrc_classToRGB ):
+def msrc_convertLabelsToRGBMasks( imgL, colourMap = msrc_classToRGB ):
     assert imgL.ndim == 2 
     imgRGB = np.zeros( imgL.shape + (3,), dtype='uint8' )
     # For each label, find matching RGB and set that value
@@ -102,55 +183,122 @@ def msrc_convertLabelsToRGB( imgL, colourMap = msrc_classToRGB ):
             x[msk] = clr[i]
     return imgRGB
 
+class LRUCache:
+    'Dictionary holding at most maxItems items, dropping the least recently used'
+
+    def __init__( self, maxItems ):
+        assert maxItems > 0
+        self.m_maxItems = maxItems
+        self.m_items = collections.OrderedDict()
+
+    def get( self, key, default=None ):
+        if key not in self.m_items:
+            return default
+        # Move to the most recently used end.
+        value = self.m_items.pop( key )
+        self.m_items[ key ] = value
+        return value
+
+    def put( self, key, value ):
+        if key in self.m_items:
+            del self.m_items[ key ]
+        elif len( self.m_items ) >= self.m_maxItems:
+            self.m_items.popitem( last=False )
+        self.m_items[ key ] = value
+
+    def __len__( self ):
+        return len( self.m_items )
+
+    def clear( self ):
+        self.m_items.clear()
+
 class LabelledImage:
-    'Structure containing image and ground truth from MSRC v2 data set'
-    m_img = None
-    m_gt  = None
-    m_hq  = None
+    """Structure containing image and ground truth from MSRC v2 data set.  Only
+    the filenames are stored; m_img, m_gt and m_hq are read when first used.  If
+    a cache is given they are kept in it, otherwise on the object.  Pickles
+    without the images, so can be sent to a worker process that reads them."""
     m_imgFn = None
     m_gtFn  = None
     m_hqFn  = None
 
-    def __init__( self,  fn, gtfn, hqfn, verbose=False ):
-        # load the image (as numpy nd array, 8bit)
-        if verbose:
-            print 'Loading image ', fn
-        self.m_img = amntools.readImage( fn )
-        if verbose:
-            print 'Loading gt image ', gtfn
-        self.m_gt  = msrc_convertRGBToLabels( amntools.readImage( gtfn ), gtfn )
+    def __init__( self,  fn, gtfn, hqfn, verbose=False, cache=None ):
+        self.m_imgFn = fn
+        self.m_gtFn  = gtfn
+        self.m_hqFn  = hqfn
+        self.m_verbose = verbose
+        self.m_cache = cache
+
+    def __getattr__( self, name ):
+        # Only called for attributes that aren't set.
+        if name not in ( 'm_img', 'm_gt', 'm_hq' ):
+            raise AttributeError( name )
+        if self.m_cache == None:
+            value = self.__load( name )
+            self.__dict__[ name ] = value
+            return value
+        key = ( self.m_imgFn, name )
+        value = self.m_cache.get( key, LabelledImage )
+        if value is LabelledImage:
+            value = self.__load( name )
+            self.m_cache.put( key, value )
+        return value
+
+    def __load( self, name ):
+        if name == 'm_img':
+            # load the image (as numpy nd array, 8bit)
+            if self.m_verbose:
+                print 'Loading image ', self.m_imgFn
+            return amntools.readImage( self.m_imgFn )
+        elif name == 'm_gt':
+            if self.m_verbose:
+                print 'Loading gt image ', self.m_gtFn
+            return msrc_readLabelImage( self.m_gtFn )
         # not necessarily hq
         try:
-            #self.m_hq  = msrc_convertRGBToLabels( pylab.imread( hqfn ) )
-            if verbose:
-                print 'Looking for high quality gt image ', hqfn
-            self.m_hq  = msrc_convertRGBToLabels( amntools.readImage( hqfn ) )
-            if verbose:
+            if self.m_verbose:
+                print 'Looking for high quality gt image ', self.m_hqFn
+            hq = msrc_readLabelImage( self.m_hqFn )
+            if self.m_verbose:
                 print '   - found'
+            return hq
         except IOError:
-            if verbose:
+            if self.m_verbose:
                 print '   - not found'
-            self.m_hq = None
-        self.m_imgFn = fn
-        self.m_gtFn  = gtfn
-        self.m_hqFn  = hqfn
-   
+            return None
+
+    def __getstate__( self ):
+        # Just the filenames.
+        return { 'm_imgFn': self.m_imgFn, 'm_gtFn': self.m_gtFn, 'm_hqFn': self.m_hqFn,
+                 'm_verbose': self.m_verbose, 'm_cache': None }
+
+# Returns the image array of a LabelledImage, read in this process if need be,
+# or x itself if it is already an image.
+def msrc_imageOf( x ):
+    if isinstance( x, LabelledImage ):
+        return x.m_img
+    return x
+
+# The default number of decoded images (or ground truths) msrc_loadImages keeps.
+defaultImageCacheSize = 64
+
 # dataSetPath is the base directory for the data set (subdirs are under this)
-# Returns a list of msrc_image objects.  subset should be a list of 
-# filenames of the original image, relative to dataSetPath.
-def msrc_loadImages( dataSetPath, subset=None, vbs=False ):
+# Returns a list of LabelledImage objects, which read their images on first use
+# and share an LRU cache of up to cacheSize decoded images.  subset should be a
+# list of filenames of the original image, relative to dataSetPath.
+def msrc_loadImages( dataSetPath, subset=None, vbs=False, cacheSize=defaultImageCacheSize ):
     res = []
     if subset == None:
         subset = glob.glob( dataSetPath + '/Images/*.bmp' ) + glob.glob( dataSetPath + '/Images/*.png' )
     else:
         subset = [ dataSetPath + '/' + fn for fn in subset ]
+    cache = LRUCache( cacheSize )
     # For each image file:
     for fn in subset:
-        # load the ground truth, convert to discrete label
+        # the ground truth is converted to discrete labels when it is read
         gtfn = fn.replace('Images/', 'GroundTruth/').replace('.','_GT.')
         hqfn = fn.replace('Images/', 'SegmentationsGTHighQuality/').replace('.','_HQGT.')
         # create an image object, stuff in list
-        res.append( LabelledImage( fn, gtfn, hqfn, verbose=vbs ) )
+        res.append( LabelledImage( fn, gtfn, hqfn, verbose=vbs, cache=cache ) )
         #break
     assert len(res) > 0, 'zarro images loaded.  subset = %s' % subset
     return res
@@ -434,6 +582,110 @@ def unpickleObject(fullFilename):
   return object
 
 
+#
+# Append-only feature store.
+#
+# Feature and label matrices are streamed to disk a block of rows at a time
+# (e.g. one block per image), as version 1.0 .npy files.  They can be opened
+# with np.load(fn, mmap_mode='r') without reading them into memory.  A csv
+# index records which rows came from which image:
+#
+#    imageName,startRow,endRow
+#
+# The .npy header is a fixed size and rewritten with the final number of rows on
+# close, so the data can be appended without knowing the row count up front.
+#
+
+npyHeaderLen = 128
+
+def writeNpyHeader( f, dtype, shape ):
+  if len(shape) == 1:
+    shapeStr = '(%d,)' % shape[0]
+  else:
+    shapeStr = '(' + ', '.join( [ '%d' % z for z in shape ] ) + ')'
+  hdr = "{'descr': '%s', 'fortran_order': False, 'shape': %s, }" % \
+      ( np.dtype(dtype).str, shapeStr )
+  # magic, version 1.0, header length, then the header dict padded with spaces
+  # and ending in a newline.
+  hlen = npyHeaderLen - 10
+  assert len(hdr) < hlen, 'npy header too long: ' + hdr
+  f.seek(0)
+  f.write( '\x93NUMPY\x01\x00' + struct.pack( '<H', hlen ) + hdr.ljust( hlen-1 ) + '\n' )
+
+class NpyAppendWriter:
+  'Writes a .npy file one block of rows at a time.  Rows have shape rowShape.'
+  def __init__( self, fn, rowShape, dtype ):
+    assert fn.endswith('.npy')
+    self.m_fn = fn
+    self.m_rowShape = tuple(rowShape)
+    self.m_dtype = np.dtype(dtype)
+    self.m_nbRows = 0
+    self.m_file = open( fn, 'wb' )
+    writeNpyHeader( self.m_file, self.m_dtype, (0,) + self.m_rowShape )
+
+  def append( self, block ):
+    block = np.ascontiguousarray( block, dtype=self.m_dtype )
+    assert block.shape[1:] == self.m_rowShape, \
+        'block has shape %s, expecting rows of %s' % (str(block.shape), str(self.m_rowShape))
+    block.tofile( self.m_file )
+    self.m_nbRows += block.shape[0]
+
+  def close( self ):
+    writeNpyHeader( self.m_file, self.m_dtype, (self.m_nbRows,) + self.m_rowShape )
+    self.m_file.close()
+
+class FeatureStoreWriter:
+  'Streams per-image feature and label blocks to .npy files, with an index csv.'
+  def __init__( self, ftrsFn, labsFn, indexFn, dim, ftrsDtype=float ):
+    self.m_ftrs = NpyAppendWriter( ftrsFn, (dim,), ftrsDtype )
+    self.m_labs = NpyAppendWriter( labsFn, (), np.int32 )
+    self.m_index = open( indexFn, 'w' )
+
+  def append( self, name, ftrs, labs ):
+    assert ftrs.shape[0] == len(labs)
+    start = self.m_ftrs.m_nbRows
+    self.m_ftrs.append( ftrs )
+    self.m_labs.append( labs )
+    self.m_index.write( '%s,%d,%d\n' % ( name, start, self.m_ftrs.m_nbRows ) )
+
+  def getNumRows( self ):
+    return self.m_ftrs.m_nbRows
+
+  def close( self ):
+    self.m_ftrs.close()
+    self.m_labs.close()
+    self.m_index.close()
+
+# Returns a list of (imageName, startRow, endRow)
+def readFeatureStoreIndex( indexFn ):
+  res = []
+  f = open( indexFn, 'r' )
+  for line in f.read().splitlines():
+    if len(line) > 0:
+      name, start, end = line.rsplit( ',', 2 )
+      res.append( ( name, int(start), int(end) ) )
+  f.close()
+  return res
+
+# Feature matrix from a pkl, npy or csv file.  npy files are memory mapped.
+def readFeatureData( fn ):
+  if fn.endswith('.pkl'):
+    return unpickleObject( fn )
+  elif fn.endswith('.npy'):
+    return np.load( fn, mmap_mode='r' )
+  else:
+    return readMatFromCSV( fn )
+
+# Label vector from a pkl, npy or csv file.
+def readLabelData( fn ):
+  if fn.endswith('.pkl'):
+    return unpickleObject( fn )
+  elif fn.endswith('.npy'):
+    return np.load( fn, mmap_mode='r' )
+  else:
+    return readMatFromCSV( fn ).astype(np.int32)
+
+
 def readEvaluationListFromCsv(evalListFile):
 # lines = pomio.readEvaluationListFromCsv("/home/amb/dev/mrf/data/eval/evalList.csv")
 
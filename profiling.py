@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import atexit
+import collections
+
+"""
+Stage timers and counters for the command-line tools.  Off unless the
+environment variable AMN_PROFILE is set to a filename, or enable() is called.
+When on, each item (usually an image) is written to that file as a line of JSON
+with the time spent in each stage, the number of calls and any counts, and at
+exit a summary line with the totals over all the items of the run is added.
+Worker processes write their own items to the same file.  The stats of the
+last item are also kept, see lastItemTimes(), and enable() without a file
+keeps just those.  When off, timer() returns a shared do-nothing object and
+count() returns at once.
+
+    with profiling.item( imgFn ):
+      with profiling.timer( 'slic' ):
+        ...
+"""
+
+_on = False
+_outFn = None
+_runId = None
+_mainPid = None
+# Stats of the item in progress, and how deeply items are nested.
+_stats = None
+_depth = 0
+_itemName = None
+_itemT0 = None
+_lastItem = None
+
+def _newStats():
+  return { 'times': collections.defaultdict( float ),
+           'calls': collections.defaultdict( int ),
+           'counts': collections.defaultdict( int ) }
+
+def enabled():
+  return _on
+
+# Turns profiling on, appending to outFn if it is given.
+def enable( outFn=None ):
+  global _on, _outFn, _runId, _mainPid, _stats
+  first = _mainPid == None
+  _on = True
+  _outFn = outFn
+  _mainPid = os.getpid()
+  _runId = '%d-%d' % ( _mainPid, int( time.time()*1000 ) )
+  _stats = _newStats()
+  if first:
+    atexit.register( _writeSummary )
+
+def disable():
+  global _on, _outFn
+  _on = False
+  _outFn = None
+
+class _NullTimer:
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, *exc ):
+    return False
+
+_nullTimer = _NullTimer()
+
+class _Timer:
+  def __init__( self, name ):
+    self.m_name = name
+
+  def __enter__( self ):
+    self.m_t0 = time.time()
+    return self
+
+  def __exit__( self, *exc ):
+    addTime( self.m_name, time.time() - self.m_t0 )
+    return False
+
+# Context manager adding the time spent in it to stage name.
+def timer( name ):
+  if not _on:
+    return _nullTimer
+  return _Timer( name )
+
+def addTime( name, seconds, calls=1 ):
+  if not _on:
+    return
+  _stats['times'][name] += seconds
+  _stats['calls'][name] += calls
+
+def count( name, n=1 ):
+  if not _on:
+    return
+  _stats['counts'][name] += n
+
+# Adds the stats from cython_uflow returnStats=True.
+def addInferenceStats( stats ):
+  if not _on:
+    return
+  addTime( 'maxflow', stats.get( 'flowSeconds', 0.0 ), stats['nbCuts'] )
+  addTime( 'energy', stats.get( 'energySeconds', 0.0 ), 0 )
+  count( 'cuts', stats['nbCuts'] )
+  count( 'iterations', stats['nbIterations'] )
+
+# Calls the cython_uflow inference function fn, timing it and asking it for its
+# stats if profiling is on.  Returns what fn returns without returnStats.
+def inference( fn, *args, **kwargs ):
+  if not _on:
+    return fn( *args, **kwargs )
+  kwargs[ 'returnStats' ] = True
+  with timer( 'inference' ):
+    res, stats = fn( *args, **kwargs )
+  addInferenceStats( stats )
+  return res
+
+def _write( record ):
+  if _outFn == None:
+    return
+  record[ 'run' ] = _runId
+  record[ 'pid' ] = os.getpid()
+  # One short write per line, so lines from several processes don't mix.
+  with open( _outFn, 'a' ) as f:
+    f.write( json.dumps( record ) + '\n' )
+
+# Starts the work on one item (usually an image), which is written as one line
+# by the matching endItem.  Nested items are part of the outermost one.
+def beginItem( name ):
+  global _stats, _depth, _itemName, _itemT0
+  if not _on:
+    return
+  _depth += 1
+  if _depth == 1:
+    _stats = _newStats()
+    _itemName = name
+    _itemT0 = time.time()
+
+def endItem():
+  global _stats, _depth, _lastItem
+  if not _on or _depth == 0:
+    return
+  _depth -= 1
+  if _depth == 0:
+    _stats['times']['total'] += time.time() - _itemT0
+    _write( { 'item': _itemName, 'times': _stats['times'],
+              'calls': _stats['calls'], 'counts': _stats['counts'] } )
+    _lastItem = _stats
+    _stats = _newStats()
+
+# Dict of the seconds spent in each stage of the last item ended by this
+# process, including 'total' for the whole item.  Empty if profiling is off.
+def lastItemTimes():
+  if not _on or _lastItem == None:
+    return {}
+  return dict( _lastItem['times'] )
+
+class _Item:
+  def __init__( self, name ):
+    self.m_name = name
+
+  def __enter__( self ):
+    beginItem( self.m_name )
+    return self
+
+  def __exit__( self, *exc ):
+    endItem()
+    return False
+
+# Context manager for beginItem and endItem.
+def item( name ):
+  if not _on:
+    return _nullTimer
+  return _Item( name )
+
+# Totals of the items of this run in the file, from all processes, plus any
+# stats recorded outside of items.
+def _writeSummary():
+  if _outFn == None or os.getpid() != _mainPid:
+    return
+  totals = _newStats()
+  nbItems = 0
+  try:
+    with open( _outFn ) as f:
+      for line in f:
+        rec = json.loads( line )
+        if rec.get( 'run' ) != _runId or 'item' not in rec:
+          continue
+        nbItems += 1
+        for k in totals:
+          for name, v in rec[k].items():
+            totals[k][name] += v
+  except ( IOError, ValueError ):
+    pass
+  for k in totals:
+    for name, v in _stats[k].items():
+      totals[k][name] += v
+  _write( { 'summary': True, 'nbItems': nbItems, 'times': totals['times'],
+            'calls': totals['calls'], 'counts': totals['counts'] } )
+
+if os.environ.get( 'AMN_PROFILE' ):
+  enable( os.environ[ 'AMN_PROFILE' ] )
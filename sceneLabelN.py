@@ -25,6 +25,8 @@ parser.add_argument('infile', type=str, action='store', \
 parser.add_argument('--outfile', type=str, action='store', \
                         help='filename of output image with MRF inferred labels')
 parser.add_argument('--verbose', action='store_true')
+parser.add_argument('--profile', type=str, action='store', \
+                        help='append stage timings as JSON lines to this file (see profiling.py)')
 parser.add_argument('--interactive', action='store_true')
 parser.add_argument('--K0', type=float, action='store', default=0.0, \
                         help='Offset for pairwise potential term in MRF.  Discourages isolated pixels.')
@@ -32,6 +34,18 @@ parser.add_argument('--K', type=float, action='store', default=0.1, \
                         help='Weighting for pairwise potential term in MRF.')
 parser.add_argument('--nhoodSz', type=int, action='store', default=4, \
                         help='Neighbourhood connectivity for graph, must be 4 or 8.')
+parser.add_argument('--inferenceMethod', type=str, action='store', \
+                        choices=['abswap', 'aexpansion'], default='abswap',\
+                        help='Move-making algorithm for MRF inference.')
+parser.add_argument('--tileSize', type=int, action='store', default=0, \
+                        help='If > 0, do the MRF inference in tiles of this size, in parallel.  For large images.')
+parser.add_argument('--nbThreads', type=int, action='store', default=1, \
+                        help='Number of threads for tiled MRF inference.')
+parser.add_argument('--unaryType', type=str, action='store', \
+                        choices=['float64', 'float32', 'int16'], default='float64',\
+                        help='Type of the unary potentials for MRF inference.  float32 and int16 use less memory.')
+parser.add_argument('--unaryScale', type=float, action='store', default=1000.0, \
+                        help='Scale for int16 unary potentials, which are rounded to 1/unaryScale.  Potentials are at most -log(1E-10) = 23, so must be < 1400.')
 parser.add_argument('--nbrPotentialMethod', type=str, action='store', \
                         choices=['contrastSensitive', 'edge'], default='contrastSensitive',\
                         help='Neighbour potential method.')
@@ -54,10 +68,14 @@ import sklearn
 import sklearn.ensemble
 import pomio
 import isprs
+import profiling
 
 # parse args
 clfrFn = args.clfrFn 
 imgFn = args.infile
+if args.profile:
+  profiling.enable( args.profile )
+profiling.beginItem( imgFn )
 
 dbgMode = 0
 
@@ -175,14 +193,27 @@ nbrPotentialParams = [args.K0,args.K,sigsq]
 
 #print 'size of class probs = ', classProbs.shape
 
-segResult = uflow.inferenceN( \
-    imgRGB.astype(float),\
-    -np.log( np.maximum(1E-10, np.ascontiguousarray(classProbs) ) ), \
-    'abswap',\
+# The reduced precision types are computed in float32, and use a float32 image.
+if args.unaryType == 'float64':
+  floatType = np.float64
+else:
+  floatType = np.float32
+unaries = -np.log( np.maximum(1E-10, np.ascontiguousarray(classProbs, dtype=floatType) ) )
+weightScale = None
+if args.unaryType == 'int16':
+  weightScale = args.unaryScale
+  unaries = np.round( weightScale * unaries ).astype(np.int16)
+
+segResult = profiling.inference( uflow.inferenceN, \
+    imgRGB.astype(floatType),\
+    unaries, \
+    args.inferenceMethod,\
     nhoodSz, \
-    nbrPotentialMethod, np.ascontiguousarray(nbrPotentialParams) )
+    nbrPotentialMethod, np.ascontiguousarray(nbrPotentialParams), \
+    tileSize=args.tileSize, nbThreads=args.nbThreads, weightScale=weightScale )
 
 #print 'size of reg result = ', segResult.shape
+profiling.endItem()
 
 # Show the result.
 dooverlay = False
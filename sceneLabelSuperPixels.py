@@ -20,8 +20,13 @@ parser.add_argument('infile', type=str, action='store', \
 parser.add_argument('--outfile', type=str, action='store', \
                         help='filename of output image with MRF inferred labels')
 parser.add_argument('--verbose', action='store_true')
+parser.add_argument('--profile', type=str, action='store', \
+                        help='append stage timings as JSON lines to this file (see profiling.py)')
 parser.add_argument('--K', type=float, action='store', default=0.1, \
                         help='Weighting for pairwise potential term in MRF.')
+parser.add_argument('--inferenceMethod', type=str, action='store', \
+                        choices=['abswap', 'aexpansion'], default='abswap',\
+                        help='Move-making algorithm for MRF inference.')
 parser.add_argument('--nbrPotentialMethod', type=str, action='store', \
                         choices=['degreeSensitive', 'adjacencyAndDegreeSensitive'], default='degreeSensitive',\
                         help='Neighbour potential method.  If adjacency is used, then --adjFn must be specified.')
@@ -53,22 +58,12 @@ import superPixels
 import skimage
 import isprs
 import features
+import labelling
+import profiling
 
-def getAdjProbs(name):
-    if name != None and len(name)>0:
-        print 'Loading adjacency probs...'
-        adjProbs = pomio.unpickleObject(name)
-        # This is actually a bunch of counts.  Some will be zero, which is probably
-        # a sampling error, so let's offset with some default number of counts.
-        adjProbs += 10.0
-        # Now turn it into normalised probabilities.
-        # todo: hey but this is not normalised for default class probability!
-        adjProbs /= adjProbs.sum()
-        # transform
-        adjProbs = -np.log( adjProbs )
-    else:
-        adjProbs = None
-    return adjProbs
+if args.profile:
+    profiling.enable( args.profile )
+profiling.beginItem( args.infile )
 
 # prefer to merge regions with high degree
 if args.nbrPotentialMethod == 'adjacencyAndDegreeSensitive':
@@ -168,22 +163,23 @@ else:
 
 # Get adjacency probs
 if args.adjFn != None:
-  adjProbs = getAdjProbs(args.adjFn)
+  adjProbs = labelling.getAdjProbs(args.adjFn)
     
     
 print 'Performing CRF inference...'
 if args.verbose:
     plt.figure()
 
-segResult = uflow.inferenceSuperPixel( \
+segResult = profiling.inference( uflow.inferenceSuperPixel, \
     spix,\
     -np.log( np.maximum(1E-10, np.ascontiguousarray(classProbs) ) ), \
     adjProbs, \
-    'abswap',\
+    args.inferenceMethod,\
     args.nbrPotentialMethod,\
     K )#, np.ascontiguousarray(nbrPotentialParams) )
 
 print '   done.'
+profiling.endItem()
 
 if args.outfile and len(args.outfile)>0:
     print 'Writing output label file %s' % args.outfile
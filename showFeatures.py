@@ -10,9 +10,9 @@ import argparse
 parser = argparse.ArgumentParser(description='Show features in binary file')
 
 parser.add_argument('ftrs', type=str, action='store', \
-                        help='filename of pkl or csv features data')
+                        help='filename of pkl, npy or csv features data')
 parser.add_argument('--labs', type=str, action='store', default=None,\
-                        help='filename of pkl or csv training labels data.  Optional.')
+                        help='filename of pkl, npy or csv training labels data.  Optional.')
 parser.add_argument('--nshow', type=int, default=3,\
                       help='Max number of features to show at once on scatter plot grid')
 parser.add_argument('--nstart', type=int, default=0,\
@@ -26,11 +26,8 @@ import pomio
 
 plt.interactive(1)
 
-# Load the features and labels
-if args.ftrs.endswith('.pkl'):
-    ftrs = pomio.unpickleObject( args.ftrs )
-else:
-    ftrs = pomio.readMatFromCSV( args.ftrs )
+# Load the features and labels.  npy feature stores are memory mapped.
+ftrs = pomio.readFeatureData( args.ftrs )
 N = ftrs.shape[0]
 D = ftrs.shape[1]
 print '%d feature vectors of dimensionality = %d' % (N,D)
@@ -38,10 +35,7 @@ print '%d feature vectors of dimensionality = %d' % (N,D)
 if args.labs == None:
   labs = None
 else:
-  if args.labs.endswith('.pkl'):
-      labs = pomio.unpickleObject( args.labs )
-  else:
-      labs = pomio.readMatFromCSV( args.labs ).astype(np.int32)
+  labs = pomio.readLabelData( args.labs )
 
 
 # show labels
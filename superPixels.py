@@ -9,7 +9,9 @@ import slic
 import matplotlib.pyplot as plt
 import pomio
 import amntools
-import multiprocessing as mp
+import arrayCache
+import workerPool
+import profiling
 
 """
 Functions and Classes for generating and dealing with super-pixels
@@ -25,7 +27,8 @@ def displayImage(image, imgTitle, orientation):
     plt.waitforbuttonpress()
 
 def getSuperPixels_SLIC(image, nbSegments, compactness):
-    return slic.slic_n(image, nbSegments, compactness)
+    with profiling.timer( 'slic' ):
+        return slic.slic_n(image, nbSegments, compactness)
 
 def getSuperPixels_Graph(image):
     # See [http://scikit-image.org/docs/dev/api/skimage.segmentation.html?highlight=slic#skimage.segmentation.felzenszwalb]
@@ -61,30 +64,47 @@ def generateImageWithSuperPixelBoundaries(image, segmentationMask):
     superPixelImage = mark_boundaries(image, segmentationMask)
     return superPixelImage
 
-# Note this only finds edges on a 4-grid.
-def make_graph(grid):
-    # get unique labels
-    vertices = np.unique(grid)
- 
-    # map unique labels to [1,...,num_labels]
-    reverse_dict = dict(zip(vertices,np.arange(len(vertices))))
-    grid = np.array([reverse_dict[x] for x in grid.flat]).reshape(grid.shape)
-   
-    # create edges
-    down = np.c_[grid[:-1, :].ravel(), grid[1:, :].ravel()]
-    right = np.c_[grid[:, :-1].ravel(), grid[:, 1:].ravel()]
-    all_edges = np.vstack([right, down])
-    all_edges = all_edges[all_edges[:, 0] != all_edges[:, 1], :]
-    all_edges = np.sort(all_edges,axis=1)
+# Returns the superpixel labels in grid, and the edges between them as an Ex2
+# int32 array of label pairs, each once, smallest label first.  Superpixels are
+# adjacent if they touch on a 4-grid, or with connectivity=8 diagonally too.
+# If image (HxWxC, same size as grid) is given, also returns for each edge its
+# boundary length (the number of adjacent pixel pairs across it) and mean
+# colour contrast (mean euclidean colour distance across those pairs).
+def make_graph(grid, connectivity=4, image=None):
+    assert connectivity in [ 4, 8 ]
+    shape = grid.shape
+    # get unique labels, and map them to [0,...,num_labels-1]
+    vertices, grid = np.unique(grid, return_inverse=True)
+    grid = grid.reshape(shape)
     num_vertices = len(vertices)
-    edge_hash = all_edges[:,0] + num_vertices * all_edges[:, 1]
+
+    # pairs of adjacent pixels, as slices of the grid
+    pairs = [ ( np.s_[:, :-1], np.s_[:, 1:] ), ( np.s_[:-1, :], np.s_[1:, :] ) ]
+    if connectivity == 8:
+        pairs += [ ( np.s_[:-1, :-1], np.s_[1:, 1:] ), ( np.s_[:-1, 1:], np.s_[1:, :-1] ) ]
+    ei = np.concatenate( [ grid[p].ravel() for p, q in pairs ] )
+    ej = np.concatenate( [ grid[q].ravel() for p, q in pairs ] )
+    cross = ( ei != ej )
+    ei, ej = ei[cross], ej[cross]
+    edge_hash = np.minimum(ei, ej).astype(np.int64) + num_vertices * np.maximum(ei, ej)
     # find unique connections
-    edges = np.unique(edge_hash)
+    edge_hash, edge_of_pair = np.unique(edge_hash, return_inverse=True)
     # undo hashing
-    edges = [[vertices[x%num_vertices],
-              vertices[x/num_vertices]] for x in edges]
- 
-    return vertices, edges
+    edges = np.empty( (len(edge_hash), 2), dtype=np.int32 )
+    edges[:,0] = vertices[ edge_hash % num_vertices ]
+    edges[:,1] = vertices[ edge_hash // num_vertices ]
+
+    if image is None:
+        return vertices, edges
+
+    assert image.shape[:2] == shape
+    image = image.reshape( shape + (-1,) ).astype(float)
+    diff = np.concatenate( [ ( image[p] - image[q] ).reshape( (-1, image.shape[2]) ) \
+                               for p, q in pairs ] )[cross]
+    boundary_length = np.bincount( edge_of_pair, minlength=len(edges) )
+    contrast = np.bincount( edge_of_pair, weights=np.sqrt( (diff**2).sum(axis=1) ), \
+                              minlength=len(edges) ) / np.maximum( boundary_length, 1 )
+    return vertices, edges, boundary_length.astype(np.int32), contrast
 
 def show_graph(grid, vertices, edges):
     # compute region centers:
@@ -105,16 +125,53 @@ def show_graph(grid, vertices, edges):
 
 
 
-class SuperPixelGraph:
-    def __init__(self,labels,nodes,edges):
+class SuperPixelGraph(object):
+    # Array-backed, with no per-instance dict, as there can be one per image of
+    # a data set in memory.
+    __slots__ = ( 'm_labels', 'm_nodes', 'm_edges', 'm_edgeLengths', 'm_edgeContrasts', \
+                  'm_nbrStart', 'm_nbrs', 'm_nbrEdges' )
+
+    # The arguments can be left out when unpickling graphs saved by older
+    # versions, see __setstate__.
+    def __init__(self,labels=None,nodes=None,edges=None,edgeLengths=None,edgeContrasts=None):
+        if labels is None:
+            return
         # labels is a HxW matrix of super-pixel labels.
         self.m_labels = labels
         # nodes is a vector of super-pixel label/index.
         self.m_nodes = nodes
-        # edges is a list of 2-tuples (ei,ej) where the edge connects super-pixels ei and ej (integer index/label).
-        self.m_edges = edges
+        # edges is an Ex2 int32 array, row e = (ei,ej) where the edge connects super-pixels ei and ej (integer index/label).
+        # Can be given as a list of pairs.
+        self.m_edges = np.ascontiguousarray( np.asarray( edges, dtype=np.int32 ).reshape( (-1,2) ) )
+        # Optional per-edge data from make_graph: boundary length in pixel pairs,
+        # and mean colour contrast across the boundary.
+        self.m_edgeLengths = edgeLengths
+        self.m_edgeContrasts = edgeContrasts
         # for now all our code relies on the superpixels being consecutive.
         assert np.all(self.m_nodes == np.arange(len(self.m_nodes)))
+        self.buildAdjacency()
+
+    # Builds the adjacency in CSR form: the neighbours of superpixel i are
+    # m_nbrs[ m_nbrStart[i] : m_nbrStart[i+1] ], joined to it by the edges
+    # with the same indices in m_nbrEdges.
+    def buildAdjacency(self):
+        n = self.getNumSuperPixels()
+        E = len(self.m_edges)
+        ends = np.concatenate( [ self.m_edges[:,0], self.m_edges[:,1] ] )
+        order = np.argsort( ends, kind='mergesort' )
+        self.m_nbrs = np.concatenate( [ self.m_edges[:,1], self.m_edges[:,0] ] )[order]
+        self.m_nbrEdges = np.concatenate( [ np.arange(E), np.arange(E) ] )[order].astype(np.int32)
+        self.m_nbrStart = np.zeros( (n+1,), dtype=np.int32 )
+        np.cumsum( np.bincount( ends, minlength=n ), out=self.m_nbrStart[1:] )
+
+    # The adjacency isn't saved, it is rebuilt when loaded.
+    def __getstate__(self):
+        return dict( ( k, getattr(self, k) ) for k in self.__slots__[:5] )
+
+    def __setstate__(self, state):
+        # Graphs saved by older versions only have labels, nodes and edges.
+        self.__init__( state['m_labels'], state['m_nodes'], state['m_edges'], \
+                         state.get('m_edgeLengths'), state.get('m_edgeContrasts') )
 
     def draw(self):
         show_graph(self.m_labels, self.m_nodes, self.m_edges)
@@ -138,47 +195,92 @@ class SuperPixelGraph:
 
     # Returns: (adjMatrix,nbAdjInvolvingVoid,nbAdj)
     def countClassAdjacencies( self, nbClasses, allSPClassLabels ):
-        counts = np.zeros( ( nbClasses, nbClasses ) )
-        voidLabel = pomio.getVoidIdx()
-        adjVoidCount = 0
-        adjCount = len(self.m_edges)
-
-        for (ei, ej) in self.m_edges:
-            ci = allSPClassLabels[ ei ]
-            cj = allSPClassLabels[ ej ]
-            # Not doing stats for void
-            if ci != voidLabel and cj != voidLabel:
-                counts[ ci, cj ] += 1
-                counts[ cj, ci ] += 1
-            else:
-                adjVoidCount += 1
-        return (counts, adjVoidCount, adjCount)
+        return countClassAdjacenciesMulti( nbClasses, [ self ], [ allSPClassLabels ] )
 
     def getNumSuperPixels( self ):
         return len(self.m_nodes)
 
+    def getNumEdges( self ):
+        return len(self.m_edges)
+
     def getLabelImage( self ):
         return self.m_labels
 
-def computeSuperPixelGraph( imgRGB, method, params ):
+    # Number of neighbours of each superpixel.
+    def getDegrees( self ):
+        return np.diff( self.m_nbrStart )
+
+    def getDegree( self, i ):
+        return self.m_nbrStart[i+1] - self.m_nbrStart[i]
+
+    def getNeighbours( self, i ):
+        return self.m_nbrs[ self.m_nbrStart[i] : self.m_nbrStart[i+1] ]
+
+    # Indices of the edges to the neighbours of superpixel i.
+    def getNeighbourEdges( self, i ):
+        return self.m_nbrEdges[ self.m_nbrStart[i] : self.m_nbrStart[i+1] ]
+
+    # Weights of the edges to the neighbours of superpixel i, from a vector of
+    # per-edge weights such as m_edgeLengths (the default) or m_edgeContrasts.
+    def getNeighbourWeights( self, i, edgeWeights=None ):
+        if edgeWeights is None:
+            edgeWeights = self.m_edgeLengths
+        assert edgeWeights is not None, 'graph has no edge weights'
+        return np.asarray( edgeWeights )[ self.getNeighbourEdges( i ) ]
+
+# Class adjacency counts over many graphs at once, with allSPClassLabels the
+# superpixel class labels of each graph.  Edges with void at either end are
+# not counted.
+# Returns: (adjMatrix,nbAdjInvolvingVoid,nbAdj)
+def countClassAdjacenciesMulti( nbClasses, spGraphs, allSPClassLabels ):
+    voidLabel = pomio.getVoidIdx()
+    ci = np.concatenate( [ np.asarray( labs )[ g.m_edges[:,0] ] \
+                             for g, labs in zip( spGraphs, allSPClassLabels ) ] + [ np.zeros(0, dtype=int) ] )
+    cj = np.concatenate( [ np.asarray( labs )[ g.m_edges[:,1] ] \
+                             for g, labs in zip( spGraphs, allSPClassLabels ) ] + [ np.zeros(0, dtype=int) ] )
+    adjCount = len(ci)
+    # Not doing stats for void
+    good = ( ci != voidLabel ) & ( cj != voidLabel )
+    adjVoidCount = adjCount - np.count_nonzero( good )
+    ci = ci[good].astype(np.int64)
+    cj = cj[good].astype(np.int64)
+    assert len(ci) == 0 or max( ci.max(), cj.max() ) < nbClasses, 'class label out of range'
+    counts = np.bincount( ci * nbClasses + cj, \
+                            minlength=nbClasses*nbClasses ).reshape( (nbClasses, nbClasses) )
+    counts = ( counts + counts.T ).astype(float)
+    return (counts, adjVoidCount, adjCount)
+
+# Version of computeSuperPixelGraph in arrayCache.  Bump it whenever the super
+# pixels (SLIC and its parameters) or make_graph change.
+spGraphCacheVersion = 1
+
+# imgRGB can also be a pomio.LabelledImage, whose image is read here.  Results
+# are kept in arrayCache, keyed by the image content, method and params.
+# connectivity is 4 or 8, see make_graph.
+def computeSuperPixelGraph( imgRGB, method, params, connectivity=4 ):
+    imgRGB = pomio.msrc_imageOf( imgRGB )
+    if arrayCache.enabled():
+        key = arrayCache.makeKey( spGraphCacheVersion, imgRGB, method, [ float(p) for p in params ], connectivity )
+        cached = arrayCache.load( 'spgraph', key )
+        if cached != None and 'edgeLengths' in cached:
+            return SuperPixelGraph( cached['labels'], cached['nodes'], cached['edges'], \
+                                      cached['edgeLengths'], cached['edgeContrasts'] )
     if method == 'slic':
         nbSegments, compactness = params[0], params[1]
         labels = getSuperPixels_SLIC(imgRGB, nbSegments, compactness)
-        nodes, edges = make_graph(labels) 
+        with profiling.timer( 'graphBuild' ):
+            nodes, edges, edgeLengths, edgeContrasts = make_graph(labels, connectivity, imgRGB)
     else:
         raise Exception('invalid superpixel method %s' % method)
-    return SuperPixelGraph(labels,nodes,edges)
-
-def computeSuperPixelGraphMulti( imgRGBArray, method, params, nbCores=1 ):
-  if nbCores>1:
-    job_server = mp.Pool(nbCores)
-    jres = [ job_server.apply_async( computeSuperPixelGraph, ( img, method, params ) ) \
-               for img in imgRGBArray ]
-    tOutSecs = 10*60 # 10 mins
-    res = [ jr.get(timeout=tOutSecs) for jr in jres ]
-  else:
-    res = [ computeSuperPixelGraph( img, method, params ) for img in imgRGBArray ]
-  return res
+    if arrayCache.enabled():
+        arrayCache.save( 'spgraph', key, labels=labels, nodes=nodes, edges=edges, \
+                           edgeLengths=edgeLengths, edgeContrasts=edgeContrasts )
+    return SuperPixelGraph(labels,nodes,edges,edgeLengths,edgeContrasts)
+
+# Runs in the shared workerPool if nbCores > 1.
+def computeSuperPixelGraphMulti( imgRGBArray, method, params, nbCores=1, connectivity=4 ):
+  return workerPool.mapMulti( computeSuperPixelGraph, \
+                                ( ( img, method, params, connectivity ) for img in imgRGBArray ), nbCores )
 
 ###################################
 # tests
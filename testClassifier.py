@@ -21,6 +21,8 @@ parser.add_argument('--outfile', type=str, action='store', \
 parser.add_argument('--outprobsfile', type=str, \
                         help='filename of output probabilities image.  If specified, the 3D matrix of probabilities will be output as a pickle (.pkl) file')
 parser.add_argument('--verbose', action='store_true')
+parser.add_argument('--profile', type=str, action='store', \
+                        help='append stage timings as JSON lines to this file (see profiling.py)')
 parser.add_argument('--nbSuperPixels', type=int, default=400, \
                         help='Desired number of super pixels in SLIC over-segmentation')
 parser.add_argument('--superPixelCompactness', type=float, default=10.0, \
@@ -36,6 +38,11 @@ import superPixels
 import skimage
 import classification
 import amntools
+import profiling
+
+if args.profile:
+    profiling.enable( args.profile )
+profiling.beginItem( args.infile )
 
 clfrFn = args.clfrFn
 clfr = pomio.unpickleObject( clfrFn )
@@ -82,6 +89,8 @@ if makeProbs:
     assert spClassProbs != None
     pomio.pickleObject( (spGraph,spClassProbs), args.outprobsfile )
 
+profiling.endItem()
+
 if args.verbose:
     plt.interactive(0)
     plt.show()
@@ -8,9 +8,9 @@ import argparse
 parser = argparse.ArgumentParser(description='Train a classifier for MRF project.')
 
 parser.add_argument('ftrs', type=str, action='store', \
-                        help='filename of pkl or csv training features data')
+                        help='filename of pkl, npy or csv training features data')
 parser.add_argument('labs', type=str, action='store', \
-                        help='filename of pkl or csv training labels data')
+                        help='filename of pkl, npy or csv training labels data')
 parser.add_argument('--outfile', type=str, action='store', \
                         help='filename of pkl for output trained classifier object')
 parser.add_argument('--type', type=str, action='store', default='randyforest', \
@@ -107,18 +107,12 @@ labs = None
 ftrs = None
 
 
-# Load the features and labels
-if infileFtrs.endswith('.pkl'):
-    ftrs = pomio.unpickleObject( infileFtrs )
-else:
-    ftrs = pomio.readMatFromCSV( infileFtrs )
+# Load the features and labels.  npy feature stores are memory mapped.
+ftrs = pomio.readFeatureData( infileFtrs )
 D = ftrs.shape[1]
 print 'Feature dimensionality = ', D
 
-if infileLabs.endswith('.pkl'):
-    labs = pomio.unpickleObject( infileLabs )
-else:
-    labs = pomio.readMatFromCSV( infileLabs ).astype(np.int32)
+labs = pomio.readLabelData( infileLabs )
 
 n = len(labs)
 assert n == ftrs.shape[0], 'Error: there are %d labels and %d training examples' \
@@ -306,15 +300,8 @@ reportAccuracy( 'Training set', labs, predlabs )
 # optionally test classifier on hold-out test set
 if infileFtrsTest != None and infileLabsTest != None:
     # Load the features and labels
-    if infileFtrsTest.endswith('.pkl'):
-        ftrsTest = pomio.unpickleObject( infileFtrsTest )
-    else:
-        ftrsTest = pomio.readMatFromCSV( infileFtrsTest )
-    
-    if infileLabsTest.endswith('.pkl'):
-        labsTest = pomio.unpickleObject( infileLabsTest )
-    else:
-        labsTest = pomio.readMatFromCSV( infileLabsTest ).astype(np.int32)
+    ftrsTest = pomio.readFeatureData( infileFtrsTest )
+    labsTest = pomio.readLabelData( infileLabsTest )
     
     ntest = len(labsTest)
     assert ntest == ftrsTest.shape[0], 'Error: for TEST set, there are %d labels and %d features' \
@@ -0,0 +1,231 @@
+import os
+import Queue
+import atexit
+import itertools
+import tempfile
+import threading
+import time
+import numpy as np
+import multiprocessing as mp
+
+"""
+A long-lived pool of worker processes, shared by the *Multi functions so that
+they don't each start (and leak) their own.  Tasks are fed to the pool lazily,
+with at most maxInFlight outstanding, so a long list of images is never all in
+the pipe or in memory at once.  Image arrays can be passed through shared
+memory rather than pickled, see SharedArray.
+"""
+
+_pool = None
+_poolSize = 0
+_poolLock = threading.Lock()
+
+def inWorker():
+  # Pool workers are daemons, and can't start pools of their own.
+  return mp.current_process().daemon
+
+# Returns the shared pool, creating it (or recreating it if the size changed).
+def getPool( nbCores ):
+  global _pool, _poolSize
+  assert nbCores > 1
+  with _poolLock:
+    if _pool != None and _poolSize != nbCores:
+      _shutdownLocked()
+    if _pool == None:
+      _pool = mp.Pool( nbCores )
+      _poolSize = nbCores
+    return _pool
+
+def _shutdownLocked():
+  global _pool, _poolSize
+  if _pool != None:
+    _pool.close()
+    _pool.join()
+    _pool = None
+    _poolSize = 0
+
+# Waits for the workers to finish and stops them.  Called at exit, or can be
+# called to free the workers' memory.
+def shutdown():
+  with _poolLock:
+    _shutdownLocked()
+
+atexit.register( shutdown )
+
+# Read-only objects for the workers, such as a classifier, that are given to
+# them by forking rather than pickled with each task.
+_shared = {}
+
+# Makes value available to the workers as getShared(name).  If the pool is
+# already running it is stopped, so that the next one is forked with the value.
+def setShared( name, value ):
+  with _poolLock:
+    _shared[ name ] = value
+    _shutdownLocked()
+
+def getShared( name ):
+  return _shared[ name ]
+
+
+#
+# Shared memory arrays
+#
+
+# Directory for shared arrays: a ram disk if there is one.
+sharedMemoryDir = '/dev/shm' if os.path.isdir( '/dev/shm' ) else None
+
+class SharedArray:
+  """Handle to a copy of an array in shared memory (a memory-mapped file on a ram
+  disk).  Pickles as just the filename, shape and dtype.  The process that made
+  it must call free() when the workers are done with it."""
+
+  def __init__( self, arr ):
+    arr = np.ascontiguousarray( arr )
+    fd, self.m_fn = tempfile.mkstemp( suffix='.npy', prefix='amn_', dir=sharedMemoryDir )
+    os.close( fd )
+    mm = np.lib.format.open_memmap( self.m_fn, mode='w+', dtype=arr.dtype, shape=arr.shape )
+    mm[...] = arr
+    del mm
+
+  def get( self ):
+    # Copy-on-write view, so workers can't change the parent's data.
+    return np.load( self.m_fn, mmap_mode='c' )
+
+  def free( self ):
+    if os.path.exists( self.m_fn ):
+      os.remove( self.m_fn )
+
+# Replaces numpy arrays in args by SharedArrays.  Returns the new args and the
+# SharedArrays to free.
+def _shareArrays( args ):
+  shared = []
+  res = []
+  for a in args:
+    if isinstance( a, np.ndarray ) and a.nbytes >= 65536:
+      a = SharedArray( a )
+      shared.append( a )
+    res.append( a )
+  return tuple( res ), shared
+
+def _callWithArrays( fn, args ):
+  args = [ a.get() if isinstance( a, SharedArray ) else a for a in args ]
+  return fn( *args )
+
+# Runs a chunk of tasks in a worker.  An exception is returned rather than
+# raised, so that the callback of apply_async is always called.
+def _callChunk( chunk ):
+  try:
+    return True, [ _callWithArrays( fn, args ) for fn, args in chunk ]
+  except Exception, e:
+    return False, e
+
+
+#
+# Mapping
+#
+
+# How often imapMulti checks for failed or lost tasks while it waits, in seconds.
+# Waiting with a timeout also lets Ctrl-C through.
+_pollSeconds = 1.0
+
+# Raises the exception of any chunk that the pool failed, e.g. because its
+# task or result couldn't be pickled.  The callback isn't called for those.
+def _checkFailed( handles ):
+  for h in handles.values():
+    if h.ready() and not h.successful():
+      h.get()
+
+# Yields fn(*args) for each tuple of args in argsList, in order if ordered is
+# true, else as they finish.  fn must be a module-level function.  With
+# nbCores > 1 the calls are made in the shared pool, chunksize tasks at a time,
+# with at most maxInFlight tasks given to the pool and not yet yielded (default
+# 4 per core).  Large array arguments go through shared memory.  If no task
+# finishes for timeout seconds, e.g. because a worker died, raises an
+# exception.  In a pool worker, or with nbCores <= 1, the calls are made here.
+def imapMulti( fn, argsList, nbCores=1, chunksize=1, maxInFlight=None, ordered=True, \
+                 timeout=10*60 ):
+  if nbCores <= 1 or inWorker():
+    for args in argsList:
+      yield fn( *args )
+    return
+
+  if maxInFlight == None:
+    maxInFlight = 4 * nbCores
+  # The limit is applied here, by giving the pool a chunk only when another is
+  # taken back, rather than by blocking the pool's task feeding thread.  So
+  # other users of the pool are never held up, and it can be shut down at any
+  # time.
+  maxChunks = max( 1, maxInFlight // chunksize )
+  argsIter = iter( argsList )
+  # Chunks back from the pool, as (chunk index, (ok, results)).
+  done = Queue.Queue()
+  # SharedArrays and AsyncResults of the chunks not yet back, by chunk index.
+  shared = {}
+  handles = {}
+  state = { 'nbSubmitted': 0 }
+
+  # Gives the next chunk to the pool.  Returns False if there are no more.
+  def submit():
+    args = list( itertools.islice( argsIter, chunksize ) )
+    if len( args ) == 0:
+      return False
+    idx = state['nbSubmitted']
+    state['nbSubmitted'] += 1
+    chunk = []
+    shared[idx] = []
+    for a in args:
+      a, arrays = _shareArrays( a )
+      shared[idx] += arrays
+      chunk.append( ( fn, a ) )
+    # The pool is looked up each time, in case it was restarted meanwhile.
+    handles[idx] = getPool( nbCores ).apply_async( _callChunk, ( chunk, ), \
+                                                     callback=lambda res, idx=idx: done.put( ( idx, res ) ) )
+    return True
+
+  # Chunks back early, waiting for those before them if ordered.
+  early = {}
+  nbTaken = 0
+  try:
+    while state['nbSubmitted'] < maxChunks and submit():
+      pass
+    lastDone = time.time()
+    while nbTaken < state['nbSubmitted']:
+      try:
+        idx, ( ok, res ) = done.get( True, _pollSeconds )
+      except Queue.Empty:
+        _checkFailed( handles )
+        if time.time() - lastDone > timeout:
+          raise RuntimeError( 'No task finished in the worker pool for %d s: a worker may have died' \
+                                % timeout )
+        continue
+      lastDone = time.time()
+      del handles[idx]
+      for a in shared.pop( idx ):
+        a.free()
+      if not ok:
+        raise res
+      if ordered:
+        early[idx] = res
+        ready = []
+        while nbTaken in early:
+          ready.append( early.pop( nbTaken ) )
+          nbTaken += 1
+      else:
+        ready = [ res ]
+        nbTaken += 1
+      while state['nbSubmitted'] - nbTaken < maxChunks and submit():
+        pass
+      for res in ready:
+        for r in res:
+          yield r
+  finally:
+    # If abandoned early or a task failed, no more chunks are given to the
+    # pool.  Those still running have their shared arrays deleted under them.
+    for arrays in shared.values():
+      for a in arrays:
+        a.free()
+    shared.clear()
+
+# List of fn(*args) for each tuple of args in argsList, in order.
+def mapMulti( fn, argsList, nbCores=1, chunksize=1, maxInFlight=None, timeout=10*60 ):
+  return list( imapMulti( fn, argsList, nbCores, chunksize, maxInFlight, True, timeout ) )